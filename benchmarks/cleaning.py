@@ -0,0 +1,81 @@
+""" Time the cleaning functions on a generated 1MB Gutenberg-style book,
+and print a digest of their output on random HTML fragments.
+
+    python benchmarks/cleaning.py [fragments]
+
+Times the lazynlp on the Python path, so to compare with another revision,
+check it out in a worktree and run the script with it first on the path:
+
+    git worktree add /tmp/lazynlp-old <revision>
+    PYTHONPATH=/tmp/lazynlp-old python benchmarks/cleaning.py
+    PYTHONPATH=. python benchmarks/cleaning.py
+
+Revisions whose functions give the same output print the same digests.
+The book and the fragments are drawn with a fixed seed.
+"""
+import hashlib
+import os
+import random
+import sys
+import timeit
+
+import lazynlp
+
+REPEAT = 5
+FUNCTIONS = ['clean_html', 'collapse_white_spaces', 'connect_lines',
+             'remove_non_alpha', 'remove_non_alphanumeric']
+PIECES = ['<p>', '</p>', '<br>', '<b>', '</b>', '<i class="x">', '</i>',
+          '<style>p {}</style>', '<style type="text/css">a</style>',
+          '<script>var a = 1;</script>', '<script src="x.js"></script>',
+          '<script><style>b</style></script>', '<!DOCTYPE html>',
+          '<a\nhref="x">', '<', '>', '\n', '\n\n', '  ', '   ', '\t', ' ',
+          'word', 'Word', 'two words', 'it was', '42', '-', '.', ',', 'é']
+
+
+def get_book(size=2**20, seed=0):
+    """ Return about size characters of text in the Gutenberg layout:
+    paragraphs of hard-wrapped lines separated by blank lines,
+    with a few tags and runs of spaces.
+    """
+    rng = random.Random(seed)
+    words = ['the', 'of', 'and', 'it', 'was', 'best', 'times', 'worst',
+             'age', 'wisdom', 'foolishness', 'epoch', 'belief', 'Light',
+             'Darkness', 'spring', 'hope', 'winter', 'despair']
+    lines, length = ['<!DOCTYPE html>', '<style>p {margin: 0}</style>'], 0
+    while length < size:
+        for _ in range(rng.randint(2, 12)):
+            line = ' '.join(rng.choice(words) for _ in range(12))
+            if rng.random() < 0.2:
+                line = f'<i>{line}</i>  {rng.choice(words)}'
+            if rng.random() < 0.1:
+                line = '    ' + line
+            lines.append(line)
+            length += len(line) + 1
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def get_fragments(count, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(PIECES) for _ in range(rng.randint(1, 30)))
+            for _ in range(count)]
+
+
+def main(fragments=20000):
+    print(f'lazynlp from {os.path.dirname(lazynlp.__file__)}')
+    book = get_book()
+    texts = get_fragments(fragments)
+    print(f'{len(book)} characters, best of {REPEAT}')
+    for name in FUNCTIONS:
+        fn = getattr(lazynlp, name)
+        elapsed = min(timeit.repeat(lambda: fn(book), number=1,
+                                    repeat=REPEAT))
+        digest = hashlib.sha256()
+        for txt in texts:
+            digest.update(fn(txt).encode('utf-8') + b'\0')
+        print(f'  {name:24} {elapsed * 1000:6.1f}ms  '
+              f'{fragments} fragments: {digest.hexdigest()[:16]}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
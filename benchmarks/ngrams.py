@@ -0,0 +1,70 @@
+""" Time build_ngram and estimate_overlap_bf on generated text.
+
+    python benchmarks/ngrams.py [lines]
+
+Times the lazynlp on the Python path, so to compare with another revision,
+check it out in a worktree and run the script with it first on the path:
+
+    git worktree add /tmp/lazynlp-old <revision>
+    PYTHONPATH=/tmp/lazynlp-old python benchmarks/ngrams.py
+    PYTHONPATH=. python benchmarks/ngrams.py
+
+The text is 20k lines of 34 words by default, about 530k 8-grams, drawn
+with a fixed seed from a Zipf-like vocabulary so that runs are comparable.
+A set stands in for the Bloom filter, to time the n-gram code only.
+Revisions without hashed n-grams only get the string timings.
+"""
+import inspect
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+import lazynlp
+
+N = 8
+REPEAT = 3
+
+
+def write_text(path, lines, words=34, vocab=50000, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                          for _ in range(rng.randint(2, 10)))
+                  for _ in range(vocab)]
+    weights = [1 / (rank + 1) for rank in range(vocab)]
+    with open(path, 'w') as f:
+        for _ in range(lines):
+            tokens = rng.choices(vocabulary, weights, k=words)
+            f.write(' '.join(tokens).capitalize() + '.\n')
+
+
+def best_of(fn):
+    return min(timeit.repeat(fn, number=1, repeat=REPEAT))
+
+
+def main(lines=20000):
+    hashed = 'hashed' in inspect.signature(lazynlp.build_ngram).parameters
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'text.txt')
+        write_text(path, lines)
+        print(f'lazynlp from {os.path.dirname(lazynlp.__file__)}')
+        print(f'{lines} lines, best of {REPEAT}')
+
+        modes = [{'hashed': False}, {'hashed': True}] if hashed else [{}]
+        for mode in modes:
+            count = best_of(lambda: lazynlp.build_ngram(path, n=N, **mode))
+            bf = set()
+            build = best_of(lambda: lazynlp.build_ngram(path, bf=bf, n=N,
+                                                        **mode))
+            overlap = best_of(lambda: lazynlp.estimate_overlap_bf(
+                bf, path, n=N, **mode))
+            name = 'hashed' if mode.get('hashed') else 'strings'
+            print(f'{name}: {len(bf)} distinct {N}-grams')
+            print(f'  build_ngram          {count:.2f}s')
+            print(f'  build_ngram, bf      {build:.2f}s')
+            print(f'  estimate_overlap_bf  {overlap:.2f}s')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,7 +1,13 @@
 __VERSION__ = '0.0.1'
 
+from .aiocrawl import *
 from .analytics import *
+from .bloom import *
 from .cleaner import *
 from .create import *
 from .crawl import *
+from .dedup import *
+from .distcrawl import *
+from .resolver import *
+from .store import *
 from .utils import *
\ No newline at end of file
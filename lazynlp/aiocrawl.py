@@ -0,0 +1,462 @@
+import asyncio
+import collections
+import concurrent.futures
+import socket
+import time
+
+import aiohttp
+import aiohttp.abc
+
+from .cleaner import *
+from .crawl import *
+
+
+class CacheResolver(aiohttp.abc.AbstractResolver):
+    """ aiohttp resolver that looks up hosts in a DNSCache, so that the
+    asyncio crawler uses the cache without replacing socket.getaddrinfo
+    for the whole process.
+    """
+
+    def __init__(self, dns):
+        self.dns = dns
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        # shielded, so that a cancelled request doesn't cancel the lookup
+        # other requests to the host wait for
+        addresses = await asyncio.shield(
+            asyncio.wrap_future(self.dns.prefetch(host)))
+        results = []
+        for address in addresses:
+            address_family = get_address_family(address)
+            if family in (0, socket.AF_UNSPEC, address_family):
+                results.append({'hostname': host,
+                                'host': address,
+                                'port': port,
+                                'family': address_family,
+                                'proto': socket.IPPROTO_TCP,
+                                'flags': socket.AI_NUMERICHOST |
+                                socket.AI_NUMERICSERV})
+        if not results:
+            raise socket.gaierror(socket.EAI_NONAME,
+                                  f'No address of family {family} for {host}')
+        return results
+
+    async def close(self):
+        pass
+
+
+class HostLimiter:
+    """ Per-host politeness for the asyncio crawler.
+    At most per_host requests to the same host are in flight at any time,
+    and two requests to the same host start at least delay seconds apart.
+    """
+
+    def __init__(self, per_host=4, delay=0):
+        self.per_host = per_host
+        self.delay = delay
+        self.semaphores = {}
+        self.users = {}
+        self.next_start = {}
+
+    async def acquire(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.per_host)
+            self.users[host] = 0
+        self.users[host] += 1
+        await self.semaphores[host].acquire()
+
+        if self.delay > 0:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.delay
+            if start > now:
+                await asyncio.sleep(start - now)
+
+    def release(self, host):
+        self.semaphores[host].release()
+        self.users[host] -= 1
+        if self.users[host] == 0:
+            # forget idle hosts so memory doesn't grow with the link list
+            del self.semaphores[host]
+            del self.users[host]
+            if self.next_start.get(host, 0) <= asyncio.get_running_loop().time():
+                self.next_start.pop(host, None)
+
+
+def timed_clean_page(page, parser='justext', prefilter=False,
+                     content_type=None):
+    """ Clean the page in a cleaner process.
+    Return the text, the encoding of the page,
+    and the seconds it took to clean it.
+    """
+    start = time.time()
+    txt, encoding = clean_page(page, parser, prefilter, content_type,
+                               with_encoding=True)
+    return txt, encoding, time.time() - start
+
+
+class AsyncCrawler:
+    """ Crawl a list of URLs with asyncio, keeping up to concurrency
+    requests in flight, while writing the same outputs as download_pages.
+
+    Pages are indexed in the order in which they finish downloading,
+    so idx of each page isn't necessarily its order in the link file.
+
+    clean_workers:
+        if set, pages are cleaned in a pool of clean_workers processes
+        instead of a thread, so cleaning scales with the number of cores.
+        At most max_pending pages (default 4 * clean_workers) wait for
+        a cleaner at any time. When the cleaners fall behind, fetchers stop
+        fetching until a slot frees up, so memory stays flat.
+    interval:
+        how often (in number of URLs) to report fetch and clean throughput.
+    checkpoint_interval:
+        how often (in number of URLs) to save the progress, see CrawlLog.
+    shard_size:
+        if set, write pages into shards of shard_size pages, see ShardWriter.
+    parser, prefilter:
+        how to clean pages, see clean_page.
+    max_size:
+        if set, give up on pages larger than max_size bytes as soon as
+        they get larger.
+    max_failures, cooldown, rate:
+        fail fast on hosts that are down and limit the rate of requests
+        to each host, see HostHealth.
+    dns_ttl, prefetch, resolver:
+        cache host resolutions and resolve the hosts of the next prefetch
+        URLs ahead of the fetchers, see download_pages.
+    """
+
+    def __init__(self,
+                 folder,
+                 timeout=30,
+                 default_skip=True,
+                 extensions=None,
+                 domains=None,
+                 concurrency=512,
+                 per_host=4,
+                 delay=0,
+                 context=None,
+                 clean_workers=None,
+                 max_pending=None,
+                 interval=10000,
+                 checkpoint_interval=100,
+                 shard_size=None,
+                 parser='justext',
+                 prefilter=False,
+                 max_size=None,
+                 max_failures=None,
+                 cooldown=300,
+                 rate=None,
+                 dns_ttl=None,
+                 prefetch=1000,
+                 resolver=None):
+        self.folder = folder
+        self.timeout = timeout
+        self.url_filter = URLFilter(default_skip, extensions, domains)
+        self.concurrency = concurrency
+        self.limiter = HostLimiter(per_host, delay)
+        self.context = context if context is not None else get_ssl_context()
+        self.checkpoint_interval = checkpoint_interval
+        self.shard_size = shard_size
+        self.parser = parser
+        self.prefilter = prefilter
+        self.max_size = max_size
+        self.health = None
+        if max_failures or rate:
+            self.health = HostHealth(max_failures, cooldown, rate)
+        self.dns_ttl = dns_ttl
+        self.prefetch = prefetch
+        self.resolver = resolver
+        self.dns = None
+        self.log = None
+        self.clean_workers = clean_workers
+        self.max_pending = max_pending or 4 * (clean_workers or 1)
+        self.interval = interval
+        self.pool = None
+        self.pending = None
+        self.stats = {'urls': 0,
+                      'fetched': 0,
+                      'fetched_bytes': 0,
+                      'cleaned': 0,
+                      'clean_time': 0,
+                      'wait_time': 0,
+                      'encodings': collections.Counter()}
+
+    async def fetch(self, session, link):
+        """ Return code, page, content_type like fetch_page.
+        Same return codes as download_page.
+        0: successfully read
+        1: bad_url
+        2: unicode error
+        3: bad connection
+        """
+        host = get_host(link)
+        if not host:
+            print(link, "doesn't exist.")
+            return 1, '', None
+
+        if self.health is None:
+            return await self.request(session, link, host)
+        if not self.health.allow(host):
+            print('Circuit open', link)
+            return 3, '', None
+        wait = self.health.reserve(host)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        start = time.time()
+        code = 3
+        try:
+            code, page, content_type = await self.request(
+                session, link, host, connect_code=CONNECT_CODE)
+        finally:
+            self.health.record(host, code in (3, CONNECT_CODE),
+                               time.time() - start)
+        if code == CONNECT_CODE:
+            return 1, '', None
+        return code, page, content_type
+
+    async def request(self, session, link, host, connect_code=1):
+        """ fetch without the checks of health. connect_code is returned
+        instead of 1 when the host can't be connected to.
+        """
+        await self.limiter.acquire(host)
+        try:
+            async with session.get(link, ssl=self.context) as response:
+                if response.status >= 400:
+                    print('Error {} for {}'.format(response.status, link))
+                    return 1, '', None
+                page = await self.read(response)
+                if page is None:
+                    print('Page too large', link)
+                    return 1, '', None
+                content_type = response.headers.get('Content-Type')
+        except UnicodeError:
+            print('UnicodeError for', link)
+            return 2, '', None
+        except (aiohttp.InvalidURL, ValueError):
+            print(link, "doesn't exist.")
+            return 1, '', None
+        except aiohttp.ClientConnectorError:
+            print('URLError for', link)
+            return connect_code, '', None
+        except (aiohttp.ClientOSError, asyncio.TimeoutError):
+            print('ConnectionError or Timeout', link)
+            return 3, '', None
+        except aiohttp.ClientError:
+            print('HTTPException', link)
+            return 1, '', None
+        finally:
+            self.limiter.release(host)
+        return 0, page, content_type
+
+    async def read(self, response):
+        """ Return the body of response, or None if it's larger
+        than max_size
+        """
+        if self.max_size is None:
+            return await response.read()
+        length = response.content_length
+        if length is not None and length > self.max_size:
+            return None
+        chunks, size = [], 0
+        async for chunk in response.content.iter_chunked(2**16):
+            size += len(chunk)
+            if size > self.max_size:
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def clean(self, page, content_type=None):
+        """ Clean the page off the event loop so that it doesn't
+        stall the other requests.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        await self.pending.acquire()
+        self.stats['wait_time'] += time.time() - start
+        try:
+            txt, encoding, clean_time = await loop.run_in_executor(
+                self.pool,
+                timed_clean_page,
+                page,
+                self.parser,
+                self.prefilter,
+                content_type)
+        finally:
+            self.pending.release()
+        self.stats['cleaned'] += 1
+        self.stats['clean_time'] += clean_time
+        if encoding:
+            self.stats['encodings'][encoding] += 1
+        return txt
+
+    def report(self, elapsed):
+        """ Print fetch and clean throughput so far.
+        Cleaning throughput is per cleaner, excluding the time
+        pages wait for a cleaner.
+        """
+        stats = self.stats
+        elapsed = max(elapsed, 1e-9)
+        clean_rate = stats['cleaned'] / max(stats['clean_time'], 1e-9)
+        print(f"URLs: {stats['urls']}. Time: {elapsed}\n"
+              f"\tfetch: {stats['fetched'] / elapsed} pages/s, "
+              f"{stats['fetched_bytes'] / elapsed / 1e6} MB/s\n"
+              f"\tclean ({self.parser}): {stats['cleaned'] / elapsed} pages/s, "
+              f"{clean_rate} pages/s per cleaner\n"
+              f"\twaiting for cleaners: {stats['wait_time']} s\n"
+              f"\tencodings: {dict(stats['encodings'].most_common(5))}")
+
+    async def process(self, session, link):
+        code, page, content_type = await self.fetch(session, link)
+        self.stats['urls'] += 1
+        if self.interval > 0 and self.stats['urls'] % self.interval == 0:
+            self.report(time.time() - self.start)
+        if code > 0:
+            self.log.write(CODE_FILES[code], link)
+            return
+        self.stats['fetched'] += 1
+        self.stats['fetched_bytes'] += len(page)
+
+        txt = await self.clean(page, content_type)
+        if not txt:
+            print('Empty page', link)
+            self.log.write('empty', link)
+            return
+
+        print(self.log.idx, link)
+        self.log.write_page(link, txt)
+
+    async def resolves(self, link):
+        """ Wait for the host of link to be resolved without blocking
+        the other requests. Return False if it doesn't resolve.
+        """
+        host = get_host(link)
+        if not host:
+            return True
+        try:
+            await asyncio.wrap_future(self.dns.prefetch(host))
+        except socket.gaierror:
+            return False
+        except Exception:
+            pass
+        return True
+
+    async def worker(self, session, queue):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                start, link = item
+                if self.dns is not None and not await self.resolves(link):
+                    self.log.write('bad', link)
+                    print("Host doesn't resolve", link)
+                else:
+                    await self.process(session, link)
+                self.log.finish(start)
+            finally:
+                queue.task_done()
+
+    async def put(self, queue, item, workers):
+        """ Put item in queue. If a worker fails, raise its exception
+        instead of waiting forever for the workers to take the item.
+        """
+        put = asyncio.ensure_future(queue.put(item))
+        try:
+            while not put.done():
+                running = [task for task in workers if not task.done()]
+                await asyncio.wait([put] + running,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in workers:
+                    if task.done() and not task.cancelled() and \
+                            task.exception() is not None:
+                        raise task.exception()
+        finally:
+            put.cancel()
+
+    async def crawl(self, links):
+        """ Crawl all the URLs in links, an iterable of (start, end, link)
+        as returned by read_links.
+        If a worker fails, stop the other workers and raise its exception.
+        """
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.pending = asyncio.Semaphore(self.max_pending)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        if self.dns is not None:
+            # the DNSCache has its own ttl
+            connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                             limit_per_host=0,
+                                             resolver=CacheResolver(self.dns),
+                                             use_dns_cache=False)
+        else:
+            connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                             limit_per_host=0)
+        async with aiohttp.ClientSession(timeout=timeout,
+                                         connector=connector) as session:
+            workers = [asyncio.create_task(self.worker(session, queue))
+                       for _ in range(self.concurrency)]
+            try:
+                for start, end, link in links:
+                    if self.log.skip_link(start):
+                        continue
+                    self.log.start(start, end)
+                    if not link:
+                        self.log.finish(start)
+                        continue
+                    if self.url_filter.to_skip(link):
+                        self.log.write('skip', link)
+                        print('Skip', link)
+                        self.log.finish(start)
+                        continue
+                    await self.put(queue, (start, link), workers)
+                for _ in workers:
+                    await self.put(queue, None, workers)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    def run(self, link_file, log=None):
+        """ Crawl all the URLs in link_file.
+        Continue from where it left off if folder already has a checkpoint
+        or an index file.
+        log: if set, the CrawlLog to write to instead of one in folder.
+        """
+        if log is None:
+            log = CrawlLog(self.folder,
+                           link_file,
+                           self.checkpoint_interval,
+                           get_page_writer(self.folder, self.shard_size))
+        self.log = log
+        links = self.log.open()
+        if self.clean_workers:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.clean_workers)
+        link_iter = read_links(links)
+        if self.dns_ttl:
+            self.dns = DNSCache(self.resolver, self.dns_ttl,
+                                min(60, self.dns_ttl))
+            if self.prefetch:
+                link_iter = prefetch_links(link_iter, self.dns, self.prefetch,
+                                           self.url_filter, wait=False)
+        self.start = time.time()
+        try:
+            asyncio.run(self.crawl(link_iter))
+        finally:
+            links.close()
+            self.log.close()
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+            if self.dns is not None:
+                self.dns.close()
+        self.report(time.time() - self.start)
+        if self.health is not None:
+            self.health.report()
+        if self.dns is not None:
+            self.dns.report()
+        print(f'Downloaded {self.log.idx} pages.')
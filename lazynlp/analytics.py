@@ -1,27 +1,156 @@
+from collections import Counter
+import functools
+import hashlib
+import heapq
+import itertools
+import multiprocessing
 import os
 import random
-import statistics
+import shutil
+import tempfile
 import time
 
+import numpy as np
 from pybloom import BloomFilter
 
+from .bloom import *
 from .cleaner import *
+from .dedup import *
 from .utils import *
 
 
 def build_ngram_from_tokens(tokens, n):
     """ Create a dictionary of n-gram from the list of tokens
+    If there are fewer than n tokens, the only n-gram is all the tokens.
     """
-    count = {}
-    curr = tokens[:n]
-    count[' '.join(curr)] = 1
-    for token in tokens[n:]:
-        curr = curr[1:] + [token]
-        string = ' '.join(curr)
-        if string not in count:
-            count[string] = 0
-        count[string] += 1
-    return count
+    if len(tokens) <= n:
+        return {' '.join(tokens): 1}
+    return Counter(map(' '.join, zip(*[tokens[i:] for i in range(n)])))
+
+
+# multiplier of the polynomial rolling hash, an odd 64-bit constant
+HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+
+
+class NgramHasher:
+    """ Hash the n-grams of a list of tokens into 64-bit integers
+    without building the n-gram strings.
+
+    Each distinct token is hashed once with blake2b and cached, so that
+    hashes are the same across runs and processes. The hash of the n-gram
+    starting at position j is the polynomial
+        t[j] * B^(n-1) + t[j+1] * B^(n-2) + ... + t[j+n-1]  (mod 2^64)
+    computed for all positions of a batch of lines at once with n vectorized
+    numpy operations. Use hash_lines on many lines at a time.
+
+    Like build_ngram_from_tokens, if there are fewer than n tokens,
+    the only n-gram is all the tokens.
+    """
+
+    def __init__(self, n, max_vocab=2**22):
+        self.n = n
+        self.max_vocab = max_vocab
+        self.vocab = {}
+
+    def token_hash(self, token):
+        digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def token_ids(self, tokens):
+        """ Return a numpy array of the hashes of tokens
+        """
+        vocab = self.vocab
+        try:
+            ids = [vocab[token] for token in tokens]
+        except KeyError:
+            if len(vocab) + len(tokens) > self.max_vocab:
+                vocab.clear()
+            for token in tokens:
+                if token not in vocab:
+                    vocab[token] = self.token_hash(token)
+            ids = [vocab[token] for token in tokens]
+        return np.array(ids, dtype=np.uint64)
+
+    def rolling_hash(self, ids, n):
+        windows = len(ids) - n + 1
+        hashes = np.zeros(windows, dtype=np.uint64)
+        for i in range(n):
+            hashes *= HASH_BASE
+            hashes += ids[i:i + windows]
+        return hashes
+
+    def hash(self, tokens):
+        """ Return a numpy array of the hashes of the n-grams of tokens
+        """
+        return self.rolling_hash(self.token_ids(tokens),
+                                 min(self.n, len(tokens)))
+
+    def hash_lines(self, lines):
+        """ Return a list of numpy arrays of the hashes of the n-grams
+        of each list of tokens in lines.
+        The n-grams of all lines are hashed together, then the ones
+        that cross two lines are dropped.
+        """
+        n = self.n
+        lengths = np.array([len(tokens) for tokens in lines], dtype=np.int64)
+        ids = self.token_ids([token for tokens in lines for token in tokens])
+        ends = np.cumsum(lengths)
+        if len(ids) < n:
+            return [self.hash(tokens) for tokens in lines]
+
+        hashes = self.rolling_hash(ids, n)
+        # n-grams of line k start in [ends[k] - lengths[k], ends[k] - n]
+        keep = np.zeros(len(hashes) + n, dtype=np.int64)
+        long_lines = lengths >= n
+        np.add.at(keep, ends[long_lines] - lengths[long_lines], 1)
+        np.add.at(keep, ends[long_lines] - n + 1, -1)
+        keep = np.cumsum(keep)[:len(hashes)] > 0
+        counts = np.where(long_lines, lengths - n + 1, 0)
+        result = np.split(hashes[keep], np.cumsum(counts)[:-1])
+        for k in np.flatnonzero(~long_lines):
+            result[k] = self.hash(lines[k])
+        return result
+
+
+def hash_lines(hasher, lines, batch_size=4096):
+    """ Yield (tokens, hashes of the n-grams) for each list of tokens
+    in lines, hashing batch_size lines at a time.
+    """
+    lines = iter(lines)
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield from zip(batch, hasher.hash_lines(batch))
+
+
+def unique_per_line(line_hashes):
+    """ Concatenate the arrays of hashes in line_hashes,
+    removing the hashes repeated within the same line.
+    """
+    if not line_hashes:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.concatenate(line_hashes)
+    lines = np.repeat(np.arange(len(line_hashes)),
+                      [len(h) for h in line_hashes])
+    order = np.lexsort((hashes, lines))
+    hashes, lines = hashes[order], lines[order]
+    keep = np.ones(len(hashes), dtype=bool)
+    keep[1:] = (hashes[1:] != hashes[:-1]) | (lines[1:] != lines[:-1])
+    return hashes[keep]
+
+
+def tokenize(line, gran='word', uncase=True, alphanumeric=True):
+    """ Split line into the tokens used for n-grams
+    """
+    if uncase:
+        line = line.lower()
+    if gran == 'word':
+        if alphanumeric:
+            line = remove_non_alphanumeric(line)
+    else:
+        line = remove_non_alpha(line)
+    return line.split()
 
 
 def build_ngram(file,
@@ -31,62 +160,85 @@ def build_ngram(file,
                 n=10,
                 uncase=True,
                 alphanumeric=True,
-                interval=100000):
+                interval=100000,
+                hashed=False):
     """
+    file: path to the file, or a store.Document
     gran: granularity of the token. It can be 'word' or 'char'
     bf: BloomFilter to update the existence of n-grams. 
         Use when the file is too large to store a dictionary count
+        With hashed, n-grams are added in batches if bf has add_many,
+        like MmapBloomFilter.
     alphanumeric: whether to keep only alphanumeric characters and space.
     outfile: if outfile is specified, build dictionary of n-grams and 
              write it to outfile
     interval: how often to report the progress.
+    hashed: if True, add n-grams to bf as 64-bit hashes from NgramHasher
+            instead of strings, and without outfile, also return them as
+            hashes. Faster, as no n-gram string is built.
+            n-grams written to outfile are always strings.
+
+    The counts are kept in memory. For files too large for that,
+    use count_ngrams.
     """
     if gran not in set(['word', 'char']):
         raise ValueError("gran has to be 'word' or 'char'")
-    count = {}
-    f = open(file, 'r')
+    count = Counter()
+    # with a bloom filter, counts are only needed to write outfile
+    keep_count = bool(outfile) or bf is None
     i = 1
-    line = f.readline()
     start = time.time()
+    hasher = NgramHasher(n) if hashed else None
+    add_many = hashed and hasattr(bf, 'add_many')
+    batch, batch_size = [], 0
 
     # read line by line in case file too big to read all lines at once
-    while line:
-        line = line.strip()
-        if line:
-            if uncase:
-                line = line.lower()
-
-            if gran == 'word':
-                if alphanumeric:
-                    line = remove_non_alphanumeric(line)
-            else:
-                line = remove_non_alpha(line)
-            line = collapse_white_spaces(line)
-            tokens = line.split()
+    lines = (tokenize(line, gran, uncase, alphanumeric)
+             for line in map(str.strip, read_lines(file)) if line)
+    if hasher is None:
+        lines = ((tokens, None) for tokens in lines)
+    else:
+        lines = hash_lines(hasher, lines)
+
+    for tokens, hashes in lines:
+        if hasher is None:
             line_count = build_ngram_from_tokens(tokens, n)
+            keys = line_count
+        else:
+            keys = hashes.tolist()
+            if outfile:
+                line_count = build_ngram_from_tokens(tokens, n)
+            elif keep_count:
+                line_count = Counter(keys)
 
+        if keep_count:
             count.update(line_count)
 
-            if bf is not None:
-                for key in line_count:
-                    bf.add(key)
+        if add_many:
+            batch.append(hashes)
+            batch_size += len(hashes)
+            if batch_size >= 2**16:
+                bf.add_many(np.concatenate(batch))
+                batch, batch_size = [], 0
+        elif bf is not None:
+            for key in keys:
+                bf.add(key)
 
-            if interval > 0 and i % interval == 0:
-                print(f'Process line: {i}. Time: {time.time() - start}')
-                start = time.time()
+        if interval > 0 and i % interval == 0:
+            print(f'Process line: {i}. Time: {time.time() - start}')
+            start = time.time()
 
-            i += 1
+        i += 1
 
-        line = f.readline()
-
-    f.close()
+    if batch:
+        bf.add_many(np.concatenate(batch))
 
     if outfile:
         outfold = outfile[:outfile.rfind('/')]
         os.makedirs(outfold, exist_ok=True)
         dict_sorted_2_file(count, os.path.join(outfile.format(n)))
 
-    if bf:
+    if bf is not None:
         return bf
 
     return count
@@ -108,8 +260,8 @@ def build_word_ngram(file,
                        outfile=outfile,
                        n=n,
                        gran='word',
+                       uncase=norm,
                        alphanumeric=alphanumeric,
-                       norm=norm,
                        interval=interval)
 
 
@@ -124,6 +276,171 @@ def build_char_ngram(file, outfile, n=10, interval=100000):
                        interval=interval)
 
 
+# rough number of bytes taken by an n-gram and its count in a Counter
+NGRAM_ENTRY_SIZE = 200
+
+
+def write_count_run(items, tmp_dir):
+    """ Write (n-gram, count) items to a new file in tmp_dir, in order
+    """
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        for ngram, count in items:
+            f.write(f'{ngram}\t{count}\n')
+    return path
+
+
+def read_count_run(path):
+    with open(path, 'r') as f:
+        for line in f:
+            ngram, count = line.rstrip('\n').rsplit('\t', 1)
+            yield ngram, int(count)
+
+
+def merge_counts(runs):
+    """ Merge runs sorted by n-gram, summing the counts of each n-gram
+    """
+    items = heapq.merge(*[read_count_run(run) for run in runs],
+                        key=lambda item: item[0])
+    for ngram, group in itertools.groupby(items, key=lambda item: item[0]):
+        yield ngram, sum(count for _, count in group)
+
+
+def count_order(item):
+    """ Most frequent n-grams first, then in alphabetical order
+    """
+    return -item[1], item[0]
+
+
+def merge_by_count(runs):
+    return heapq.merge(*[read_count_run(run) for run in runs], key=count_order)
+
+
+def reduce_runs(runs, tmp_dir, merge, max_runs=256):
+    """ Merge runs max_runs at a time until there are at most max_runs left,
+    so that the final merge doesn't open too many files at once.
+    """
+    while len(runs) > max_runs:
+        merged = []
+        for i in range(0, len(runs), max_runs):
+            group = runs[i:i + max_runs]
+            merged.append(write_count_run(merge(group), tmp_dir))
+            for run in group:
+                os.remove(run)
+        runs = merged
+    return runs
+
+
+def count_ngrams_part(args):
+    """ Count the n-grams of files, writing the counts to a new run
+    sorted by n-gram each time there are max_entries distinct n-grams.
+    Return the runs. Take a tuple of arguments to be used with a process pool.
+    """
+    files, gran, n, uncase, alphanumeric, header, max_entries, tmp_dir = args
+    count = Counter()
+    runs = []
+    for file in files:
+        lines = itertools.islice(read_lines(file), header, None)
+        for line in map(str.strip, lines):
+            if not line:
+                continue
+            tokens = tokenize(line, gran, uncase, alphanumeric)
+            if not tokens:
+                continue
+            count.update(build_ngram_from_tokens(tokens, n))
+            if len(count) >= max_entries:
+                runs.append(write_count_run(sorted(count.items()), tmp_dir))
+                count = Counter()
+    if count:
+        runs.append(write_count_run(sorted(count.items()), tmp_dir))
+    return runs
+
+
+def count_ngrams(files,
+                 outfile,
+                 gran='word',
+                 n=10,
+                 uncase=True,
+                 alphanumeric=True,
+                 header=0,
+                 max_memory=2**30,
+                 workers=None,
+                 top_k=None,
+                 by_count=True,
+                 tmp_dir=None):
+    """ Count the n-grams of files exactly and write them to outfile in
+    the same format as build_ngram:
+        [n-gram][tab][count]
+    Memory stays under about max_memory bytes however many n-grams there are.
+
+    1. workers processes each count the n-grams of part of the files,
+       writing the counts to sorted runs in tmp_dir whenever they
+       reach their share of max_memory.
+    2. The runs are merged, summing the counts of each n-gram.
+    3. If by_count, the counts are sorted from the most frequent n-gram,
+       with another external sort. Otherwise, they're written in
+       alphabetical order of n-grams.
+
+    top_k: if set, only write the top_k most frequent n-grams. They're kept
+           in a heap while merging, so no full sort is needed.
+    header: number of lines of each file to skip, e.g. 1 for the url.
+
+    Return the number of n-grams written to outfile: the number of
+    distinct n-grams, or with top_k, at most top_k.
+    """
+    if gran not in set(['word', 'char']):
+        raise ValueError("gran has to be 'word' or 'char'")
+    if isinstance(files, str):
+        files = [files]
+    workers = workers or os.cpu_count()
+    parts = max(min(workers, len(files)), 1)
+    max_entries = max(max_memory // (NGRAM_ENTRY_SIZE * parts), 1)
+    tmp_dir = tempfile.mkdtemp(dir=tmp_dir)
+    tasks = [(files[i::parts], gran, n, uncase, alphanumeric, header,
+              max_entries, tmp_dir) for i in range(parts)]
+
+    start = time.time()
+    try:
+        if parts > 1:
+            with multiprocessing.Pool(parts) as pool:
+                runs = [run for part_runs in pool.imap_unordered(
+                    count_ngrams_part, tasks) for run in part_runs]
+        else:
+            runs = count_ngrams_part(tasks[0])
+        print(f'Counted {len(files)} files into {len(runs)} runs. '
+              f'Time: {time.time() - start}')
+
+        runs = reduce_runs(runs, tmp_dir, merge_counts)
+        items = merge_counts(runs)
+        if top_k is not None:
+            items = heapq.nsmallest(top_k, items, key=count_order)
+        elif by_count:
+            items_runs = []
+            while True:
+                chunk = list(itertools.islice(items, max_entries * parts))
+                if not chunk:
+                    break
+                chunk.sort(key=count_order)
+                items_runs.append(write_count_run(chunk, tmp_dir))
+            for run in runs:
+                os.remove(run)
+            runs = reduce_runs(items_runs, tmp_dir, merge_by_count)
+            items = merge_by_count(runs)
+
+        outfold = os.path.dirname(outfile)
+        if outfold:
+            os.makedirs(outfold, exist_ok=True)
+        total = 0
+        with open(outfile, 'w') as out:
+            for ngram, count in items:
+                out.write(f'{ngram}\t{count}\n')
+                total += 1
+    finally:
+        shutil.rmtree(tmp_dir)
+    print(f'Wrote {total} n-grams to {outfile}. Time: {time.time() - start}')
+    return total
+
+
 def estimate_overlap(source_files,
                      target_files,
                      gran='word',
@@ -131,12 +448,20 @@ def estimate_overlap(source_files,
                      capacity=100000,
                      error_rate=1e-5,
                      header=0,
-                     interval=100000):
+                     interval=100000,
+                     hashed=False,
+                     bf_file=None,
+                     workers=None):
     """ Estimate overlapping of target_files with source_files using n-grams
 
     gran: granularity of the token. It can be 'word' or 'char'
     header: number of lines of each file to skip. It's because in our format,
             the first line is the url
+    hashed: use 64-bit n-gram hashes instead of strings, see build_ngram
+    bf_file: if set, keep the n-grams of source_files in an MmapBloomFilter
+             saved in bf_file. If bf_file already exists, source_files are
+             added to it, so only new source files need to be passed.
+    workers: if set, use workers processes, see estimate_overlap_parallel
     """
     if gran not in set(['word', 'char']):
         raise ValueError("gran has to be 'word' or 'char'")
@@ -144,8 +469,22 @@ def estimate_overlap(source_files,
         source_files = [source_files]
     if isinstance(target_files, str):
         target_files = [target_files]
+    if workers:
+        return estimate_overlap_parallel(source_files,
+                                         target_files,
+                                         gran=gran,
+                                         n=n,
+                                         capacity=capacity,
+                                         error_rate=error_rate,
+                                         header=header,
+                                         hashed=hashed,
+                                         bf_file=bf_file,
+                                         workers=workers)
 
-    bf = BloomFilter(capacity=capacity, error_rate=error_rate)
+    if bf_file:
+        bf = MmapBloomFilter.open_or_create(bf_file, capacity, error_rate)
+    else:
+        bf = BloomFilter(capacity=capacity, error_rate=error_rate)
     for source_file in source_files:
         bf = build_ngram(file=source_file,
                          bf=bf,
@@ -153,7 +492,8 @@ def estimate_overlap(source_files,
                          n=n,
                          uncase=True,
                          alphanumeric=True,
-                         interval=interval)
+                         interval=interval,
+                         hashed=hashed)
 
     results = []
     for file in target_files:
@@ -161,72 +501,574 @@ def estimate_overlap(source_files,
         results.append(estimate_overlap_bf(bf,
                                            file,
                                            gran=gran,
-                                           n=8,
-                                           header=header))
+                                           n=n,
+                                           header=header,
+                                           hashed=hashed))
+    if bf_file:
+        bf.close()
     return results
 
 
-def estimate_overlap_bf(bf, target_file, gran='word', n=8, header=0):
+def estimate_overlap_bf(bf,
+                        target_file,
+                        gran='word',
+                        n=8,
+                        header=0,
+                        hashed=False):
     """ Estimate overlapping of target_file with an existing bloomfilter
     gran: granularity of the token. It can be 'word' or 'char'
+    hashed: whether bf contains 64-bit n-gram hashes, see build_ngram.
+            If bf has contains_many, like MmapBloomFilter, n-grams are
+            checked in batches.
     """
     if gran not in set(['word', 'char']):
         raise ValueError("gran has to be 'word' or 'char'")
+    seen, total = count_overlap_bf(bf, target_file, gran, n, header, hashed)
+    result = seen / total
+    print('{} seen out of {}: {}'.format(seen, total, result))
+    return result
 
-    f = open(target_file, 'r')
-    for _ in range(header + 1):
-        line = f.readline()
 
-    total, seen = 0, 0
-    while line:
-        line = line.strip().lower()
+def count_overlap_bf(bf,
+                     target_file,
+                     gran='word',
+                     n=8,
+                     header=0,
+                     hashed=False):
+    """ Return the number of n-grams of target_file found in bf and the
+    total number of n-grams, counting each n-gram once per line
+    """
+    if hashed and hasattr(bf, 'contains_many'):
+        return count_overlap_bf_many(bf, target_file, gran, n, header)
 
-        if gran == 'word':
-            line = remove_non_alphanumeric(line)
+    lines = (tokenize(line.strip(), gran) for line in
+             itertools.islice(read_lines(target_file), header, None))
+    if hashed:
+        lines = hash_lines(NgramHasher(n), lines)
+    else:
+        lines = ((tokens, None) for tokens in lines)
+
+    total, seen = 0, 0
+    for tokens, hashes in lines:
+        if hashes is None:
+            line_count = build_ngram_from_tokens(tokens, n)
         else:
-            line = remove_non_alpha(line)
-        line = collapse_white_spaces(line)
-        tokens = line.split()
-        line_count = build_ngram_from_tokens(tokens, n)
+            line_count = dict.fromkeys(hashes.tolist())
 
         for key in line_count:
             if key in bf:
                 seen += 1
             total += 1
+    return seen, total
 
-        line = f.readline()
 
-    result = seen / total
-    print('{} seen out of {}: {}'.format(seen, total, result))
-    return result
+def count_overlap_bf_many(bf, target_file, gran='word', n=8, header=0,
+                          batch_size=4096):
+    """ Same as count_overlap_bf with hashed=True, but checking the
+    n-grams of batch_size lines at a time with bf.contains_many
+    """
+    lines = (tokenize(line.strip(), gran) for line in
+             itertools.islice(read_lines(target_file), header, None))
+    hasher = NgramHasher(n)
+    total, seen = 0, 0
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            break
+        hashes = unique_per_line(hasher.hash_lines(batch))
+        seen += int(bf.contains_many(hashes).sum())
+        total += len(hashes)
+    return seen, total
 
 
-def file_stats(file):
-    """ Return statistics about line lengths and average character per words
+def build_bf_part(args):
+    """ Build an MmapBloomFilter in path with the n-grams of source_files.
+    Take a tuple of arguments to be used with a process pool.
     """
-    line_lengths, token_lengths = [], []
-    with open(file, 'r') as f:
-        line = f.readline()
-        while line:
-            tokens = line.split()
-            line_lengths.append(len(tokens))
-            line_token_lengths = [len(token) for token in tokens]
-            token_lengths.append([len(tokens),
-                                  sum(line_token_lengths) / len(tokens)])
-            line = f.readline()
+    source_files, path, capacity, error_rate, gran, n, hashed = args
+    bf = MmapBloomFilter.create(path, capacity, error_rate)
+    for source_file in source_files:
+        build_ngram(file=source_file,
+                    bf=bf,
+                    gran=gran,
+                    n=n,
+                    interval=0,
+                    hashed=hashed)
+    bf.close()
+    return path
 
-    total_tokens = sum([pair[0] for pair in token_lengths])
-    total_chars = sum([pair[0] * pair[1] for pair in token_lengths])
-    average_chars = total_chars / total_tokens
+
+def get_file_overlap(args):
+    """ Return (seen, total) for target_file against the filter in bf_file,
+    opened read-only so that all processes share its pages.
+    Take a tuple of arguments to be used with a process pool.
+    """
+    bf_file, target_file, gran, n, header, hashed = args
+    bf = MmapBloomFilter.open(bf_file, readonly=True)
+    try:
+        return count_overlap_bf(bf, target_file, gran, n, header, hashed)
+    finally:
+        bf.close()
+
+
+def estimate_overlap_parallel(source_files,
+                              target_files,
+                              gran='word',
+                              n=8,
+                              capacity=100000,
+                              error_rate=1e-5,
+                              header=0,
+                              hashed=False,
+                              bf_file=None,
+                              workers=None):
+    """ Same as estimate_overlap, using workers processes.
+
+    Each worker builds a filter of part of source_files, and the filters
+    are merged into one MmapBloomFilter by OR-ing their bits. It's saved in
+    bf_file, or a temporary file removed at the end. Then target files are
+    scored by the workers, which all map the same filter read-only.
+    Progress is reported per target file instead of per line.
+    """
+    workers = workers or os.cpu_count()
+    tmp_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(bf_file)) if bf_file else None)
+    path = bf_file or os.path.join(tmp_dir, 'ngrams.bloom')
+    bf = MmapBloomFilter.open_or_create(path, capacity, error_rate)
+    capacity, error_rate = bf.capacity, bf.error_rate
+    parts = min(workers, len(source_files))
+    tasks = [(source_files[i::parts],
+              os.path.join(tmp_dir, f'part{i}.bloom'),
+              capacity,
+              error_rate,
+              gran,
+              n,
+              hashed) for i in range(parts)]
+
+    start = time.time()
+    results = []
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for part_file in pool.imap_unordered(build_bf_part, tasks):
+                part = MmapBloomFilter.open(part_file, readonly=True)
+                bf.update(part)
+                part.close()
+                os.remove(part_file)
+            bf.flush()
+            print(f'Built filter of {len(source_files)} files. '
+                  f'Time: {time.time() - start}')
+
+            tasks = [(path, file, gran, n, header, hashed)
+                     for file in target_files]
+            seen, total = 0, 0
+            report = max(len(target_files) // 100, 1)
+            for i, counts in enumerate(pool.imap(get_file_overlap, tasks), 1):
+                results.append(counts[0] / counts[1])
+                seen, total = seen + counts[0], total + counts[1]
+                if i % report == 0 or i == len(target_files):
+                    print(f'{i} / {len(target_files)} files. '
+                          f'{seen} seen out of {total}: {seen / total}. '
+                          f'Time: {time.time() - start}')
+    finally:
+        bf.close()
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def get_ngram_hashes(file, gran='word', n=8, header=0, hasher=None):
+    """ Return the sorted unique 64-bit hashes of the n-grams of file,
+    skipping the first header lines and empty lines.
+    """
+    hasher = hasher or NgramHasher(n)
+    lines = (tokenize(line.strip(), gran) for line in
+             itertools.islice(read_lines(file), header, None))
+    hashes = [line_hashes for tokens, line_hashes
+              in hash_lines(hasher, (tokens for tokens in lines if tokens))]
+    if not hashes:
+        return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate(hashes))
+
+
+MINHASH_SEED = 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_minhash_params(num_perm, seed=MINHASH_SEED):
+    """ Return the multipliers (odd) and increments of the num_perm hash
+    functions h(x) = a * x + b (mod 2^64) used for MinHash signatures.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**64, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**64, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def get_minhash(hashes, num_perm=128, batch_size=4096):
+    """ Return the MinHash signature of a set of 64-bit hashes: for each of
+    num_perm hash functions, the min of the function over the set.
+    The fraction of equal values between the signatures of two sets
+    estimates their Jaccard similarity.
+    """
+    a, b = get_minhash_params(num_perm)
+    signature = np.full(num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for i in range(0, len(hashes), batch_size):
+        batch = hashes[i:i + batch_size, None] * a + b
+        signature = np.minimum(signature, batch.min(axis=0))
+    return signature
+
+
+def get_minhash_similarity(signature1, signature2):
+    """ Return the Jaccard similarity of two sets estimated from their
+    MinHash signatures: the fraction of equal values.
+    """
+    return np.count_nonzero(signature1 == signature2) / len(signature1)
+
+
+def get_file_minhash(args):
+    """ Return (file, MinHash signature of its n-grams or None if it has no
+    n-grams). Take a tuple of arguments to be used with a process pool.
+    """
+    file, gran, n, header, num_perm = args
+    hashes = get_ngram_hashes(file, gran=gran, n=n, header=header)
+    if len(hashes) == 0:
+        return file, None
+    return file, get_minhash(hashes, num_perm)
+
+
+def get_candidate_probability(similarity, bands, rows):
+    """ Return the probability that two signatures with Jaccard similarity
+    similarity share at least one of bands bands of rows values.
+    """
+    return 1 - (1 - similarity ** rows) ** bands
+
+
+def get_lsh_params(threshold, num_perm):
+    """ Return the number of bands and rows per band, with
+    bands * rows <= num_perm, such that two signatures with Jaccard
+    similarity threshold have the closest to 50% chance to share a band,
+    see get_candidate_probability.
+    """
+    pairs = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+    return min(pairs, key=lambda pair: abs(
+        get_candidate_probability(threshold, *pair) - 0.5))
+
+
+class MinHashLSH:
+    """ Locality-sensitive hashing index of MinHash signatures.
+    Each signature is split into bands of rows values. Signatures that
+    share all the values of any band are candidates, and a candidate
+    matches if its estimated Jaccard similarity is at least threshold,
+    see get_minhash_similarity. So pairs below threshold are never
+    matched, and pairs above it are matched more often the more similar
+    they are.
+
+    The signatures are kept, num_perm * 8 bytes each, plus an entry in
+    a dict of buckets for each band.
+    """
+
+    def __init__(self, threshold=0.5, num_perm=128):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = get_lsh_params(threshold, num_perm)
+        self.buckets = {}
+        self.signatures = []
+
+    def band_keys(self, signature):
+        keys = []
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows]
+            keys.append(hashlib.blake2b(values.tobytes(),
+                                        digest_size=8,
+                                        salt=band.to_bytes(8, 'little'))
+                        .digest())
+        return keys
+
+    def query(self, signature):
+        """ Return True if a signature in the index that shares a band
+        with signature has an estimated Jaccard similarity with it of at
+        least threshold.
+        """
+        checked = set()
+        for key in self.band_keys(signature):
+            for i in self.buckets.get(key, ()):
+                if i in checked:
+                    continue
+                checked.add(i)
+                if get_minhash_similarity(
+                        signature, self.signatures[i]) >= self.threshold:
+                    return True
+        return False
+
+    def insert(self, signature):
+        i = len(self.signatures)
+        self.signatures.append(signature)
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, []).append(i)
+
+
+class TextStats:
+    """ Streaming statistics of the number of words per line and characters
+    per word. Memory doesn't grow with the number of lines: the mean and
+    variance are updated online (Welford's algorithm), and the median comes
+    from a histogram of line lengths, which has one entry per distinct
+    length. Stats of different files can be merged with update.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.histogram = Counter()
+        self.total_tokens = 0
+        self.total_chars = 0
+
+    def add_line(self, line):
+        tokens = line.split()
+        if not tokens:
+            return
+        length = len(tokens)
+        self.lines += 1
+        delta = length - self.mean
+        self.mean += delta / self.lines
+        self.m2 += delta * (length - self.mean)
+        self.histogram[length] += 1
+        self.total_tokens += length
+        self.total_chars += sum(map(len, tokens))
+
+    def update(self, other):
+        """ Merge the stats of other into these stats
+        """
+        if not other.lines:
+            return
+        lines = self.lines + other.lines
+        delta = other.mean - self.mean
+        self.mean += delta * other.lines / lines
+        self.m2 += other.m2 + delta ** 2 * self.lines * other.lines / lines
+        self.lines = lines
+        self.histogram.update(other.histogram)
+        self.total_tokens += other.total_tokens
+        self.total_chars += other.total_chars
+
+    def min_length(self):
+        return min(self.histogram) if self.histogram else 0
+
+    def max_length(self):
+        return max(self.histogram) if self.histogram else 0
+
+    def stdev(self):
+        """ Sample standard deviation, like statistics.stdev
+        """
+        if self.lines < 2:
+            return 0.0
+        return (self.m2 / (self.lines - 1)) ** 0.5
+
+    def percentile(self, q):
+        """ Return the smallest line length such that at least q percent of
+        lines are at most that long
+        """
+        rank = max(q / 100 * self.lines, 1)
+        seen = 0
+        for length in sorted(self.histogram):
+            seen += self.histogram[length]
+            if seen >= rank:
+                return length
+        return 0
+
+    def median(self):
+        """ Median line length, like statistics.median
+        """
+        if not self.lines:
+            return 0
+        middle = [(self.lines - 1) // 2, self.lines // 2]
+        values, seen = [], 0
+        for length in sorted(self.histogram):
+            seen += self.histogram[length]
+            while middle and middle[0] < seen:
+                values.append(length)
+                middle.pop(0)
+            if not middle:
+                break
+        return sum(values) / 2 if self.lines % 2 == 0 else values[0]
+
+    def average_chars(self):
+        if not self.total_tokens:
+            return 0
+        return self.total_chars / self.total_tokens
+
+
+def get_text_stats(file):
+    """ Return the TextStats of file, a path or a store.Document
+    """
+    stats = TextStats()
+    for line in read_lines(file):
+        stats.add_line(line)
+    return stats
+
+
+def file_stats(file, workers=None):
+    """ Return statistics about line lengths and average character per words.
+    Empty lines are skipped.
+
+    file: a path or store.Document, or a list of them. With workers,
+          the files are read by workers processes and their stats merged.
+    """
+    files = [file] if isinstance(file, str) or hasattr(file, 'lines') \
+        else file
+    stats = TextStats()
+    if workers and workers > 1 and len(files) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            for part in pool.imap_unordered(get_text_stats, files):
+                stats.update(part)
+    else:
+        for file in files:
+            stats.update(get_text_stats(file))
+
+    average_chars = stats.average_chars()
     print(f'Character per word: average = {average_chars}.')
     print(f'Word count per line:'
-          f'\n\taverage = {statistics.mean(line_lengths)},'
-          f'\n\tmedian = {statistics.median(line_lengths)},'
-          f'\n\tmax = {max(line_lengths)},'
-          f'\n\tmin = {min(line_lengths)},'
-          f'\n\tstddev = {statistics.stdev(line_lengths)}.')
-    return statistics.mean(line_lengths), average_chars
+          f'\n\taverage = {stats.mean},'
+          f'\n\tmedian = {stats.median()},'
+          f'\n\tmax = {stats.max_length()},'
+          f'\n\tmin = {stats.min_length()},'
+          f'\n\tstddev = {stats.stdev()}.')
+    return stats.mean, average_chars
+
+
+class EntropyCounter:
+    """ Hashed counts of the k-grams of a text for k = 1..max_n, in bounded
+    memory: the k-grams are hashed with NgramHasher into width buckets per
+    order, whatever the number of distinct k-grams. k-grams that fall in the
+    same bucket are counted together, so entropies are underestimated once
+    the number of distinct k-grams gets close to width.
+    Counts of different files can be merged with update.
 
+    With gran='char', the tokens are characters and each line is a string.
+    """
+
+    def __init__(self, max_n=10, width=2**20, gran='word'):
+        self.max_n = max_n
+        self.width = width
+        self.gran = gran
+        self.counts = np.zeros((max_n, width), dtype=np.int64)
+        self.hasher = NgramHasher(1)
+
+    def add_lines(self, lines):
+        """ Count the k-grams of a batch of lines, each a list of tokens,
+        or a string with gran='char'. k-grams don't cross lines.
+        """
+        lengths = np.array([len(tokens) for tokens in lines], dtype=np.int64)
+        if self.gran == 'char':
+            codes = np.frombuffer(''.join(lines).encode('utf-32-le'),
+                                  dtype=np.uint32)
+            ids = splitmix64(codes.astype(np.uint64))
+        else:
+            ids = self.hasher.token_ids([token for tokens in lines
+                                         for token in tokens])
+        # number of tokens from each position to the end of its line
+        ends = np.repeat(np.cumsum(lengths), lengths)
+        remaining = ends - np.arange(len(ids))
+
+        hashes = np.zeros(len(ids), dtype=np.uint64)
+        width = np.uint64(self.width)
+        for k in range(1, min(self.max_n, len(ids)) + 1):
+            with np.errstate(over='ignore'):
+                hashes = hashes[:len(ids) - k + 1] * HASH_BASE + ids[k - 1:]
+            valid = hashes[remaining[:len(hashes)] >= k]
+            buckets = (splitmix64(valid) % width).astype(np.int64)
+            self.counts[k - 1] += np.bincount(buckets, minlength=self.width)
+
+    def update(self, other):
+        self.counts += other.counts
+
+    def entropies(self):
+        """ Return the list of entropies in bits of the k-grams
+        for k = 1..max_n
+        """
+        result = []
+        for counts in self.counts:
+            counts = counts[counts > 0].astype(np.float64)
+            total = counts.sum()
+            if not total:
+                result.append(0.0)
+                continue
+            result.append(float(np.log2(total) -
+                                (counts * np.log2(counts)).sum() / total))
+        return result
+
+    def conditional_entropies(self):
+        """ Return the list of entropies in bits of a token given
+        the k - 1 tokens before it, for k = 1..max_n:
+            H(X_k | X_1 .. X_k-1) = H(X_1 .. X_k) - H(X_1 .. X_k-1)
+        """
+        entropies = self.entropies()
+        return [h - prev for h, prev in zip(entropies, [0.0] + entropies)]
+
+    def __getstate__(self):
+        # the hasher's vocabulary doesn't need to go between processes
+        state = self.__dict__.copy()
+        state['hasher'] = NgramHasher(1)
+        return state
+
+
+def get_entropy_counter(args):
+    """ Return the EntropyCounter of files.
+    Take a tuple of arguments to be used with a process pool.
+    """
+    files, gran, max_n, width, uncase, header, batch_size = args
+    counter = EntropyCounter(max_n, width, gran)
+    for file in files:
+        lines = itertools.islice(read_lines(file), header, None)
+        lines = (tokenize(line.strip(), gran, uncase) for line in lines)
+        if gran == 'char':
+            lines = (' '.join(tokens) for tokens in lines)
+        lines = (tokens for tokens in lines if tokens)
+        while True:
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                break
+            counter.add_lines(batch)
+    return counter
+
+
+def estimate_entropy(file,
+                     gran='word',
+                     max_n=10,
+                     width=2**20,
+                     uncase=True,
+                     header=0,
+                     workers=None,
+                     batch_size=4096):
+    """ Estimate the entropy of the text in file for each order k = 1..max_n,
+    in one pass and in bounded memory, see EntropyCounter.
+
+    file: a path or store.Document, or a list of them. With workers,
+          the files are split between workers processes and their
+          counts merged.
+    gran: 'word' to use words as tokens, tokenized like build_ngram,
+          or 'char' to use characters, including the spaces between words.
+    width: number of hashed counters per order, each taking 8 bytes.
+    header: number of lines of each file to skip, e.g. 1 for the url.
+
+    Return the list of conditional entropies in bits per token of each order,
+    i.e. the entropy of a token given the k - 1 tokens before it.
+    """
+    if gran not in set(['word', 'char']):
+        raise ValueError("gran has to be 'word' or 'char'")
+    files = [file] if isinstance(file, str) or hasattr(file, 'lines') \
+        else file
+    parts = max(min(workers or 1, len(files)), 1)
+    tasks = [(files[i::parts], gran, max_n, width, uncase, header, batch_size)
+             for i in range(parts)]
+    if parts > 1:
+        counter = EntropyCounter(max_n, width, gran)
+        with multiprocessing.Pool(parts) as pool:
+            for part in pool.imap_unordered(get_entropy_counter, tasks):
+                counter.update(part)
+    else:
+        counter = get_entropy_counter(tasks[0])
 
-def estimate_entropy(file, gran='word', max_n=10):
-    pass
+    entropies = counter.entropies()
+    conditional = counter.conditional_entropies()
+    for k in range(max_n):
+        print(f'{k + 1}-gram: entropy = {entropies[k]}, '
+              f'conditional entropy = {conditional[k]}')
+    return conditional
@@ -0,0 +1,172 @@
+import hashlib
+import math
+import os
+import struct
+
+import numpy as np
+
+BLOOM_MAGIC = b'LZBLOOM1'
+
+# magic, number of bits, number of hash functions, count, capacity,
+# error rate, padded so the bits start at a page-friendly offset
+BLOOM_HEADER = struct.Struct('<8sQIQQd')
+BLOOM_HEADER_SIZE = 4096
+
+MASK64 = 2**64 - 1
+
+
+def splitmix64(x):
+    """ Mix a 64-bit integer. Works on Python ints and numpy uint64 arrays.
+    """
+    if isinstance(x, np.ndarray):
+        with np.errstate(over='ignore'):
+            z = x + np.uint64(0x9E3779B97F4A7C15)
+            z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            return z ^ (z >> np.uint64(31))
+    z = (x + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def key_to_int(key):
+    """ Keys are either 64-bit integers, such as the n-gram hashes of
+    NgramHasher, or strings, which are hashed into 64-bit integers.
+    """
+    if isinstance(key, int):
+        return key & MASK64
+    if isinstance(key, str):
+        key = key.encode()
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class MmapBloomFilter:
+    """ Bloom filter whose bits live in a memory-mapped file, so that it
+    can be saved and reopened instantly, extended with new n-grams across
+    runs, and shared read-only by many processes through the page cache.
+
+    Same interface as pybloom.BloomFilter (add, in, len), plus add_many and
+    contains_many that take numpy arrays of 64-bit hashes.
+
+    Use MmapBloomFilter.create to make a new filter and MmapBloomFilter.open
+    to open an existing one. Opening with readonly=True maps the file
+    read-only. A filter has to be queried with the same kind of keys it was
+    built with: strings, or hashes from NgramHasher (hashed=True).
+
+    File format: a header of BLOOM_HEADER_SIZE bytes, then the bits.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        with open(path, 'rb') as f:
+            header = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+        (magic, self.num_bits, self.num_hashes, self.count, self.capacity,
+         self.error_rate) = header
+        if magic != BLOOM_MAGIC:
+            raise ValueError(f"{path} isn't a lazynlp Bloom filter")
+        self.bits = np.memmap(path,
+                              dtype=np.uint8,
+                              mode='r' if readonly else 'r+',
+                              offset=BLOOM_HEADER_SIZE,
+                              shape=(self.num_bits // 8,))
+
+    @classmethod
+    def create(cls, path, capacity=100000000, error_rate=1e-7):
+        """ Create an empty filter in path that can hold capacity keys
+        with a false positive rate of error_rate.
+        """
+        num_bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        num_bits = int(math.ceil(num_bits / 64)) * 64
+        num_hashes = max(int(round(num_bits / capacity * math.log(2))), 1)
+        with open(path, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, num_bits, num_hashes, 0,
+                                      capacity, error_rate))
+            f.truncate(BLOOM_HEADER_SIZE + num_bits // 8)
+        return cls(path)
+
+    @classmethod
+    def open(cls, path, readonly=False):
+        return cls(path, readonly=readonly)
+
+    @classmethod
+    def open_or_create(cls, path, capacity=100000000, error_rate=1e-7):
+        if os.path.exists(path):
+            return cls.open(path)
+        return cls.create(path, capacity, error_rate)
+
+    def __len__(self):
+        """ Number of keys added, counting keys added more than once
+        """
+        return self.count
+
+    def positions(self, key):
+        h1 = splitmix64(key_to_int(key))
+        h2 = splitmix64(h1) | 1
+        return [((h1 + i * h2) & MASK64) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(key))
+
+    def positions_many(self, hashes):
+        """ Return an array of shape (len(hashes), num_hashes) of the bit
+        positions of each hash
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        h1 = splitmix64(hashes)
+        h2 = splitmix64(h1) | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            positions = h1[:, None] + steps * h2[:, None]
+        return positions % np.uint64(self.num_bits)
+
+    def add_many(self, hashes):
+        """ Add an array of 64-bit hashes
+        """
+        positions = self.positions_many(hashes).ravel()
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+        self.count += len(hashes)
+
+    def contains_many(self, hashes):
+        """ Return a boolean array of whether each hash may be in the filter
+        """
+        positions = self.positions_many(hashes)
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        found = self.bits[positions >> np.uint64(3)] & masks
+        return found.all(axis=1)
+
+    def update(self, other, chunk_size=2**26):
+        """ Add all the keys of other, a filter with the same number of
+        bits and hash functions, by OR-ing its bits chunk by chunk.
+        """
+        if (self.num_bits, self.num_hashes) != (other.num_bits,
+                                                other.num_hashes):
+            raise ValueError('Bloom filters have different sizes')
+        for i in range(0, len(self.bits), chunk_size):
+            chunk = self.bits[i:i + chunk_size]
+            np.bitwise_or(chunk, other.bits[i:i + chunk_size], out=chunk)
+        self.count += other.count
+
+    def flush(self):
+        if self.readonly:
+            return
+        self.bits.flush()
+        with open(self.path, 'r+b') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.num_bits,
+                                      self.num_hashes, self.count,
+                                      self.capacity, self.error_rate))
+
+    def close(self):
+        self.flush()
+        del self.bits
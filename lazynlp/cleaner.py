@@ -1,23 +1,54 @@
 from collections import Counter
+import codecs
+import functools
 import lxml
+import lxml.etree
+import lxml.html
+import numpy as np
 import os
 import string
 import re
+import time
 
 import html
 import justext
 from unidecode import unidecode
 
+from .dedup import *
 from .utils import *
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+STYLE_TAG_RE = re.compile('<style.*?>[^<>]*?</style>')
+SCRIPT_TAG_RE = re.compile('<script.*?>[^<>]*?</script>')
+DOC_TAG_RE = re.compile('<!DOCTYPE[^<>]*?>')
+HTML_TAG_RE = re.compile('<.*?>')
+NON_ALPHANUMERIC_RE = re.compile(r'[^a-zA-Z0-9 ]+')
+NON_ALPHA_RE = re.compile(r'[^a-zA-Z ]+')
+WHITE_SPACES_RE = re.compile(' {2,}')
+PRINTABLE = frozenset(string.printable)
+PRINTABLE_BYTES = string.printable.encode()
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([-\w.:]+)',
+                             re.I)
+XML_DECLARATION_RE = re.compile(r'^\s*<\?xml[^>]*\?>')
+# IS_PRINTABLE[c] for each ASCII code c
+IS_PRINTABLE = np.zeros(128, dtype=bool)
+IS_PRINTABLE[list(PRINTABLE_BYTES)] = True
+
+
+@functools.lru_cache(maxsize=None)
+def get_stoplist(language='English'):
+    """ Load the justext stoplist of language once per process
+    """
+    return frozenset(justext.get_stoplist(language))
 
-def parse_html(page):
-    """ Clean HTML tags for webpages that aren't Gutenberg books
+
+def parse_html_justext(page):
+    """ Extract the paragraphs that aren't boilerplate with justext
     """
     try:
-        parts = justext.justext(page, justext.get_stoplist('English'))
+        parts = justext.justext(page, get_stoplist('English'))
     except lxml.etree.ParserError as e:
         print('Page empty')
         return ''
@@ -31,31 +62,212 @@ def parse_html(page):
     return '\n\n'.join(paragraphs)
 
 
+# tags whose text is never content
+SKIP_TAGS = set(['script', 'style', 'noscript', 'head', 'nav', 'header',
+                 'footer', 'aside', 'form', 'button', 'select', 'iframe',
+                 'svg', 'template'])
+
+# tags that start a new paragraph
+BLOCK_TAGS = set(['p', 'div', 'section', 'article', 'main', 'blockquote',
+                  'pre', 'li', 'ul', 'ol', 'dl', 'dd', 'dt', 'table', 'tr',
+                  'td', 'th', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr',
+                  'figcaption', 'body'])
+
+
+def get_paragraphs(doc):
+    """ Split the text of an lxml document into paragraphs at block tags,
+    without the text of SKIP_TAGS. Yield (text, number of characters
+    in links) for each paragraph.
+    """
+    chunks, link_chars, in_link = [], 0, 0
+    walker = lxml.etree.iterwalk(doc,
+                                 events=('start', 'end', 'comment', 'pi'))
+    for event, el in walker:
+        tag = el.tag.lower() if isinstance(el.tag, str) else None
+        if event in ('comment', 'pi'):
+            # only the text after a comment or processing instruction
+            if el.tail:
+                chunks.append(el.tail)
+                if in_link:
+                    link_chars += len(el.tail)
+        elif event == 'start':
+            if tag is None or tag in SKIP_TAGS:
+                walker.skip_subtree()
+                continue
+            if tag in BLOCK_TAGS and chunks:
+                yield ''.join(chunks), link_chars
+                chunks, link_chars = [], 0
+            if tag == 'a':
+                in_link += 1
+            if el.text:
+                chunks.append(el.text)
+                if in_link:
+                    link_chars += len(el.text)
+        else:
+            if tag == 'a':
+                in_link -= 1
+            elif tag in BLOCK_TAGS and chunks:
+                yield ''.join(chunks), link_chars
+                chunks, link_chars = [], 0
+            if el.tail:
+                chunks.append(el.tail)
+                if in_link:
+                    link_chars += len(el.tail)
+    if chunks:
+        yield ''.join(chunks), link_chars
+
+
+def parse_html_density(page,
+                       min_length=80,
+                       max_link_density=0.3,
+                       min_stopword_density=0.2):
+    """ Extract the paragraphs with a lot of text with lxml.
+    Faster than justext, which classifies paragraphs using their context.
+
+    A paragraph is kept if it has at least min_length characters,
+    at most max_link_density of them in links, and at least
+    min_stopword_density of its words in the English stoplist.
+    """
+    try:
+        doc = lxml.html.document_fromstring(page)
+    except (lxml.etree.ParserError, ValueError) as e:
+        print('Page empty')
+        return ''
+    stoplist = get_stoplist('English')
+    paragraphs = []
+    for text, link_chars in get_paragraphs(doc):
+        words = text.split()
+        text = ' '.join(words)
+        if len(text) < min_length or link_chars > max_link_density * len(text):
+            continue
+        stopwords = sum(1 for word in words if word.lower() in stoplist)
+        if stopwords >= min_stopword_density * len(words):
+            paragraphs.append(text)
+    return '\n\n'.join(paragraphs)
+
+
+PARSERS = {'justext': parse_html_justext, 'density': parse_html_density}
+
+
+def parse_html(page, parser='justext'):
+    """ Clean HTML tags for webpages that aren't Gutenberg books
+
+    parser: name of the extractor in PARSERS, or a function that takes
+        the page and returns its text.
+        'justext': justext, which classifies paragraphs as boilerplate
+            using their length, links, stopwords and neighbors.
+        'density': parse_html_density, faster but less accurate.
+    """
+    if not callable(parser):
+        if parser not in PARSERS:
+            raise ValueError(f'parser has to be one of {list(PARSERS)}')
+        parser = PARSERS[parser]
+    return parser(page)
+
+
+def is_text_page(page,
+                 content_type=None,
+                 min_size=0,
+                 max_size=2**24,
+                 max_tag_density=0.1,
+                 sample_size=2**16):
+    """ Cheap check to reject pages that obviously have no text
+    before parsing them:
+        - content_type, if known, isn't text or HTML
+        - the page has fewer than min_size or more than max_size bytes
+        - the start of the page has a null byte, i.e. it's binary
+        - more than max_tag_density of the first sample_size characters
+          start a tag, i.e. it's almost all markup
+    """
+    if content_type:
+        content_type = content_type.lower()
+        if 'html' not in content_type and 'text' not in content_type:
+            return False
+    if not min_size <= len(page) <= max_size:
+        return False
+    sample = page[:sample_size]
+    if isinstance(sample, bytes):
+        if b'\x00' in sample:
+            return False
+        tags = sample.count(b'<')
+    else:
+        if '\x00' in sample:
+            return False
+        tags = sample.count('<')
+    return tags <= max_tag_density * len(sample)
+
+
+def benchmark_parsers(pages, parsers=None):
+    """ Clean pages, a list of pages as downloaded, with each parser
+    and print its throughput, so you can choose between speed and quality.
+    Return a dict of parser: pages per second.
+    """
+    results = {}
+    for parser in parsers or list(PARSERS):
+        start = time.time()
+        texts = [clean_page(page, parser=parser) for page in pages]
+        elapsed = max(time.time() - start, 1e-9)
+        results[parser] = len(pages) / elapsed
+        chars = sum(len(txt) for txt in texts)
+        kept = sum(1 for txt in texts if txt)
+        print(f'{parser}: {results[parser]} pages/s, '
+              f'{kept} non-empty pages, {chars} characters')
+    return results
+
+
+class HTMLCleaner:
+    """ Clean HTML tags of Gutenberg-style pages in a fixed number of
+    linear passes, with the patterns compiled once:
+        1. remove the <style>, <script> and <!DOCTYPE> blocks, skipping
+           the pass when the text has no such tag.
+        2. connect the lines, see connect_lines, building the result in
+           a list instead of concatenating strings.
+        3. replace the remaining tags with a space.
+    Tags are removed after connecting the lines, so tags broken across
+    lines are removed too.
+
+    collapse: also collapse multiple white spaces into one in the last pass.
+    """
+
+    def __init__(self, line_sep='\n', collapse=False):
+        self.line_sep = line_sep
+        self.collapse = collapse
+        self.blocks = [('<style', STYLE_TAG_RE),
+                       ('<script', SCRIPT_TAG_RE),
+                       ('<!DOCTYPE', DOC_TAG_RE)]
+
+    def __call__(self, txt):
+        for tag, pattern in self.blocks:
+            if tag in txt:
+                txt = pattern.sub(' ', txt)
+        txt = connect_lines(txt, self.line_sep)
+        if '<' in txt:
+            txt = HTML_TAG_RE.sub(' ', txt)
+        if self.collapse:
+            txt = collapse_white_spaces(txt)
+        return txt.strip()
+
+
+html_cleaner = HTMLCleaner()
+
+
 def clean_html(txt):
     """ Clean HTML tags of webpages downloaded
     Use this function for Gutenberg book format.
     """
-    style_tag_re = re.compile('<style.*?>[^<>]*?</style>')
-    txt = re.sub(style_tag_re, ' ', txt)
-    script_tag_re = re.compile('<script.*?>[^<>]*?</script>')
-    txt = re.sub(script_tag_re, ' ', txt)
-    doc_tag_re = re.compile('<!DOCTYPE[^<>]*?>')
-    txt = re.sub(doc_tag_re, ' ', txt)
-    html_tag_re = re.compile('<.*?>')
-    txt = connect_lines(txt)
-    return re.sub(html_tag_re, ' ', txt).strip()
+    return html_cleaner(txt)
 
 
 def remove_non_alphanumeric(txt):
     """ Remove all non-alphanumeric characters, except space, from the text
     """
-    return re.sub(r'[^a-zA-Z0-9 ]+', '', txt)
+    return NON_ALPHANUMERIC_RE.sub('', txt)
 
 
 def remove_non_alpha(txt):
     """ Remove all non-alphabetical characters, except space, from the text
     """
-    return re.sub(r'[^a-zA-Z ]+', '', txt)
+    return NON_ALPHA_RE.sub('', txt)
 
 
 def transliterate(txt):
@@ -68,15 +280,7 @@ def transliterate(txt):
 def collapse_white_spaces(txt):
     """Collapse multiple white spaces into one white space
     """
-    clean_txt = ''
-    prev = None
-    for c in txt:
-        if c == ' ' and prev == ' ':
-            continue
-        else:
-            clean_txt += c
-        prev = c
-    return clean_txt
+    return WHITE_SPACES_RE.sub(' ', txt)
 
 
 def connect_lines(txt, line_sep='\n'):
@@ -87,34 +291,107 @@ def connect_lines(txt, line_sep='\n'):
 
     Two consecutive lines are separated by line_sep.
     """
-    lines = txt.split('\n')
-
-    result, curr = '', ''
-    for line in lines:
+    result, curr = [], []
+    for line in txt.split('\n'):
         line = line.strip()
         if not line:
             if curr:
-                result += (curr + '\n')
-            result += line_sep
-            curr = ''
+                result.append(' '.join(curr))
+                result.append(' \n')
+                curr = []
+            result.append(line_sep)
         else:
-            curr += (line + ' ')
-
-    return result + curr
-
-
-def clean_page(page):
+            curr.append(line)
+    if curr:
+        result.append(' '.join(curr))
+        result.append(' ')
+    return ''.join(result)
+
+
+def normalize_encoding(name):
+    """ Return the Python name of the encoding, or None if it's unknown.
+    Like browsers, treat latin-1 and ASCII as windows-1252, their superset,
+    and UTF-16 and UTF-32 as utf-8, as pages declared so in a header or
+    in ASCII <meta> tags aren't in them. Only a byte order mark is
+    trusted for UTF-16, see get_declared_encoding.
+    """
     try:
-        page = page.decode('utf-8')
-    except UnicodeDecodeError as e:
-        print("Can't decode", e)
-
-    page = page.strip()
-    if not page:
-        return ''
-    txt = parse_html(page)
-    txt = transliterate(txt)
-    txt = html.unescape(txt)
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    if name in set(['latin-1', 'iso8859-1', 'ascii']):
+        return 'cp1252'
+    if name.startswith(('utf-16', 'utf-32')):
+        return 'utf-8'
+    return name
+
+
+def get_declared_encoding(page, content_type=None, sniff_size=4096):
+    """ Return the encoding of page given by, in order, its byte order mark,
+    the charset of content_type, or a <meta> tag in the first sniff_size
+    bytes. Return None if none of them gives a known encoding.
+    """
+    if page.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if page.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if content_type:
+        match = CHARSET_RE.search(content_type)
+        if match and normalize_encoding(match.group(1)):
+            return normalize_encoding(match.group(1))
+    match = META_CHARSET_RE.search(page[:sniff_size])
+    if match:
+        return normalize_encoding(match.group(1).decode('ascii'))
+    return None
+
+
+def decode_page(page, content_type=None):
+    """ Decode the bytes of a page into text.
+    Return the text and the encoding used.
+
+    Try the encoding declared by the page, see get_declared_encoding,
+    then utf-8, then windows-1252, and if none of them can decode the page,
+    utf-8 replacing the bad bytes. The text is decoded once when the
+    first encoding tried is right.
+    """
+    declared = get_declared_encoding(page, content_type)
+    encodings = [declared] if declared else []
+    encodings += [e for e in ['utf-8', 'cp1252'] if e != declared]
+    for encoding in encodings:
+        try:
+            return page.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    return page.decode('utf-8', errors='replace'), 'utf-8'
+
+
+def clean_page(page,
+               parser='justext',
+               prefilter=False,
+               content_type=None,
+               with_encoding=False):
+    """ Extract the text of a page as downloaded.
+
+    parser: see parse_html.
+    prefilter: if True, return '' for pages rejected by is_text_page
+        without parsing them.
+    content_type: Content-Type header of the page, if known,
+        used by the prefilter and to decode the page, see decode_page.
+    with_encoding: if True, return the text and the encoding
+        the page was decoded with.
+    """
+    encoding = None
+    if prefilter and not is_text_page(page, content_type):
+        txt = ''
+    else:
+        if isinstance(page, bytes):
+            page, encoding = decode_page(page, content_type)
+        # the page is text now, so its XML encoding declaration is obsolete
+        page = XML_DECLARATION_RE.sub('', page, count=1).strip()
+        txt = parse_html(page, parser) if page else ''
+        txt = html.unescape(transliterate(txt))
+    if with_encoding:
+        return txt, encoding
     return txt
 
 
@@ -122,22 +399,92 @@ def find_unprintable(txt):
     """Find the list of unprintable character
     and return a Counter of them
     """
-    printable = set(string.printable)
-    unprintable = [c for c in txt if c not in printable]
-    return Counter(unprintable)
+    if txt.isascii():
+        # only control characters can be unprintable, look at the bytes
+        return Counter(txt.encode().translate(None, PRINTABLE_BYTES).decode())
+    # surrogatepass for lone surrogates, as in text decoded with
+    # surrogateescape
+    codes = np.frombuffer(txt.encode('utf-32-le', 'surrogatepass'),
+                          dtype=np.uint32)
+    unprintable = codes[codes >= 128]
+    ascii_codes = codes[codes < 128]
+    unprintable = np.concatenate([unprintable,
+                                  ascii_codes[~IS_PRINTABLE[ascii_codes]]])
+    chars, counts = np.unique(unprintable, return_counts=True)
+    return Counter({chr(c): int(count) for c, count in zip(chars, counts)})
+
+
+@functools.lru_cache(maxsize=None)
+def get_unprintable_table():
+    """ Return the str.translate table of the unprintable characters
+    in unprintable_chars.txt to their replacement
+    """
+    table = {}
+    with open(f'{dir_path}/unprintable_chars.txt', 'r') as f:
+        for line in f:
+            parts = line.strip().split(':')
+            if len(parts[0]) == 1 and parts[0] not in PRINTABLE:
+                table[ord(parts[0])] = parts[1]
+    return table
+
+
+@functools.lru_cache(maxsize=2**16)
+def transliterate_char(c):
+    """ Printable transliteration of c, possibly empty
+    """
+    if '\ud800' <= c <= '\udfff':
+        # a lone surrogate, e.g. an undecodable byte, is no character
+        return ''
+    return ''.join(ch for ch in unidecode(c) if ch in PRINTABLE)
 
 
-def replace_unprintable(txt):
+def replace_unprintable(txt, unknown='transliterate', max_replace=64):
     """Replace non-printable characters with printable characters
+
+    Characters in unprintable_chars.txt are replaced with their replacement.
+    unknown: what to do with the other unprintable characters.
+        'transliterate': replace them with their transliteration
+            by unidecode, removing them if there is none.
+        'remove': remove them.
+        'keep': keep them.
+        'raise': raise a ValueError.
+
+    The unprintable characters of txt are found with find_unprintable,
+    then replaced with one str.replace each, which is much faster than
+    str.translate on non-ASCII text, or one str.translate if there are
+    more than max_replace of them.
     """
-    printable = set(string.printable)
-    lines = open(f'{dir_path}/unprintable_chars.txt', 'r').readlines()
-    chars = {line.strip().split(':')[0]:
-             line.strip().split(':')[1] for line in lines}
-    return ''.join([c if c in printable else chars[c] for c in txt])
+    if unknown not in set(['transliterate', 'remove', 'keep', 'raise']):
+        raise ValueError(
+            "unknown has to be 'transliterate', 'remove', 'keep' or 'raise'")
+    chars = find_unprintable(txt)
+    if not chars:
+        return txt
+    known = get_unprintable_table()
+    table = {}
+    for c in chars:
+        if ord(c) in known:
+            table[ord(c)] = known[ord(c)]
+        elif unknown == 'transliterate':
+            table[ord(c)] = transliterate_char(c)
+        elif unknown == 'remove':
+            table[ord(c)] = None
+        elif unknown == 'raise':
+            raise ValueError(f'No replacement for {repr(c)}')
+    if len(table) > max_replace:
+        return txt.translate(table)
+    for code, replacement in table.items():
+        txt = txt.replace(chr(code), replacement or '')
+    return txt
 
 
-def dedup_lines(files, outfold):
+def dedup_lines(files,
+                outfold,
+                backend='set',
+                bits=128,
+                max_memory=None,
+                tmp_dir=None,
+                workers=None):
     """
     Files is a list of files
     Remove all duplicated lines across all files
@@ -148,30 +495,58 @@ def dedup_lines(files, outfold):
         remove lines that have appeared in files[:n-1] and also in files[n]
         and save to outfold/files[n]
 
+    backend: how to store the fingerprints of the lines seen so far.
+        'set': a Python set. Exact, but ~100 bytes per line.
+        'table': a FingerprintSet, 8 or 16 bytes per slot depending on bits.
+            Exact with bits=128, approximate with bits=64.
+            About as fast as 'set'. The table is sized from a count of the
+            lines before writing anything: if it needs more than max_memory
+            bytes, fall back to 'disk'.
+        'disk': external sort in tmp_dir, see dedup_lines_external.
+            Exact, and uses about max_memory bytes (default 1GB).
+    All exact backends produce the same output.
+
+    workers: if set, dedup with workers processes, each owning a partition
+        of the fingerprints, see dedup_lines_parallel. backend is ignored.
     """
     os.makedirs(outfold, exist_ok=True)
-    seen = set()
     total, unique = 0, 0
 
     if isinstance(files, str):
         files = [files]
 
+    outfiles = [os.path.join(outfold, str(i) + '_' + get_filename(file))
+                for i, file in enumerate(files)]
+    if backend == 'table' and not workers:
+        fits, lines = fits_in_table(files, bits, max_memory)
+        if not fits:
+            print(f'Dedup table for {lines} lines needs more than '
+                  f'{max_memory} bytes, falling back to disk')
+            backend = 'disk'
+    if workers:
+        print(f'Dedup backend: parallel with {workers} workers (exact)')
+        unique, total = dedup_lines_parallel(files,
+                                             outfiles,
+                                             workers,
+                                             tmp_dir=tmp_dir)
+        files = []
+    elif backend == 'disk':
+        print('Dedup backend: disk (exact)')
+        unique, total = dedup_lines_external(files,
+                                             outfiles,
+                                             max_memory or 2**30,
+                                             tmp_dir)
+        files = []
+    elif backend == 'table':
+        seen = get_seen_set(backend, bits, max_memory, lines)
+    else:
+        seen = get_seen_set(backend, bits, max_memory)
+
     for i, file in enumerate(files):
         print('Processing:', file)
-        filename = get_filename(file)
-        out = open(os.path.join(outfold, str(i) + '_' + filename), 'w')
-        f_in = open(file, 'r')
-        line = f_in.readline()
-        while line:
-            hashed = get_hash(line.strip())
-            if hashed not in seen:
-                out.write(line)
-                seen.add(hashed)
-                unique += 1
-            total += 1
-            line = f_in.readline()
-        f_in.close()
-        out.close()
+        file_unique, file_total = dedup_file(seen, file, outfiles[i])
+        unique += file_unique
+        total += file_total
     if total == 0:
         raise ValueError('The files list seems to be empty')
     print(
@@ -182,32 +557,51 @@ def dedup_lines(files, outfold):
             total))
 
 
-def dedup_lines_from_new_file(original_files, new_file, outfile):
+def dedup_lines_from_new_file(original_files,
+                              new_file,
+                              outfile,
+                              backend='set',
+                              bits=128,
+                              max_memory=None,
+                              tmp_dir=None,
+                              workers=None):
     """ Get unique lines from new_file that aren't already in original_files
+    See dedup_lines for backend, bits, max_memory, tmp_dir and workers.
     """
-    seen = set()
-
     if isinstance(original_files, str):
         original_files = [original_files]
 
-    for original_file in original_files:
-        with open(original_file, 'r') as f_in:
-            line = f_in.readline()
-            while line:
-                seen.add(get_hash(line.strip()))
-                line = f_in.readline()
+    files = original_files + [new_file]
+    if backend == 'table' and not workers:
+        fits, lines = fits_in_table(files, bits, max_memory)
+        if not fits:
+            print(f'Dedup table for {lines} lines needs more than '
+                  f'{max_memory} bytes, falling back to disk')
+            backend = 'disk'
+
+    if workers or backend == 'disk':
+        outfiles = [None] * len(original_files) + [outfile]
+        if workers:
+            print(f'Dedup backend: parallel with {workers} workers (exact)')
+            unique, total = dedup_lines_parallel(files,
+                                                 outfiles,
+                                                 workers,
+                                                 tmp_dir=tmp_dir)
+        else:
+            print('Dedup backend: disk (exact)')
+            unique, total = dedup_lines_external(files,
+                                                 outfiles,
+                                                 max_memory or 2**30,
+                                                 tmp_dir)
+        print(f'{unique} unique lines out of {total}: {unique / total}')
+        return
+
+    if backend == 'table':
+        seen = get_seen_set(backend, bits, max_memory, lines)
+    else:
+        seen = get_seen_set(backend, bits, max_memory)
 
-    out = open(outfile, 'w')
-    total, unique = 0, 0
-    with open(new_file, 'r') as f_in:
-        line = f_in.readline()
-        while line:
-            hashed = get_hash(line.strip())
-            if hashed not in seen:
-                out.write(line)
-                seen.add(hashed)
-                unique += 1
-            total += 1
-            line = f_in.readline()
-    out.close()
+    for original_file in original_files:
+        dedup_file(seen, original_file)
+    unique, total = dedup_file(seen, new_file, outfile)
     print(f'{unique} unique lines out of {total}: {unique / total}')
@@ -1,55 +1,218 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import glob
 import hashlib
 import html
 import http
+import json
 import os
 import re
 import socket
 import ssl
+import threading
 import time
+import urllib.parse
 import urllib.request
 
 import requests
 import tldextract
+import urllib3
 
 from .cleaner import *
+from .resolver import *
+from .store import *
 from .utils import *
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+GUTENBERG_URL = 'http://www.gutenberg.org'
 
-def exists(url):
-    request = requests.get(url)
-    return request.status_code == 200
+
+def exists(url, session=None, timeout=None):
+    """ Return True if url returns status 200.
+    With a session, only send a HEAD request through the session's
+    connection pool instead of downloading the whole page.
+    """
+    if session is None:
+        request = requests.get(url)
+        return request.status_code == 200
+
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    if response.status_code == 405:
+        # HEAD not allowed, GET the headers without reading the body
+        with session.get(url, stream=True, timeout=timeout) as response:
+            return response.status_code == 200
+    return response.status_code == 200
 
 
-def get_gutenberg_link_from_id(book_id):
-    txt_tmpl1 = 'http://www.gutenberg.org/cache/epub/{}/pg{}.txt'
-    txt_tmpl2 = 'http://www.gutenberg.org/files/{}/{}.txt'
+def get_gutenberg_link_from_id(book_id,
+                               session=None,
+                               base_url=GUTENBERG_URL,
+                               timeout=None):
+    txt_tmpl1 = base_url + '/cache/epub/{}/pg{}.txt'
+    txt_tmpl2 = base_url + '/files/{}/{}.txt'
 
     for tmpl in [txt_tmpl1, txt_tmpl2]:
         link = tmpl.format(book_id, book_id)
-        if exists(link):
+        if exists(link, session, timeout):
             return link
 
-    txt_tmpl3 = 'http://www.gutenberg.org/files/{}/{}-{}.txt'
+    txt_tmpl3 = base_url + '/files/{}/{}-{}.txt'
     # idx = [0, 8] + list(range(1, 8)) + list(range(9, 15))
     for i in [0, 8]:
         link = txt_tmpl3.format(book_id, book_id, i)
-        if exists(link):
+        if exists(link, session, timeout):
             return link
     return None
 
 
-def get_us_gutenberg_links(outfile, max_id=58910):
-    out = open(outfile, 'w')
-    for book_id in range(1, max_id + 1):
-        link = get_gutenberg_link_from_id(book_id)
-        if link:
-            out.write(link + '\n')
-        else:
-            print("Can't find link for book id", book_id)
-    out.close()
+def read_gutenberg_cache(cache_file):
+    """ Return a dictionary mapping each book id in cache_file to its link,
+    or '' if the book has no link.
+    A last line cut short by an interrupted run is skipped.
+    """
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                book_id, tab, link = line[:-1].partition('\t')
+                if book_id.isdigit() and tab:
+                    cache[int(book_id)] = link
+    return cache
+
+
+def remove_partial_line(path):
+    """ Cut the last line of path if it doesn't end with a newline,
+    so that lines can be appended to it.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+class ContextAdapter(requests.adapters.HTTPAdapter):
+    """ HTTPAdapter whose HTTPS connections use the SSL context given,
+    so that the context is created once and reused for all connections.
+    """
+
+    def __init__(self, context=None, **kwargs):
+        self.context = context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.context is not None:
+            kwargs['ssl_context'] = self.context
+        return super().init_poolmanager(*args, **kwargs)
+
+
+def get_session(pool_size=10, context=None, hosts=100):
+    """ Return a requests session that keeps up to pool_size
+    connections open per host, for the hosts most recently used.
+    Connections are kept alive between requests to the same host.
+
+    context: SSL context of the HTTPS connections, e.g. get_ssl_context().
+    """
+    session = requests.Session()
+    adapter = ContextAdapter(context=context,
+                             pool_connections=max(hosts, pool_size),
+                             pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if context is not None and context.verify_mode == ssl.CERT_NONE:
+        session.verify = False
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return session
+
+
+def find_gutenberg_links(book_ids,
+                         cache_file,
+                         workers=32,
+                         base_url=GUTENBERG_URL,
+                         timeout=30):
+    """ Find the links of book_ids with workers threads sending HEAD requests.
+
+    Each result is appended to cache_file as [book_id][tab][link] as soon as
+    it's found, with an empty link if the book has none, so an interrupted
+    run continues where it left off and reruns only probe new ids.
+    Books that fail because of connection errors aren't cached.
+
+    Return a dictionary mapping each book id to its link or ''.
+    """
+    cache = read_gutenberg_cache(cache_file)
+    todo = [book_id for book_id in book_ids if book_id not in cache]
+    print(f'{len(cache)} cached. Probing {len(todo)} book ids.')
+
+    session = get_session(workers)
+    start = time.time()
+    remove_partial_line(cache_file)
+    with open(cache_file, 'a') as out, \
+            concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(get_gutenberg_link_from_id,
+                                   book_id,
+                                   session,
+                                   base_url,
+                                   timeout): book_id for book_id in todo}
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            book_id = futures[future]
+            try:
+                link = future.result() or ''
+            except requests.exceptions.RequestException as e:
+                print('Error for book id', book_id, e)
+                continue
+            cache[book_id] = link
+            out.write(f'{book_id}\t{link}\n')
+            if (i + 1) % 1000 == 0:
+                out.flush()
+                print(f'Probed {i + 1} book ids. Time: {time.time() - start}')
+    session.close()
+    return cache
+
+
+def get_us_gutenberg_links(outfile,
+                           max_id=58910,
+                           workers=None,
+                           cache_file=None,
+                           base_url=GUTENBERG_URL,
+                           timeout=30):
+    """
+    Write the links to all US Gutenberg books with id up to max_id to outfile.
+
+    workers (int):
+        if set, probe workers book ids at a time with HEAD requests,
+        caching the results in cache_file (default: outfile.cache).
+        See find_gutenberg_links.
+    """
+    if not workers:
+        out = open(outfile, 'w')
+        for book_id in range(1, max_id + 1):
+            link = get_gutenberg_link_from_id(book_id, base_url=base_url)
+            if link:
+                out.write(link + '\n')
+            else:
+                print("Can't find link for book id", book_id)
+        out.close()
+        return
+
+    cache_file = cache_file or outfile + '.cache'
+    book_ids = range(1, max_id + 1)
+    links = find_gutenberg_links(book_ids,
+                                 cache_file,
+                                 workers=workers,
+                                 base_url=base_url,
+                                 timeout=timeout)
+    with open(outfile, 'w') as out:
+        for book_id in book_ids:
+            if links.get(book_id):
+                out.write(links[book_id] + '\n')
+            else:
+                print("Can't find link for book id", book_id)
 
 
 def get_id_aus(link):
@@ -83,17 +246,44 @@ def get_aus_gutenberg_links(
                 seen_ids.add(book_id)
 
 
+@functools.lru_cache(maxsize=2**20)
+def extract_domain(host):
+    """ Return (subdomain, domain, suffix) of host.
+    Cached because the same hosts come up again and again in link lists.
+    """
+    extracted = tldextract.extract(host)
+    return extracted.subdomain, extracted.domain, extracted.suffix
+
+
+def get_domain_parts(link):
+    """ Return (subdomain, domain, suffix) of the host of link
+    """
+    try:
+        host = urllib.parse.urlsplit(link).hostname
+    except ValueError:
+        host = None
+    return extract_domain(host or link)
+
+
+def get_host(link):
+    try:
+        return urllib.parse.urlsplit(link).hostname or ''
+    except ValueError:
+        return ''
+
+
 def to_skip(link, extensions=None, domains=None):
     """ domains can be:
             - just the name (as in: google)
             - main domain (as in: google.com)
             - subdomain (as in: news.google.com)
+
+    To check many links, use URLFilter instead.
     """
     for ext in extensions:
         if link.endswith(ext):
             return True
-    raw_url = get_raw_url(link)
-    subdomain, domain, suffix = tldextract.extract(link)
+    subdomain, domain, suffix = get_domain_parts(link)
     if domain in domains:
         return True
     if '.'.join([domain, suffix]) in domains:
@@ -103,7 +293,200 @@ def to_skip(link, extensions=None, domains=None):
     return False
 
 
-def download_page(link, context=None, timeout=None):
+class URLFilter:
+    """ Same as to_skip, but with the extensions and domains compiled once
+    into hash sets, so each check is a few set lookups.
+
+    Extensions are grouped by length, so that checking whether a link ends
+    with one of them is one lookup per distinct length.
+
+    If default_skip, also skip the extensions in exclude_extensions.txt
+    and the domains in exclude_domains.txt.
+    """
+
+    def __init__(self, default_skip=True, extensions=None, domains=None):
+        extensions = list(extensions or [])
+        domains = list(domains or [])
+        if default_skip:
+            extensions.extend(read_skip_file('exclude_extensions.txt'))
+            domains.extend(read_skip_file('exclude_domains.txt'))
+
+        self.extensions = {}
+        for ext in extensions:
+            if ext:
+                self.extensions.setdefault(len(ext), set()).add(ext)
+        self.ext_lengths = sorted(self.extensions)
+        self.domains = set(domains)
+
+    def to_skip(self, link):
+        for length in self.ext_lengths:
+            if link[-length:] in self.extensions[length]:
+                return True
+        subdomain, domain, suffix = get_domain_parts(link)
+        domains = self.domains
+        return (domain in domains
+                or domain + '.' + suffix in domains
+                or subdomain + '.' + domain + '.' + suffix in domains)
+
+    def __call__(self, link):
+        return self.to_skip(link)
+
+    def filter_urls(self, links):
+        """ Yield the links, stripped, that shouldn't be skipped
+        """
+        for link in links:
+            link = link.strip()
+            if not self.to_skip(link):
+                yield link
+
+
+class HostState:
+    """ What HostHealth knows about one host
+    """
+    __slots__ = ['rate', 'tokens', 'last', 'latency', 'errors', 'failures',
+                 'opened', 'probing']
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.latency = None
+        self.errors = 0.
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+
+
+class HostHealth:
+    """ Health of each host over a crawl, so that hosts that are down
+    don't take a full timeout for each of their URLs.
+
+    Circuit breaker: after max_failures connection errors or timeouts in a
+    row on a host, including hosts that refuse connections or don't
+    resolve, its circuit opens, and its URLs fail right away as
+    connection errors without being fetched. Every cooldown seconds, one
+    URL is let through to probe the host (half-open). If it succeeds, the
+    circuit closes, otherwise it stays open for another cooldown.
+
+    Rate limit: if rate is set, requests to each host go through a token
+    bucket of burst tokens, refilled at rate requests per second. The rate
+    of a host is halved on each failure, down to rate / 64, and grows back
+    by rate / 16 on each success.
+
+    Also keeps a moving average of the latency and error rate of each host,
+    see report. Only the max_hosts hosts seen last are remembered.
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_failures=3, cooldown=300, rate=None, burst=1,
+                 alpha=0.2, max_hosts=2**16):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.rate = rate
+        self.burst = burst
+        self.alpha = alpha
+        self.max_hosts = max_hosts
+        self.hosts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.fast_failed = 0
+        self.opened = 0
+
+    def get(self, host):
+        """ Return the state of host. Call with the lock held.
+        """
+        state = self.hosts.get(host)
+        if state is None:
+            state = HostState(self.rate, self.burst)
+            self.hosts[host] = state
+            if len(self.hosts) > self.max_hosts:
+                self.hosts.popitem(last=False)
+        else:
+            self.hosts.move_to_end(host)
+        return state
+
+    def allow(self, host):
+        """ Return False if the circuit of host is open and the URL
+        should fail without being fetched.
+        """
+        with self.lock:
+            state = self.get(host)
+            if state.opened is None:
+                return True
+            if not state.probing and \
+                    time.monotonic() - state.opened >= self.cooldown:
+                state.probing = True
+                return True
+            self.fast_failed += 1
+            return False
+
+    def reserve(self, host):
+        """ Take a token from the bucket of host.
+        Return the number of seconds to wait before sending the request.
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            state = self.get(host)
+            now = time.monotonic()
+            state.tokens = min(self.burst,
+                               state.tokens + (now - state.last) * state.rate)
+            state.last = now
+            state.tokens -= 1
+            if state.tokens >= 0:
+                return 0
+            return -state.tokens / state.rate
+
+    def record(self, host, failed, latency):
+        """ Learn from a request to host that took latency seconds.
+        failed: True if the request failed because the host couldn't be
+        connected to or timed out.
+        """
+        alpha = self.alpha
+        with self.lock:
+            state = self.get(host)
+            if state.latency is None:
+                state.latency = latency
+            state.latency += alpha * (latency - state.latency)
+            state.errors += alpha * (failed - state.errors)
+            state.probing = False
+
+            if not failed:
+                state.failures = 0
+                if state.opened is not None:
+                    print('Circuit closed for', host)
+                    state.opened = None
+                if self.rate:
+                    state.rate = min(self.rate, state.rate + self.rate / 16)
+                return
+
+            state.failures += 1
+            if self.rate:
+                state.rate = max(self.rate / 64, state.rate / 2)
+            if state.opened is not None:
+                state.opened = time.monotonic()
+            elif self.max_failures and state.failures >= self.max_failures:
+                print('Circuit open for', host)
+                state.opened = time.monotonic()
+                self.opened += 1
+
+    def report(self, top=5):
+        """ Print the circuits opened and the slowest hosts
+        """
+        with self.lock:
+            states = [(host, state) for host, state in self.hosts.items()
+                      if state.latency is not None]
+            open_hosts = sum(state.opened is not None
+                             for _, state in states)
+        slowest = sorted(states, key=lambda item: -item[1].latency)[:top]
+        print(f'Circuits opened: {self.opened}, open now: {open_hosts}, '
+              f'URLs failed fast: {self.fast_failed}')
+        for host, state in slowest:
+            print(f'\t{host}: {state.latency:.2f} s, '
+                  f'{state.errors:.0%} errors')
+
+
+def download_page(link, context=None, timeout=None, session=None,
+                  max_size=None):
     """
     Return code, page
     0: successfully read (write to index)
@@ -112,15 +495,36 @@ def download_page(link, context=None, timeout=None):
     3. bad_connection_urls
 
     When code is not 0, return ''
+
+    session: if set, a session from get_session to download the page with,
+        reusing the connections to the same host. Pages compressed with
+        gzip or deflate, or brotli if the brotli package is installed,
+        are decompressed.
+    max_size: if set, give up on pages larger than max_size bytes
+        (after decompression) as soon as they get larger, with code 1.
+    """
+    code, page, _ = fetch_page(link, context, timeout, session, max_size)
+    return code, page
+
+
+def fetch_page(link, context=None, timeout=None, session=None, max_size=None,
+               connect_code=1):
+    """ Same as download_page, but return code, page, content_type
+    where content_type is the Content-Type header of the page, or None.
+    connect_code: code to return instead of 1 when the host can't be
+        connected to, e.g. it refuses connections or doesn't resolve.
     """
+    if session is not None:
+        return fetch_page_session(link, session, timeout, max_size,
+                                  connect_code)
     try:
         req = urllib.request.Request(link)
     except ValueError as e:
         print(link, "doesn't exist.")
-        return 1, ''
+        return 1, '', None
     except ConnectionResetError as e:
         print('ConnectionResetError', link)
-        return 3, ''
+        return 3, '', None
 
     try:
         if timeout is not None:
@@ -130,52 +534,553 @@ def download_page(link, context=None, timeout=None):
             response = urllib.request.urlopen(req, context=context)
     except UnicodeError as e:
         print('UnicodeError for', link)
-        return 2, ''
+        return 2, '', None
     except (urllib.error.HTTPError) as e:
         print('Error {} for {}'.format(e.code, link))
-        return 1, ''
+        return 1, '', None
     except urllib.error.URLError as e:
         print('URLError for', link)
-        return 1, ''
+        return connect_code, '', None
     except http.client.HTTPException as e:
         print('HTTPException', link)
-        return 1, ''
+        return 1, '', None
     except http.client.RemoteDisconnected as e:
         print('RemoteDisconnected', link)
-        return 1, ''
+        return 1, '', None
     except (ConnectionError, socket.timeout) as e:
         print('ConnectionError or Timeout', link)
-        return 3, ''
+        return 3, '', None
 
     try:
-        page = response.read()
+        if max_size is None:
+            page = response.read()
+        else:
+            page = response.read(max_size + 1)
+            if len(page) > max_size:
+                print('Page too large', link)
+                return 1, '', None
     except http.client.HTTPException as e:
         print('HTTPException', link)
-        return 1, ''
+        return 1, '', None
     except (ConnectionError, socket.timeout) as e:
         print('ConnectionError or Timeout', link)
-        return 3, ''
-    return 0, page
+        return 3, '', None
+    finally:
+        response.close()
+    return 0, page, response.headers.get('Content-Type')
+
+
+def get_session_error_code(e, link, connect_code=1):
+    """ Return the code fetch_page gives with urllib for the error that
+    raised e, an exception of requests or a ValueError, so that both put
+    the same URLs in the same status files:
+        - errors while connecting, including timeouts, are URLErrors: 1
+        - timeouts and broken connections once connected: 3
+        - the server closing the connection or sending a bad response: 1
+    """
+    if isinstance(e, UnicodeError):
+        print('UnicodeError for', link)
+        return 2
+    if isinstance(e, ValueError):
+        # invalid URLs, some of which urllib only rejects when encoding
+        # their host to connect to it
+        try:
+            get_host(link).encode('idna')
+        except UnicodeError:
+            print('UnicodeError for', link)
+            return 2
+        print(link, "doesn't exist.")
+        return 1
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        print('ConnectionError or Timeout', link)
+        return 3
+    if isinstance(e, (requests.exceptions.ConnectionError,
+                      requests.exceptions.ChunkedEncodingError)):
+        reason = e.args[0] if e.args else None
+        if isinstance(reason, urllib3.exceptions.MaxRetryError):
+            reason = reason.reason
+        if isinstance(reason, urllib3.exceptions.ReadTimeoutError):
+            print('ConnectionError or Timeout', link)
+            return 3
+        if isinstance(reason, urllib3.exceptions.ProtocolError):
+            # the connection broke after the request was sent
+            cause = reason.args[1] if len(reason.args) > 1 else None
+            if isinstance(cause, http.client.HTTPException):
+                print('HTTPException', link)
+                return 1
+            print('ConnectionError or Timeout', link)
+            return 3
+        if isinstance(e, requests.exceptions.ConnectionError):
+            print('URLError for', link)
+            return connect_code
+    print('HTTPException', link)
+    return 1
+
+
+def fetch_page_session(link, session, timeout=None, max_size=None,
+                       connect_code=1):
+    """ fetch_page through a requests session, see download_page
+    """
+    try:
+        # pass verify explicitly, or REQUESTS_CA_BUNDLE overrides it
+        response = session.get(link,
+                               timeout=timeout,
+                               stream=True,
+                               verify=session.verify)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return get_session_error_code(e, link, connect_code), '', None
+
+    with response:
+        if response.status_code >= 400:
+            print('Error {} for {}'.format(response.status_code, link))
+            return 1, '', None
+        length = response.headers.get('Content-Length', '')
+        if max_size is not None and length.isdigit() and \
+                int(length) > max_size:
+            print('Page too large', link)
+            return 1, '', None
+
+        chunks, size = [], 0
+        try:
+            for chunk in response.iter_content(2**16):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    print('Page too large', link)
+                    return 1, '', None
+                chunks.append(chunk)
+        except requests.exceptions.RequestException as e:
+            return get_session_error_code(e, link, connect_code), '', None
+        return 0, b''.join(chunks), response.headers.get('Content-Type')
 
 
 def get_current_idx(index_file, links):
-    lines = open(index_file, 'r').readlines()
+    """ Legacy resume for folders without a checkpoint.
+    Skip links until the last URL in index_file.
+    """
+    lines = open(index_file, 'rb').readlines()
     idx = len(lines)
     if idx > 0:
         last_seen = lines[-1].strip()
         while True:
-            link = links.readline().strip()
-            if link == last_seen:
+            link = links.readline()
+            if not link or link.strip() == last_seen:
                 break
     return idx, links
 
 
+STATUS_FILES = ['index', 'skip', 'connection', 'bad', 'non_ascii', 'empty']
+
+# download_page codes to the status file the URL is logged in
+CODE_FILES = {1: 'bad', 2: 'non_ascii', 3: 'connection'}
+
+# code for hosts that can't be connected to, which are bad URLs
+# but count as failures of the host for HostHealth
+CONNECT_CODE = 4
+
+
+def read_links(links):
+    """ Yield (start, end, link) for each line of the link file opened in
+    binary mode, where [start, end) is the byte range of the line.
+    """
+    start = links.tell()
+    while True:
+        line = links.readline()
+        if not line:
+            return
+        end = links.tell()
+        yield start, end, line.decode('utf-8', errors='replace').strip()
+        start = end
+
+
+def prefetch_links(links, dns, lookahead=1000, url_filter=None, wait=True):
+    """ Yield the (start, end, link) of links, as returned by read_links,
+    after starting to resolve the hosts of the next lookahead links
+    with dns, a DNSCache. Links that url_filter skips aren't resolved.
+
+    If wait, a link is only yielded once its host is resolved, so the
+    crawler knows right away if it doesn't resolve (see DNSCache.failed)
+    without a fetcher waiting on DNS.
+    """
+    pending = collections.deque()
+
+    def next_ready(max_pending):
+        while pending and (len(pending) > max_pending
+                           or pending[0][1] is None
+                           or pending[0][1].done()):
+            item, future = pending.popleft()
+            if wait and future is not None:
+                concurrent.futures.wait([future])
+            yield item
+
+    for item in links:
+        link = item[2]
+        host = get_host(link) if link else ''
+        future = None
+        if host and (url_filter is None or not url_filter.to_skip(link)):
+            future = dns.prefetch(host)
+        pending.append((item, future))
+        yield from next_ready(lookahead)
+    yield from next_ready(0)
+
+
+class CrawlLog:
+    """ The status files of a crawl folder, plus a checkpoint of the progress
+    over the link file, saved in folder/checkpoint.json.
+
+    The checkpoint contains:
+        offset: byte offset into the link file of the first link not yet
+                processed. Resuming is a seek to offset.
+        done: start offsets of the links after offset that have already
+              been processed. It's only non-empty for concurrent crawls,
+              where links finish out of order.
+        idx: index of the next page to write.
+        counts: number of URLs written to each status file.
+        sizes: size in bytes of each status file.
+        writer: state of the page writer.
+
+    Each link, whether it's downloaded, skipped, bad, or empty, counts
+    towards the progress once finish() is called on it. The checkpoint is
+    written atomically every interval links. When resuming, the status files
+    are truncated to the sizes in the checkpoint and pages written after the
+    checkpoint are removed, so the links processed after the last checkpoint
+    are processed again. If the crawl was closed properly, nothing is
+    processed twice.
+    """
+
+    def __init__(self, folder, link_file, interval=100, writer=None):
+        self.folder = folder
+        self.writer = writer if writer is not None else PageFiles(folder)
+        self.link_file = link_file
+        self.interval = interval
+        self.checkpoint_file = os.path.join(folder, 'checkpoint.json')
+        self.offset = 0
+        self.idx = 0
+        self.counts = {name: 0 for name in STATUS_FILES}
+        self.pending = collections.deque()
+        self.finished = set()
+        self.done = set()
+        self.unsaved = 0
+        self.status_files = None
+
+    def open(self):
+        """ Create the folder and open the status files.
+        Return the link file opened in binary mode, positioned at where the
+        crawl left off the last time.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        links = open(self.link_file, 'rb')
+        index_file = os.path.join(self.folder, 'index.urls')
+
+        resumed = os.path.exists(self.checkpoint_file)
+        if resumed:
+            self.restore()
+            links.seek(self.offset)
+            print('Resume from checkpoint:', self.idx)
+        elif os.path.exists(index_file):
+            """ If index file exists, we've downloaded from this list of
+            URLs before, continue from where it left off the last time.
+            """
+            self.idx, links = get_current_idx(index_file, links)
+            self.offset = links.tell()
+            self.counts['index'] = self.idx
+            print(self.idx)
+
+        self.status_files = {
+            name: open(os.path.join(self.folder, f'{name}.urls'), 'a')
+            for name in STATUS_FILES}
+        if resumed:
+            # the crawl is no longer closed: if it stops before the next
+            # checkpoint, the pages it writes must be removed on resume
+            self.save()
+        return links
+
+    def restore(self):
+        with open(self.checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['link_file'] != os.path.abspath(self.link_file):
+            print('Warning: checkpoint was made for', checkpoint['link_file'])
+        self.offset = checkpoint['offset']
+        self.done = set(checkpoint['done'])
+        self.idx = checkpoint['idx']
+        self.counts.update(checkpoint['counts'])
+
+        for name, size in checkpoint['sizes'].items():
+            path = os.path.join(self.folder, f'{name}.urls')
+            if os.path.exists(path):
+                with open(path, 'rb+') as f:
+                    f.truncate(size)
+
+        self.writer.restore(checkpoint.get('writer', {}),
+                            self.idx,
+                            closed=checkpoint['closed'],
+                            interval=checkpoint['interval'])
+
+    def skip_link(self, start):
+        """ Return True if the link starting at start was already processed
+        """
+        if start in self.done:
+            self.done.remove(start)
+            return True
+        return False
+
+    def start(self, start, end):
+        """ Register that the link at [start, end) in the link file
+        is being processed. Links have to be started in file order.
+        """
+        self.pending.append((start, end))
+
+    def write(self, name, link):
+        self.status_files[name].write(link + '\n')
+        self.counts[name] += 1
+        if name == 'index':
+            self.idx += 1
+
+    def write_page(self, link, txt):
+        self.writer.write(self.idx, link, txt)
+        self.write('index', link)
+
+    def finish(self, start):
+        """ Mark the link starting at start as processed.
+        Links can finish in any order.
+        """
+        self.finished.add(start)
+        while self.pending and self.pending[0][0] in self.finished:
+            link_start, link_end = self.pending.popleft()
+            self.finished.remove(link_start)
+            self.offset = link_end
+        self.unsaved += 1
+        if self.unsaved >= self.interval:
+            self.save()
+
+    def save(self, closed=False):
+        for f in self.status_files.values():
+            f.flush()
+        checkpoint = {'link_file': os.path.abspath(self.link_file),
+                      'offset': self.offset,
+                      'done': sorted(self.finished | self.done),
+                      'idx': self.idx,
+                      'counts': self.counts,
+                      'sizes': {name: f.tell()
+                                for name, f in self.status_files.items()},
+                      'writer': self.writer.state(),
+                      'interval': self.interval,
+                      'closed': closed}
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_file, self.checkpoint_file)
+        self.unsaved = 0
+
+    def close(self):
+        self.save(closed=True)
+        for f in self.status_files.values():
+            f.close()
+        self.writer.close()
+
+
+def read_skip_file(filename):
+    """ Return the stripped lines of lazynlp/[filename]
+    """
+    with open(f'{dir_path}/{filename}', 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def get_ssl_context():
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+def write_page(folder, idx, link, txt, hashed):
+    """ Write the page into folder/[idx]_[hash].txt.
+    The first line of the file is the URL.
+    hashed is a hashlib object, updated with the current time for each page.
+    """
+    hashed.update(str(time.time()).encode())
+    name = hashed.hexdigest()
+    with open(f'{folder}/{idx}_{name}.txt', 'w') as out:
+        out.write(link + '\n' + txt)
+
+
+class PageFiles:
+    """ Write each page into its own file, see write_page.
+    Same interface as store.ShardWriter.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.hashed = hashlib.sha1()
+
+    def write(self, idx, link, txt):
+        write_page(self.folder, idx, link, txt, self.hashed)
+
+    def state(self):
+        return {}
+
+    def restore(self, state, idx, closed=False, interval=0):
+        """ If the crawl wasn't closed properly, remove the pages written
+        after the checkpoint, from idx on. There can be more than interval
+        of them, as concurrent crawls write the pages of links that
+        haven't finished yet.
+        """
+        if closed:
+            return
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                page_idx = entry.name.split('_')[0]
+                if (entry.name.endswith('.txt') and page_idx.isdigit()
+                        and int(page_idx) >= idx):
+                    os.remove(entry.path)
+
+    def close(self):
+        pass
+
+
+def get_page_writer(folder, shard_size=None):
+    if shard_size:
+        return ShardWriter(folder, shard_size)
+    return PageFiles(folder)
+
+
+def process_link(link, ctx, timeout, url_filter, parser='justext',
+                 prefilter=False, session=None, max_size=None, health=None,
+                 dns=None):
+    """ Download and clean one link without writing anything.
+    Return the status file to write the link to, the text of the page,
+    and its encoding.
+    health: if set, a HostHealth to fail fast on hosts that are down
+        and limit the rate of requests to each host.
+    dns: if set, a DNSCache to fail fast on hosts that don't resolve.
+    """
+    if url_filter.to_skip(link):
+        print('Skip', link)
+        return 'skip', '', None
+
+    if dns is not None and dns.failed(get_host(link)):
+        print("Host doesn't resolve", link)
+        return 'bad', '', None
+
+    if health is None:
+        code, page, content_type = fetch_page(link, ctx, timeout, session,
+                                              max_size)
+    else:
+        code, page, content_type = fetch_page_health(link, health, ctx,
+                                                     timeout, session,
+                                                     max_size)
+    if code > 0:
+        return CODE_FILES[code], '', None
+
+    txt, encoding = clean_page(page, parser, prefilter, content_type,
+                               with_encoding=True)
+    if not txt:
+        print('Empty page', link)
+        return 'empty', '', encoding
+    return 'index', txt, encoding
+
+
+def fetch_page_health(link, health, context=None, timeout=None,
+                      session=None, max_size=None):
+    """ fetch_page, unless the circuit of the host of link is open,
+    waiting for the rate limit of the host, see HostHealth
+    """
+    host = get_host(link)
+    if not health.allow(host):
+        print('Circuit open', link)
+        return 3, '', None
+    wait = health.reserve(host)
+    if wait > 0:
+        time.sleep(wait)
+
+    start = time.time()
+    code = 3
+    try:
+        code, page, content_type = fetch_page(link, context, timeout,
+                                              session, max_size,
+                                              connect_code=CONNECT_CODE)
+    finally:
+        health.record(host, code in (3, CONNECT_CODE), time.time() - start)
+    if code == CONNECT_CODE:
+        return 1, '', None
+    return code, page, content_type
+
+
+def log_link(log, link, name, txt, encoding):
+    """ Log the result of process_link into the right status file,
+    and write the page if there's one.
+    """
+    if name != 'index':
+        log.write(name, link)
+        return
+
+    print(log.idx, link, encoding)
+    log.write_page(link, txt)
+
+    print(find_unprintable(txt))
+
+
+def crawl_link(link, log, ctx, timeout, url_filter, parser='justext',
+               prefilter=False, session=None, max_size=None, health=None,
+               dns=None):
+    """ Download and clean one link for download_pages,
+    and log it into the right status file.
+    """
+    log_link(log, link, *process_link(link, ctx, timeout, url_filter, parser,
+                                      prefilter, session, max_size, health,
+                                      dns))
+
+
+def crawl_links_threaded(links, log, workers, *args):
+    """ Download and clean links, as returned by read_links, in a pool of
+    workers threads, with args the arguments of process_link after link.
+
+    Only the calling thread writes: it logs the links in their order in
+    the link file, so the output is the same as crawling them one by one,
+    including the idx of each page. At most 4 * workers links are being
+    processed or waiting to be logged at any time.
+    """
+    pending = collections.deque()
+
+    def log_done(max_pending):
+        while len(pending) > max_pending:
+            start, link, future = pending.popleft()
+            log_link(log, link, *future.result())
+            log.finish(start)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for start, end, link in links:
+            if log.skip_link(start):
+                continue
+            log.start(start, end)
+            future = executor.submit(process_link, link, *args)
+            pending.append((start, link, future))
+            log_done(4 * workers)
+        log_done(0)
+
+
 def download_pages(link_file,
                    folder,
                    timeout=30,
                    default_skip=True,
-                   extensions=[],
-                   domains=[]):
+                   extensions=None,
+                   domains=None,
+                   concurrency=None,
+                   per_host=4,
+                   delay=0,
+                   clean_workers=None,
+                   checkpoint_interval=100,
+                   shard_size=None,
+                   parser='justext',
+                   prefilter=False,
+                   keep_alive=False,
+                   max_size=None,
+                   workers=None,
+                   max_failures=None,
+                   cooldown=300,
+                   rate=None,
+                   dns_ttl=None,
+                   prefetch=1000,
+                   resolver=None):
     """
     link_file (str):
         file contains links to pages to crawl. Each line contains one URL.
@@ -200,11 +1105,74 @@ def download_pages(link_file,
         You can also add your own domains and extensions to skip with domains
         and extensions and arguments.
 
+    concurrency (int):
+        if set, crawl with the asyncio crawler (see lazynlp/aiocrawl.py),
+        keeping up to concurrency requests in flight.
+    per_host (int):
+        with concurrency, max number of requests in flight to the same host.
+    delay (float):
+        with concurrency, min seconds between two requests to the same host.
+    clean_workers (int):
+        with concurrency, clean pages in a pool of clean_workers processes
+        so that cleaning doesn't compete with fetching for one core.
+    checkpoint_interval (int):
+        how often (in number of URLs) to save the progress over link_file
+        to folder/checkpoint.json. Rerunning with the same folder resumes
+        from the last checkpoint.
+    shard_size (int):
+        if set, write pages into compressed shards of shard_size pages
+        instead of one file per page. See lazynlp/store.py to read them.
+    parser (str):
+        how to extract the text of pages, 'justext' or the faster but
+        less accurate 'density'. See parse_html.
+    prefilter (bool):
+        if True, pages that are obviously not text are left empty without
+        being parsed. See is_text_page.
+    keep_alive (bool):
+        if True, download through a requests session that keeps
+        connections to each host open and reuses them, and decompresses
+        the pages sent compressed. See get_session. Errors are written to
+        the same status files as with urllib, but requests are sent with
+        the headers of requests (User-Agent, Accept-Encoding).
+    max_size (int):
+        if set, give up on pages larger than max_size bytes as soon as
+        they get larger, and write them to bad.urls.
+    workers (int):
+        if set, download and clean pages in a pool of workers threads.
+        The output is the same as without workers: pages are written by
+        one thread, in the order of link_file.
+    max_failures (int):
+        after max_failures connection errors, including hosts that refuse
+        connections or don't resolve, or timeouts in a row on a host,
+        write the next URLs of the host to connection.urls without
+        fetching them, except for one every cooldown seconds to check
+        if the host is back. By default, all URLs are fetched.
+        See HostHealth.
+    cooldown (float):
+        seconds between two checks of a host that is down.
+    rate (float):
+        if set, max number of requests per second to the same host.
+        It's lowered for hosts that fail, and raised back when they recover.
+    dns_ttl (float):
+        if set, seconds to cache the IP addresses of each host, so that
+        it's only resolved once instead of once per URL. Hosts that don't
+        resolve are cached for a minute. By default, each URL is resolved
+        by the system. See DNSCache.
+    prefetch (int):
+        with dns_ttl, resolve the hosts of up to prefetch URLs ahead
+        of the fetchers. URLs whose host doesn't resolve are written to
+        bad.urls without being fetched.
+    resolver:
+        function that returns the list of IP addresses of a host,
+        by default the system resolver, see resolve_host.
+
     In the folder:
             Each URL is downloaded into a file, indexed by the order in which
             it is downloaded.
             The first line of each file is the URL.
             The rest is the textual content of the page.
+            With shard_size, pages are instead appended to
+            pages_[shard].jsonl.gz, indexed by pages_[shard].idx.
 
             index.urls contains all the URLs that have been successfully downloaded.
             bad.urls contains the URLs that are bad.
@@ -213,71 +1181,115 @@ def download_pages(link_file,
             non_ascii.urls contains the URLs that haven't been downloaded because
                             of bad encoding issues.
             empty.urls contains the URLs that have empty textual content.
+            skip.urls contains the URLs that are skipped.
+            checkpoint.json contains the progress over link_file.
     """
-    index_file = os.path.join(folder, 'index.urls')
-    idx = 0
-    links = open(link_file, 'r')
+    log = CrawlLog(folder, link_file, checkpoint_interval,
+                   get_page_writer(folder, shard_size))
+    crawl_log(log,
+              timeout=timeout,
+              default_skip=default_skip,
+              extensions=extensions,
+              domains=domains,
+              concurrency=concurrency,
+              per_host=per_host,
+              delay=delay,
+              clean_workers=clean_workers,
+              parser=parser,
+              prefilter=prefilter,
+              keep_alive=keep_alive,
+              max_size=max_size,
+              workers=workers,
+              max_failures=max_failures,
+              cooldown=cooldown,
+              rate=rate,
+              dns_ttl=dns_ttl,
+              prefetch=prefetch,
+              resolver=resolver)
 
-    if os.path.isdir(folder) and os.path.exists(index_file):
-        """ If index file exists, we've downloaded from this list of
-        URLs before, continue from where it left off the last time.
-        """
-        idx, links = get_current_idx(index_file, links)
-        print(idx)
-    else:
-        os.makedirs(folder, exist_ok=True)
 
-    index = open(os.path.join(folder, 'index.urls'), 'a')
-    skipped_urls = open(os.path.join(folder, 'skip.urls'), 'a')
-    bad_connection_urls = open(os.path.join(folder, 'connection.urls'), 'a')
-    bad_urls = open(os.path.join(folder, 'bad.urls'), 'a')
-    non_ascii_urls = open(os.path.join(folder, 'non_ascii.urls'), 'a')
-    empty_urls = open(os.path.join(folder, 'empty.urls'), 'a')
+def crawl_log(log,
+              timeout=30,
+              default_skip=True,
+              extensions=None,
+              domains=None,
+              concurrency=None,
+              per_host=4,
+              delay=0,
+              clean_workers=None,
+              parser='justext',
+              prefilter=False,
+              keep_alive=False,
+              max_size=None,
+              workers=None,
+              max_failures=None,
+              cooldown=300,
+              rate=None,
+              dns_ttl=None,
+              prefetch=1000,
+              resolver=None):
+    """ Crawl the link file of log, a CrawlLog, into its folder.
+    See download_pages for the arguments.
+    """
+    if concurrency:
+        from .aiocrawl import AsyncCrawler
+        crawler = AsyncCrawler(log.folder,
+                               timeout=timeout,
+                               default_skip=default_skip,
+                               extensions=extensions,
+                               domains=domains,
+                               concurrency=concurrency,
+                               per_host=per_host,
+                               delay=delay,
+                               clean_workers=clean_workers,
+                               parser=parser,
+                               prefilter=prefilter,
+                               max_size=max_size,
+                               max_failures=max_failures,
+                               cooldown=cooldown,
+                               rate=rate,
+                               dns_ttl=dns_ttl,
+                               prefetch=prefetch,
+                               resolver=resolver)
+        return crawler.run(log.link_file, log)
 
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
+    links = log.open()
+    ctx = get_ssl_context()
+    session = None
+    if keep_alive:
+        session = get_session(pool_size=max(workers or 1, 10), context=ctx)
+    url_filter = URLFilter(default_skip, extensions, domains)
+    health = None
+    if max_failures or rate:
+        health = HostHealth(max_failures, cooldown, rate)
+    dns = None
+    link_iter = read_links(links)
+    if dns_ttl:
+        dns = DNSCache(resolver, dns_ttl, min(60, dns_ttl))
+        if prefetch:
+            link_iter = prefetch_links(link_iter, dns, prefetch, url_filter)
+    args = (ctx, timeout, url_filter, parser, prefilter, session, max_size,
+            health, dns)
 
-    hashed = hashlib.sha1()
-
-    if default_skip:
-        ext_lines = open(f'{dir_path}/exclude_extensions.txt', 'r').readlines()
-        extensions.extend([line.strip() for line in ext_lines])
-        domain_lines = open(f'{dir_path}/exclude_domains.txt', 'r').readlines()
-        domains.extend([line.strip() for line in domain_lines])
-
-    for link in links:
-        link = link.strip()
-        if to_skip(link, extensions, domains):
-            skipped_urls.write(link + '\n')
-            print('Skip', link)
-            continue
-
-        code, page = download_page(link, ctx, timeout)
-        if code == 1:
-            bad_urls.write(link + '\n')
-        elif code == 2:
-            non_ascii_urls.write(link + '\n')
-        elif code == 3:
-            bad_connection_urls.write(link + '\n')
-        if code > 0:
-            continue
-
-        txt = clean_page(page)
-
-        if not txt:
-            print('Empty page', link)
-            empty_urls.write(link + '\n')
-            continue
-
-        print(idx, link)
-        hashed.update(str(time.time()).encode())
-        name = hashed.hexdigest()
-        with open(f'{folder}/{idx}_{name}.txt', 'w') as out:
-            out.write(link + '\n' + txt)
-
-        print(find_unprintable(txt))
-        index.write('{}\n'.format(link))
-        idx += 1
-
-    links.close()
+    try:
+        with dns.installed() if dns else contextlib.nullcontext():
+            if workers:
+                crawl_links_threaded(link_iter, log, workers, *args)
+            else:
+                for start, end, link in link_iter:
+                    if log.skip_link(start):
+                        continue
+                    log.start(start, end)
+                    crawl_link(link, log, *args)
+                    log.finish(start)
+    finally:
+        links.close()
+        log.close()
+        if session is not None:
+            session.close()
+        if dns is not None:
+            dns.close()
+    if health is not None:
+        health.report()
+    if dns is not None:
+        dns.report()
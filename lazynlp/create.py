@@ -1,6 +1,10 @@
+import gzip
+import hashlib
+import heapq
+import multiprocessing
 import os
-import random
 import shutil
+import time
 
 from pybloom import BloomFilter
 
@@ -27,7 +31,12 @@ def filter_files(files,
                  capacity=100000000,
                  error_rate=1e-7,
                  header=0,
-                 interval=1000000):
+                 interval=1000000,
+                 hashed=False,
+                 method='bloom',
+                 num_perm=128,
+                 workers=None,
+                 bf_file=None):
     """ Include only files that has less than threshold n-gram overlapping
         with the current dataset.
     Names of all the files that are deemed duplicated are stored in
@@ -35,24 +44,67 @@ def filter_files(files,
     Names of all the files used for the dataset are stored in
         clean_files.list
 
+    files can also be store.Documents, for example the result of
+        get_documents(folder) for pages crawled into shards.
+        They're listed as [shard file]:[idx].
+
     Args:
         header (int):
             number of lines of each file to skip. It's because in our format,
             the first line is the url
+        hashed (bool):
+            use 64-bit n-gram hashes instead of n-gram strings,
+            see build_ngram
+        method (str):
+            'bloom': a file is duplicated if more than threshold of its
+                n-grams are in a BloomFilter of the n-grams of the files
+                kept so far.
+            'minhash': a file is duplicated if its estimated Jaccard
+                similarity with a file kept so far is likely above threshold,
+                see filter_files_minhash. capacity, error_rate and hashed
+                are ignored.
+        num_perm (int):
+            with minhash, size of the MinHash signatures.
+        workers (int):
+            with minhash, number of processes computing signatures.
+        bf_file (str):
+            with bloom, keep the BloomFilter in an MmapBloomFilter saved in
+            bf_file. If bf_file already exists, files are compared against
+            the files kept in previous runs too.
 
     """
+    if method == 'minhash':
+        return filter_files_minhash(files,
+                                    threshold=threshold,
+                                    gran=gran,
+                                    n=n,
+                                    header=header,
+                                    num_perm=num_perm,
+                                    workers=workers,
+                                    interval=interval)
+    if method != 'bloom':
+        raise ValueError("method has to be 'bloom' or 'minhash'")
+
     sorted_files = sort_files_by_size(files)
-    bf = BloomFilter(capacity=capacity, error_rate=error_rate)
+    if bf_file:
+        bf = MmapBloomFilter.open_or_create(bf_file, capacity, error_rate)
+    else:
+        bf = BloomFilter(capacity=capacity, error_rate=error_rate)
     dupped_files = open('dupped_files.list', 'w')
     clean_files = open('clean_files.list', 'w')
 
     dup_count = 0
 
     for size, file in sorted_files:
-        overlap = estimate_overlap_bf(bf, file, gran=gran, n=n, header=header)
+        overlap = estimate_overlap_bf(bf,
+                                      file,
+                                      gran=gran,
+                                      n=n,
+                                      header=header,
+                                      hashed=hashed)
         if overlap > threshold:
             print("Dup", file)
-            dupped_files.write(file.strip() + '\n')
+            dupped_files.write(str(file).strip() + '\n')
             dup_count += 1
         else:
             bf = build_ngram(file=file,
@@ -61,13 +113,181 @@ def filter_files(files,
                              n=n,
                              uncase=True,
                              alphanumeric=True,
-                             interval=interval)
-            clean_files.write(file.strip() + '\n')
+                             interval=interval,
+                             hashed=hashed)
+            clean_files.write(str(file).strip() + '\n')
+    if bf_file:
+        bf.close()
+    total = len(files)
+    print(f'{dup_count} duplicated out of {total}: {dup_count / total}')
+
+
+def filter_files_minhash(files,
+                         threshold=0.5,
+                         gran='word',
+                         n=8,
+                         header=0,
+                         num_perm=128,
+                         workers=None,
+                         interval=1000000):
+    """ Same as filter_files, but compare files with MinHash signatures
+    of their n-grams and a MinHashLSH index instead of a BloomFilter.
+    Signatures are computed in parallel by workers processes. Memory only
+    grows with the number of files, not with the number of n-grams.
+
+    Files are still processed from the largest, and a file is duplicated
+    if its estimated Jaccard similarity with a file kept before it is at
+    least threshold. Files without any n-gram are kept.
+    """
+    sorted_files = [file for size, file in sort_files_by_size(files)]
+    lsh = MinHashLSH(threshold, num_perm)
+    print(f'MinHash LSH: {lsh.bands} bands of {lsh.rows} rows')
+    dupped_files = open('dupped_files.list', 'w')
+    clean_files = open('clean_files.list', 'w')
+
+    dup_count = 0
+    tasks = ((file, gran, n, header, num_perm) for file in sorted_files)
+    pool = multiprocessing.Pool(workers) if workers != 1 else None
+    try:
+        signatures = (pool.imap(get_file_minhash, tasks, chunksize=16)
+                      if pool is not None else map(get_file_minhash, tasks))
+        start = time.time()
+        for i, (file, signature) in enumerate(signatures):
+            if signature is not None and lsh.query(signature):
+                print("Dup", file)
+                dupped_files.write(str(file).strip() + '\n')
+                dup_count += 1
+            else:
+                if signature is not None:
+                    lsh.insert(signature)
+                clean_files.write(str(file).strip() + '\n')
+            if interval > 0 and (i + 1) % interval == 0:
+                print(f'Process file: {i + 1}. Time: {time.time() - start}')
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        dupped_files.close()
+        clean_files.close()
     total = len(files)
     print(f'{dup_count} duplicated out of {total}: {dup_count / total}')
 
 
-def partition(file, outfold, test_size=0.1, valid_size=0.1):
+SPLITS = ['train', 'valid', 'test']
+
+
+# split hashes are in [0, HASH_RANGE)
+HASH_RANGE = 2**64
+
+
+def get_split_hash(key, seed=0):
+    """ Map key, a string, to a 64-bit integer that is the same
+    across runs and processes for the same seed
+    """
+    digest = hashlib.blake2b(key.encode(),
+                             digest_size=8,
+                             key=str(seed).encode()).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def get_units(file, by_document=False):
+    """ Yield (key, lines) for each unit to assign to a split in file.
+    A unit is a non-empty line, or with by_document, the whole file,
+    keyed by its name.
+    """
+    if by_document:
+        yield str(file), read_lines(file)
+        return
+    for line in read_lines(file):
+        if line.strip():
+            yield line.rstrip('\n'), [line]
+
+
+def get_split_bounds(files, valid_size, test_size, seed=0, by_document=False):
+    """ Return (a, b) such that a unit goes to valid if its split hash is
+    under a, to test if it's in [a, b), and to train otherwise.
+
+    A size that is a fraction of 1 is the probability of a unit to go to
+    that split. An integer larger than 1 is the number of units. To get
+    exactly that many, the units with the smallest hashes are picked,
+    which needs a first pass over files keeping only that many hashes.
+    Duplicated units have the same hash, so they go to the same split.
+    """
+    valid = max(valid_size, 0)
+    test = max(test_size, 0)
+    valid_count, test_count = valid > 1, test > 1
+    if not valid_count and not test_count:
+        return int(valid * HASH_RANGE), int((valid + test) * HASH_RANGE)
+
+    if valid_count:
+        low, k = 0, int(valid) + (int(test) if test_count else 0)
+    else:
+        low, k = int(valid * HASH_RANGE), int(test)
+    # max-heap of the k smallest hashes from low
+    heap = []
+    for file in files:
+        for key, _ in get_units(file, by_document):
+            u = get_split_hash(key, seed)
+            if u < low:
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, -u)
+            elif u < -heap[0]:
+                heapq.heapreplace(heap, -u)
+    smallest = sorted(-u for u in heap)
+
+    def bound(count):
+        if count > len(smallest):
+            return HASH_RANGE
+        return smallest[count - 1] + 1
+
+    if not valid_count:
+        return low, bound(int(test))
+    a = bound(int(valid))
+    if test_count:
+        return a, bound(int(valid) + int(test))
+    return a, a + int(test * HASH_RANGE)
+
+
+def open_split(outfold, split, compress=False):
+    if compress:
+        return gzip.open(f'{outfold}/{split}.txt.gz', 'wt')
+    return open(f'{outfold}/{split}.txt', 'w', buffering=2**20)
+
+
+def partition_files(args):
+    """ Write the units of files to the split files in outfold.
+    Take a tuple of arguments to be used with a process pool.
+    """
+    files, outfold, bounds, seed, by_document, compress = args
+    os.makedirs(outfold, exist_ok=True)
+    outs = [open_split(outfold, split, compress) for split in SPLITS]
+    counts = [0, 0, 0]
+    try:
+        for file in files:
+            for key, lines in get_units(file, by_document):
+                u = get_split_hash(key, seed)
+                i = 1 if u < bounds[0] else 2 if u < bounds[1] else 0
+                for line in lines:
+                    if line.strip():
+                        outs[i].write(line)
+                counts[i] += 1
+    finally:
+        for out in outs:
+            out.close()
+    return counts
+
+
+def partition(file,
+              outfold,
+              test_size=0.1,
+              valid_size=0.1,
+              seed=0,
+              by_document=False,
+              compress=False,
+              workers=None):
     """
     outfold will contain:
     train.txt
@@ -77,18 +297,45 @@ def partition(file, outfold, test_size=0.1, valid_size=0.1):
     You can choose not to include test or valid by setting its size to -1
     If the size is a fraction of 1, it'll be divided based on that ration.
     If it's an integer larger than 1, test/valid will contain that number of samples
+
+    file: a path, or a list of paths or store.Documents.
+    Each non-empty line goes to a split depending on the hash of its content
+    with seed, so the split is the same every time, and lines can be
+    assigned independently, e.g. by different processes.
+    Memory doesn't depend on the size of file.
+
+    seed: change it to get a different split.
+    by_document: put all the lines of a file in the same split
+        instead of splitting each line independently.
+    compress: write gzip files [split].txt.gz instead.
+    workers: if file is a list, split it with workers processes, each
+        writing its own part, then concatenate the parts.
     """
+    files = [file] if isinstance(file, str) or hasattr(file, 'lines') \
+        else file
     os.makedirs(outfold, exist_ok=True)
-    files = [open(f'{outfold}/{filename}', 'w')
-             for filename in ['train.txt', 'valid.txt', 'test.txt']]
-    adjusted_test_size = test_size / (1 - valid_size)
-    with open(file, 'r') as f:
-        for line in f.readlines():
-            if not line.strip():
-                continue
-            if random.random() < valid_size:
-                files[1].write(line)
-            elif random.random() < adjusted_test_size:
-                files[2].write(line)
-            else:
-                files[0].write(line)
+    bounds = get_split_bounds(files, valid_size, test_size, seed, by_document)
+
+    parts = max(min(workers or 1, len(files)), 1)
+    if parts == 1:
+        counts = partition_files((files, outfold, bounds, seed, by_document,
+                                  compress))
+    else:
+        tasks = [(files[i::parts], f'{outfold}/part_{i}', bounds, seed,
+                  by_document, compress) for i in range(parts)]
+        with multiprocessing.Pool(parts) as pool:
+            part_counts = pool.map(partition_files, tasks)
+        counts = [sum(c) for c in zip(*part_counts)]
+        suffix = '.txt.gz' if compress else '.txt'
+        for split in SPLITS:
+            # gzip members can be concatenated too
+            with open(f'{outfold}/{split}{suffix}', 'wb') as out:
+                for task in tasks:
+                    with open(f'{task[1]}/{split}{suffix}', 'rb') as f_in:
+                        shutil.copyfileobj(f_in, out, 2**20)
+        for task in tasks:
+            shutil.rmtree(task[1])
+
+    for split, count in zip(SPLITS, counts):
+        print(f'{split}: {count}')
+    return counts
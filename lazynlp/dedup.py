@@ -0,0 +1,582 @@
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .utils import *
+
+
+class FingerprintSet:
+    """ Set of line fingerprints (MD5 digests as returned by get_hash) stored
+    in an open-addressing hash table backed by numpy arrays of 64-bit
+    integers, so each fingerprint costs 8 or 16 bytes per slot instead of
+    the ~100 bytes of a bytes object in a Python set.
+
+    Add fingerprints in batches with add_many, which probes the table for
+    the whole batch at once. For 1M digests in batches of 64k, it takes
+    about as long as DigestSet.add_many when capacity is set up front,
+    and about 1.5x as long when the table has to grow on the way.
+    add and `in` work on one fingerprint at a time, and are much slower
+    than a set: use them for a few lookups only.
+
+    bits:
+        128 keeps the whole MD5 digest, so it's exact: the same as a set
+            of digests.
+        64 keeps only the first 8 bytes and uses half the memory, but it's
+            approximate: two different lines collide with probability
+            about n^2 / 2^65 for n unique lines.
+    capacity: number of fingerprints to make room for up front.
+    max_memory:
+        max number of bytes for the table. Raise MemoryError if it needs to
+        grow beyond that, see get_memory to check it before.
+    """
+
+    def __init__(self, bits=128, capacity=2**16, max_memory=None,
+                 max_load=0.75):
+        if bits not in [64, 128]:
+            raise ValueError('bits has to be 64 or 128')
+        self.bits = bits
+        self.exact = bits == 128
+        self.max_memory = max_memory
+        self.max_load = max_load
+        self.size = 0
+        self.has_zero = False
+        self.allocate(get_table_size(capacity, max_load))
+
+    @staticmethod
+    def get_memory(count, bits=128, max_load=0.75):
+        """ Number of bytes of a table that holds count fingerprints
+        """
+        return get_table_size(count, max_load) * bits // 8
+
+    def allocate(self, capacity):
+        if self.max_memory and capacity * self.bits // 8 > self.max_memory:
+            raise MemoryError(
+                f'FingerprintSet needs more than {self.max_memory} bytes')
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.his = np.zeros(capacity, dtype=np.uint64)
+        self.los = np.zeros(capacity if self.bits == 128 else 0,
+                            dtype=np.uint64)
+
+    @property
+    def memory(self):
+        """ Number of bytes used by the table
+        """
+        return self.capacity * self.bits // 8
+
+    def __len__(self):
+        return self.size
+
+    def split(self, digests):
+        """ Return the arrays of the high and low 64 bits of digests,
+        a list of 16-byte digests. The low bits are 0 with bits=64.
+        """
+        values = np.frombuffer(b''.join(digests), dtype='<u8').reshape(-1, 2)
+        his = values[:, 0].astype(np.uint64)
+        if self.bits == 64:
+            return his, np.zeros(len(digests), dtype=np.uint64)
+        return his, values[:, 1].astype(np.uint64)
+
+    def probe(self, slots):
+        """ Return the high and low bits in slots
+        """
+        if self.bits == 64:
+            return self.his[slots], np.zeros(len(slots), dtype=np.uint64)
+        return self.his[slots], self.los[slots]
+
+    def find(self, hi, lo):
+        """ Return the slot of (hi, lo), or of the empty slot where it goes
+        """
+        i = int(hi) & self.mask
+        while True:
+            slot_hi, slot_lo = self.probe([i])
+            if (slot_hi[0] == hi and slot_lo[0] == lo) or \
+                    (not slot_hi[0] and not slot_lo[0]):
+                return i
+            i = (i + 1) & self.mask
+
+    def __contains__(self, digest):
+        (hi,), (lo,) = self.split([digest])
+        if not hi and not lo:
+            return self.has_zero
+        slot_hi, slot_lo = self.probe([self.find(hi, lo)])
+        return bool(slot_hi[0] or slot_lo[0])
+
+    def add(self, digest):
+        """ Add digest. Return True if it wasn't in the set before.
+        """
+        return bool(self.add_many([digest])[0])
+
+    def add_many(self, digests):
+        """ Add digests, a list of 16-byte digests, in order.
+        Return a boolean array of whether each digest wasn't in the set
+        before, nor earlier in digests.
+        """
+        new = np.zeros(len(digests), dtype=bool)
+        if not digests:
+            return new
+        his, los = self.split(digests)
+        # the first occurrence of each digest, as the sort is stable
+        order = np.lexsort((los, his))
+        his, los = his[order], los[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (his[1:] != his[:-1]) | (los[1:] != los[:-1])
+        his, los, first = his[first], los[first], order[first]
+
+        # (0, 0) marks empty slots, keep track of it separately
+        zero = (his == 0) & (los == 0)
+        if zero.any():
+            if not self.has_zero:
+                self.has_zero = True
+                self.size += 1
+                new[first[zero]] = True
+            his, los, first = his[~zero], los[~zero], first[~zero]
+
+        while (self.size + len(his)) > self.capacity * self.max_load:
+            self.grow()
+        added = self.insert(his, los)
+        self.size += int(np.count_nonzero(added))
+        new[first[added]] = True
+        return new
+
+    def insert(self, his, los):
+        """ Insert the distinct non-zero keys (his, los), probing the table
+        for all of them at once. Return a boolean array of whether each
+        key wasn't in the table.
+        """
+        added = np.zeros(len(his), dtype=bool)
+        slots = (his & np.uint64(self.mask)).astype(np.int64)
+        todo = np.arange(len(his))
+        while len(todo):
+            slot_his, slot_los = self.probe(slots[todo])
+            found = (slot_his == his[todo]) & (slot_los == los[todo])
+            empty = (slot_his == 0) & (slot_los == 0)
+            # keys that reach the same empty slot: the first one takes it,
+            # the others look at it again in the next round
+            candidates = todo[empty]
+            candidate_slots = slots[candidates]
+            order = np.argsort(candidate_slots, kind='stable')
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (candidate_slots[order[1:]] !=
+                         candidate_slots[order[:-1]])
+            first = order[first]
+            winners = candidates[first]
+            self.his[slots[winners]] = his[winners]
+            if self.bits == 128:
+                self.los[slots[winners]] = los[winners]
+            added[winners] = True
+
+            done = found.copy()
+            done[np.flatnonzero(empty)[first]] = True
+            moved = todo[~found & ~empty]
+            slots[moved] = (slots[moved] + 1) & self.mask
+            todo = todo[~done]
+        return added
+
+    def grow(self):
+        his, los = self.his, self.los
+        used = his != 0
+        if self.bits == 128:
+            used |= los != 0
+        self.allocate(self.capacity * 2)
+        if self.bits == 128:
+            self.insert(his[used], los[used])
+        else:
+            self.insert(his[used], np.zeros(int(used.sum()), dtype=np.uint64))
+
+
+def get_table_size(count, max_load=0.75):
+    """ Return the number of slots, a power of 2, of a FingerprintSet
+    that holds count fingerprints.
+    """
+    slots = max(int(count / max_load) + 1, 2)
+    return 1 << (slots - 1).bit_length()
+
+
+class DigestSet(set):
+    """ A Python set whose add returns True if the item is new,
+    like FingerprintSet.add
+    """
+
+    def add(self, item):
+        if item in self:
+            return False
+        super().add(item)
+        return True
+
+    def add_many(self, items):
+        return [self.add(item) for item in items]
+
+
+def get_seen_set(backend='set', bits=128, max_memory=None, capacity=2**16):
+    """ Return an empty set of fingerprints for dedup_lines.
+    backend is 'set' for a Python set or 'table' for a FingerprintSet
+    with room for capacity fingerprints.
+    """
+    if backend == 'set':
+        print('Dedup backend: set (exact)')
+        return DigestSet()
+    if backend == 'table':
+        seen = FingerprintSet(bits=bits, capacity=capacity,
+                              max_memory=max_memory)
+        mode = 'exact' if seen.exact else 'approximate'
+        print(f'Dedup backend: table ({mode}, {bits}-bit fingerprints)')
+        return seen
+    raise ValueError("backend has to be 'set', 'table' or 'disk'")
+
+
+def count_lines(files, buffer_size=2**20):
+    """ Return an upper bound on the number of lines of files read in text
+    mode: each '\n' or '\r' may end a line, and so may the end of a file.
+    """
+    count = 0
+    for file in files:
+        with open(file, 'rb') as f:
+            while True:
+                data = f.read(buffer_size)
+                if not data:
+                    break
+                count += data.count(b'\n') + data.count(b'\r')
+        count += 1
+    return count
+
+
+def fits_in_table(files, bits=128, max_memory=None):
+    """ Return whether a FingerprintSet of the lines of files fits in
+    max_memory bytes, and the upper bound on their number of lines.
+    """
+    lines = count_lines(files)
+    if not max_memory:
+        return True, lines
+    return FingerprintSet.get_memory(lines, bits) <= max_memory, lines
+
+
+def dedup_file(seen, file, outfile=None, batch_size=2**16):
+    """ Add the fingerprints of the lines of file to seen, a set from
+    get_seen_set, batch_size lines at a time. Write the lines that
+    weren't in seen to outfile if given.
+    Return the number of unique and total lines.
+    """
+    unique, total = 0, 0
+    out = open(outfile, 'w') if outfile else None
+    with open(file, 'r') as f_in:
+        while True:
+            lines = list(itertools.islice(f_in, batch_size))
+            if not lines:
+                break
+            new = seen.add_many([get_hash(line.strip()) for line in lines])
+            if out is not None:
+                kept = [line for line, is_new in zip(lines, new) if is_new]
+                out.writelines(kept)
+                unique += len(kept)
+            total += len(lines)
+    if out is not None:
+        out.close()
+    return unique, total
+
+
+# each record of a sorted run is a 16-byte digest followed by
+# the big-endian position of the line, so that records sort by
+# digest first, then by position
+RECORD_SIZE = 24
+
+
+def write_run(records, tmp_dir):
+    records.sort()
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b''.join(records))
+    return path
+
+
+def read_run(path, buffer_size=2**20):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(buffer_size * RECORD_SIZE)
+            if not chunk:
+                return
+            for i in range(0, len(chunk), RECORD_SIZE):
+                yield chunk[i:i + RECORD_SIZE]
+
+
+def dedup_lines_external(files, outfiles, max_memory=2**30, tmp_dir=None):
+    """ Remove duplicated lines across files with an external sort, so that
+    memory stays under about max_memory bytes however many lines there are.
+    Exact: keep the first occurrence of each line in file order, like
+    dedup_lines.
+
+    outfiles[i] is where to write the unique lines of files[i], or None
+    to only use files[i] as lines seen before.
+
+    1. Write sorted runs of (fingerprint, position) of all lines to tmp_dir.
+    2. Merge the runs. The first record of each fingerprint is the first
+       occurrence of the line. Mark its position in a bitmap on disk.
+    3. Read the files again and write the lines marked in the bitmap.
+
+    Return the number of unique and total lines written to outfiles.
+    """
+    # a bytes record in a list costs about 65 bytes
+    run_size = max(max_memory // 65, 1)
+    runs, records = [], []
+    position = 0
+    for file in files:
+        with open(file, 'r') as f_in:
+            for line in f_in:
+                records.append(get_hash(line.strip()) +
+                               position.to_bytes(8, 'big'))
+                position += 1
+                if len(records) >= run_size:
+                    runs.append(write_run(records, tmp_dir))
+                    records = []
+    if records:
+        runs.append(write_run(records, tmp_dir))
+    records = None
+
+    fd, bitmap_path = tempfile.mkstemp(suffix='.bitmap', dir=tmp_dir)
+    os.ftruncate(fd, max(position // 8 + 1, 1))
+    bitmap = mmap.mmap(fd, 0)
+    try:
+        prev = None
+        buffer_size = max(max_memory // (2 * RECORD_SIZE * len(runs) or 1),
+                          1024)
+        for record in heapq.merge(*[read_run(run, buffer_size)
+                                    for run in runs]):
+            digest = record[:16]
+            if digest != prev:
+                pos = int.from_bytes(record[16:], 'big')
+                bitmap[pos >> 3] |= 1 << (pos & 7)
+                prev = digest
+        for run in runs:
+            os.remove(run)
+
+        total, unique = 0, 0
+        position = 0
+        for file, outfile in zip(files, outfiles):
+            out = open(outfile, 'w') if outfile else None
+            with open(file, 'r') as f_in:
+                for line in f_in:
+                    if out is not None:
+                        if bitmap[position >> 3] & (1 << (position & 7)):
+                            out.write(line)
+                            unique += 1
+                        total += 1
+                    position += 1
+            if out is not None:
+                out.close()
+    finally:
+        bitmap.close()
+        os.close(fd)
+        os.remove(bitmap_path)
+    return unique, total
+
+
+def get_line_hash(line):
+    """ Same as get_hash(line.strip()) for a line read in binary mode
+    """
+    txt = line.decode('utf-8', 'surrogateescape').strip()
+    return hashlib.md5(txt.encode('utf-8', 'surrogateescape')).digest()
+
+
+def get_chunks(file, chunk_size):
+    """ Split file into [start, end) byte ranges of about chunk_size bytes
+    that start and end at line boundaries.
+    """
+    size = os.path.getsize(file)
+    chunks = []
+    start = 0
+    with open(file, 'rb') as f:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            end = min(end, size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def split_newlines(line):
+    """ Split a line read in binary mode like text mode does with universal
+    newlines: '\\r\\n' and '\\r' end lines too, and are replaced by '\\n'.
+    """
+    if b'\r' not in line:
+        yield line
+        return
+    for part in line.splitlines(keepends=True):
+        if part.endswith(b'\r\n'):
+            part = part[:-2] + b'\n'
+        elif part.endswith(b'\r'):
+            part = part[:-1] + b'\n'
+        yield part
+
+
+def read_chunk(file, start, end):
+    """ Yield the lines of file in [start, end), in binary,
+    split as in text mode, see split_newlines.
+    """
+    with open(file, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                return
+            yield from split_newlines(line)
+
+
+def partition_chunk(args):
+    """ Hash the lines of a chunk and group their records by partition.
+    Write the records in chunk_path as the sections for partitions 0, 1, ...
+    Return the number of lines and the size of each section.
+    """
+    file, start, end, chunk_path, partitions = args
+    sections = [[] for _ in range(partitions)]
+    count = 0
+    for line in read_chunk(file, start, end):
+        digest = get_line_hash(line)
+        partition = int.from_bytes(digest[:4], 'little') % partitions
+        sections[partition].append(digest + count.to_bytes(8, 'big'))
+        count += 1
+    sizes = []
+    with open(chunk_path, 'wb') as f:
+        for section in sections:
+            data = b''.join(section)
+            f.write(data)
+            sizes.append(len(data))
+    return count, sizes
+
+
+def dedup_partition(args):
+    """ Go through the records of one partition in file order and flag the
+    first occurrence of each fingerprint in the shared flags file.
+    Each line belongs to one partition, so workers never write to the same
+    byte.
+    """
+    partition, chunk_paths, section_offsets, bases, flags_path = args
+    seen = set()
+    with open(flags_path, 'r+b') as f:
+        flags = mmap.mmap(f.fileno(), 0)
+        for chunk_path, offsets, base in zip(chunk_paths,
+                                             section_offsets,
+                                             bases):
+            start, end = offsets[partition], offsets[partition + 1]
+            with open(chunk_path, 'rb') as chunk:
+                chunk.seek(start)
+                data = chunk.read(end - start)
+            for i in range(0, len(data), RECORD_SIZE):
+                digest = data[i:i + 16]
+                if digest not in seen:
+                    seen.add(digest)
+                    line_no = int.from_bytes(data[i + 16:i + RECORD_SIZE],
+                                             'big')
+                    flags[base + line_no] = 1
+        flags.close()
+    return len(seen)
+
+
+def write_chunk(args):
+    """ Write the flagged lines of a chunk to part_path
+    """
+    file, start, end, base, flags_path, part_path = args
+    unique, total = 0, 0
+    with open(flags_path, 'rb') as f, open(part_path, 'wb') as out:
+        flags = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for line in read_chunk(file, start, end):
+            if flags[base + total]:
+                out.write(line)
+                unique += 1
+            total += 1
+        flags.close()
+    return unique, total
+
+
+def dedup_lines_parallel(files,
+                         outfiles,
+                         workers=None,
+                         partitions=None,
+                         chunk_size=2**26,
+                         tmp_dir=None):
+    """ Remove duplicated lines across files with workers processes.
+    Keep the first occurrence of each line in file order, like dedup_lines.
+
+    outfiles[i] is where to write the unique lines of files[i], or None
+    to only use files[i] as lines seen before.
+
+    1. Split the files into chunks of about chunk_size bytes. For each chunk
+       in parallel, hash the lines and group (fingerprint, line number)
+       by partition, the fingerprint modulo partitions.
+    2. For each partition in parallel, go through its records chunk by chunk
+       in file order, so the first time a worker sees a fingerprint is its
+       first occurrence. Each worker only keeps the fingerprints of its own
+       partition in memory. First occurrences are flagged in a file of
+       one byte per line.
+    3. For each chunk in parallel, write the flagged lines, then concatenate
+       the chunks of each file.
+
+    Files are read in binary, but lines are split and written as in text
+    mode, like dedup_lines: '\\r\\n' and '\\r' end lines too, and are
+    written as '\\n'.
+
+    Return the number of unique and total lines written to outfiles.
+    """
+    workers = workers or os.cpu_count()
+    partitions = partitions or 4 * workers
+    work_dir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        chunks = []
+        for i, file in enumerate(files):
+            for start, end in get_chunks(file, chunk_size):
+                chunk_path = os.path.join(work_dir, f'{len(chunks)}.chunk')
+                chunks.append((i, file, start, end, chunk_path))
+
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(partition_chunk,
+                               [(file, start, end, chunk_path, partitions)
+                                for _, file, start, end, chunk_path in chunks])
+
+            bases, section_offsets = [], []
+            total_lines = 0
+            for count, sizes in results:
+                bases.append(total_lines)
+                total_lines += count
+                section_offsets.append(
+                    [0] + list(itertools.accumulate(sizes)))
+
+            flags_path = os.path.join(work_dir, 'flags')
+            with open(flags_path, 'wb') as f:
+                f.truncate(max(total_lines, 1))
+
+            chunk_paths = [chunk[-1] for chunk in chunks]
+            pool.map(dedup_partition,
+                     [(partition, chunk_paths, section_offsets, bases,
+                       flags_path) for partition in range(partitions)])
+
+            to_write = [(j, chunk) for j, chunk in enumerate(chunks)
+                        if outfiles[chunk[0]]]
+            counts = pool.map(write_chunk,
+                              [(file, start, end, bases[j], flags_path,
+                                chunk_path + '.part')
+                               for j, (_, file, start, end, chunk_path)
+                               in to_write])
+
+        for i, outfile in enumerate(outfiles):
+            if outfile:
+                with open(outfile, 'wb') as out:
+                    for _, chunk in to_write:
+                        if chunk[0] == i:
+                            with open(chunk[-1] + '.part', 'rb') as part:
+                                shutil.copyfileobj(part, out, 2**24)
+    finally:
+        shutil.rmtree(work_dir)
+
+    unique = sum(count[0] for count in counts)
+    total = sum(count[1] for count in counts)
+    return unique, total
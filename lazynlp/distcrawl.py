@@ -0,0 +1,421 @@
+""" Distributed crawl of one link file by many workers, processes or hosts,
+sharing a filesystem.
+
+The URLs are split once into num_shards shards by hash of their registered
+domain (as in google.com for news.google.com), so all URLs of a domain are
+in the same shard. Workers don't own fixed shards: each one repeatedly
+takes a lease on a shard nobody holds, crawls it, and marks it done, so
+workers can join or leave at any time. A shard is crawled by one worker at
+a time, so per_host and delay stay per domain across the whole crawl.
+
+Layout of root:
+    links/shards.json:      link file and number of URLs of each shard
+    links/[shard].urls:     URLs of each shard
+    leases/[shard].[epoch].lease, leases/[shard].done: see ShardLease
+    crawl/[shard]/:         crawl folder of each shard, as download_pages
+
+If a worker dies, its lease expires and another worker resumes the shard
+from its checkpoint. Once all shards are done, merge_shards combines the
+crawl folders into one.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+from .crawl import *
+from .store import *
+
+
+def get_registered_domain(link):
+    """ Return the registered domain of link, as in google.com
+    for https://news.google.com/...
+    """
+    subdomain, domain, suffix = get_domain_parts(link)
+    if suffix:
+        return domain + '.' + suffix
+    return domain
+
+
+def get_domain_shard(link, num_shards):
+    """ Return the shard of link, the same across runs and hosts
+    for the same number of shards.
+    """
+    domain = get_registered_domain(link).encode()
+    digest = hashlib.blake2b(domain, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % num_shards
+
+
+def get_links_folder(root):
+    return os.path.join(root, 'links')
+
+
+def get_shard_links(root, shard):
+    return os.path.join(get_links_folder(root), f'{shard:05d}.urls')
+
+
+def get_shard_folder(root, shard):
+    return os.path.join(root, 'crawl', f'{shard:05d}')
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def split_links(link_file, root, num_shards=64):
+    """ Split the URLs of link_file into root/links/[shard].urls by
+    get_domain_shard, keeping their order, and return the manifest
+    root/links/shards.json.
+
+    Only done once: if root is already split, return its manifest.
+    Workers that start at the same time all split into their own temporary
+    folder and rename it to root/links, so only one split is kept.
+    """
+    folder = get_links_folder(root)
+    manifest_file = os.path.join(folder, 'shards.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+
+    os.makedirs(root, exist_ok=True)
+    tmp_folder = f'{folder}.{get_worker_name()}.tmp'
+    os.makedirs(tmp_folder, exist_ok=True)
+    outs = [open(os.path.join(tmp_folder, f'{shard:05d}.urls'), 'wb')
+            for shard in range(num_shards)]
+    counts = [0] * num_shards
+    try:
+        with open(link_file, 'rb') as f:
+            for line in f:
+                link = line.strip()
+                if not link:
+                    continue
+                shard = get_domain_shard(link.decode('utf-8', 'replace'),
+                                         num_shards)
+                outs[shard].write(link + b'\n')
+                counts[shard] += 1
+    finally:
+        for out in outs:
+            out.close()
+
+    manifest = {'link_file': os.path.abspath(link_file),
+                'num_shards': num_shards,
+                'counts': counts}
+    with open(os.path.join(tmp_folder, 'shards.json'), 'w') as f:
+        json.dump(manifest, f)
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        # another worker split it first
+        shutil.rmtree(tmp_folder)
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    print(f'Split {sum(counts)} URLs into {num_shards} shards')
+    return manifest
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class ShardLease:
+    """ Lease of a worker on a shard.
+
+    A lease is the file root/leases/[shard].[epoch].lease. Taking a shard
+    creates the file of the next epoch exclusively, so when workers race
+    for the same shard, only one of them gets it. The holder touches its
+    file every lease_time / 3 seconds from a thread. If the holder dies,
+    its file isn't touched anymore and after lease_time seconds, another
+    worker can take the shard with the next epoch. A holder that was only
+    stalled sees the newer epoch and stops, see LeasedCrawlLog.
+
+    lease_time has to be much longer than the longest stall of a worker,
+    otherwise two workers can write to the same shard for a moment.
+    """
+
+    def __init__(self, root, shard, worker=None, lease_time=300):
+        self.folder = os.path.join(root, 'leases')
+        self.shard = shard
+        self.worker = worker or get_worker_name()
+        self.lease_time = lease_time
+        self.epoch = None
+        self.lost = False
+        self.stop = threading.Event()
+        self.thread = None
+
+    def get_file(self, epoch):
+        return os.path.join(self.folder, f'{self.shard:05d}.{epoch}.lease')
+
+    def get_done_file(self):
+        return os.path.join(self.folder, f'{self.shard:05d}.done')
+
+    def epochs(self):
+        prefix = f'{self.shard:05d}.'
+        return [int(name.split('.')[1]) for name in os.listdir(self.folder)
+                if name.startswith(prefix) and name.endswith('.lease')]
+
+    def is_done(self):
+        return os.path.exists(self.get_done_file())
+
+    def acquire(self):
+        """ Return True if the shard was free or its lease expired,
+        and is now held by this worker.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        epochs = self.epochs()
+        epoch = 0
+        if epochs:
+            epoch = max(epochs)
+            try:
+                age = time.time() - os.path.getmtime(self.get_file(epoch))
+            except FileNotFoundError:
+                return False
+            if age < self.lease_time:
+                return False
+            epoch += 1
+
+        try:
+            fd = os.open(self.get_file(epoch),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker, 'time': time.time()}, f)
+        self.epoch = epoch
+        self.lost = False
+
+        for old_epoch in epochs:
+            try:
+                os.remove(self.get_file(old_epoch))
+            except FileNotFoundError:
+                pass
+
+        self.stop.clear()
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return True
+
+    def held(self):
+        """ Return True if no other worker took the shard since acquire
+        """
+        if self.lost or self.epoch is None:
+            return False
+        if max(self.epochs(), default=-1) != self.epoch:
+            self.lost = True
+        return not self.lost
+
+    def heartbeat(self):
+        while not self.stop.wait(self.lease_time / 3):
+            if not self.held():
+                print(f'Lost the lease on shard {self.shard}')
+                return
+            try:
+                os.utime(self.get_file(self.epoch))
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def release(self, done=False):
+        """ Stop renewing the lease. With done, mark the shard as done,
+        otherwise let other workers take it right away.
+        """
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if not self.held():
+            return
+        if done:
+            with open(self.get_done_file(), 'w') as f:
+                json.dump({'worker': self.worker, 'time': time.time()}, f)
+        # expire the lease but keep the file so that epochs keep increasing
+        os.utime(self.get_file(self.epoch), (0, 0))
+        self.epoch = None
+
+
+class LeasedCrawlLog(CrawlLog):
+    """ CrawlLog of a shard that stops the crawl with LeaseLost at the next
+    checkpoint once another worker took over the shard, and then leaves
+    the folder to that worker without saving.
+    """
+
+    def __init__(self, lease, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lease = lease
+        self.lost = False
+
+    def save(self, closed=False):
+        if not self.lease.held():
+            self.lost = True
+            self.unsaved = 0
+            raise LeaseLost(f'Shard {self.lease.shard} taken by another worker')
+        super().save(closed)
+
+    def close(self):
+        try:
+            if not self.lost:
+                self.save(closed=True)
+        finally:
+            for f in self.status_files.values():
+                f.close()
+            self.writer.close()
+
+
+def crawl_shard(root, lease, checkpoint_interval=100, shard_size=None,
+                **kwargs):
+    """ Crawl the shard held by lease into root/crawl/[shard]
+    """
+    shard = lease.shard
+    log = LeasedCrawlLog(lease,
+                         get_shard_folder(root, shard),
+                         get_shard_links(root, shard),
+                         checkpoint_interval,
+                         get_page_writer(get_shard_folder(root, shard),
+                                         shard_size))
+    crawl_log(log, **kwargs)
+    print(f'Shard {shard} done: {log.idx} pages')
+
+
+def crawl_shards(link_file,
+                 root,
+                 worker=None,
+                 num_shards=64,
+                 lease_time=300,
+                 poll=None,
+                 checkpoint_interval=100,
+                 shard_size=None,
+                 **kwargs):
+    """ Run one worker of a distributed crawl of link_file into root.
+    Start as many workers as you want, on hosts that share root, with the
+    same link_file, root and num_shards. Each worker returns once all
+    shards are done, then run merge_shards.
+
+    worker (str):
+        name of the worker in the leases, by default [hostname]-[pid].
+    num_shards (int):
+        number of shards to split link_file into, by registered domain.
+        Only used by the first worker to start.
+    lease_time (float):
+        seconds after which a shard whose worker stopped renewing its lease
+        is taken over by another worker.
+    poll (float):
+        seconds to wait before looking again for a free shard when all
+        the shards left are held by other workers. By default lease_time / 10.
+
+    checkpoint_interval, shard_size, and the other keyword arguments
+    are the same as download_pages.
+
+    Return the shards crawled by this worker.
+    """
+    worker = worker or get_worker_name()
+    manifest = split_links(link_file, root, num_shards)
+    num_shards = manifest['num_shards']
+    poll = poll if poll is not None else lease_time / 10
+
+    # start at a different shard for each worker so they don't all race
+    # for the same shards
+    first = int(hashlib.blake2b(worker.encode(), digest_size=8).hexdigest(),
+                16) % num_shards
+    shards = [(first + i) % num_shards for i in range(num_shards)]
+
+    crawled = []
+    while True:
+        leases = [ShardLease(root, shard, worker, lease_time)
+                  for shard in shards]
+        leases = [lease for lease in leases if not lease.is_done()]
+        if not leases:
+            return crawled
+
+        acquired = False
+        for lease in leases:
+            if lease.is_done() or not lease.acquire():
+                continue
+            acquired = True
+            done = False
+            try:
+                # it may have been done between is_done and acquire
+                if not lease.is_done():
+                    print(f'{worker} crawling shard {lease.shard}')
+                    crawl_shard(root, lease, checkpoint_interval, shard_size,
+                                **kwargs)
+                    crawled.append(lease.shard)
+                done = True
+            except LeaseLost as e:
+                print(e)
+            finally:
+                lease.release(done)
+        if not acquired:
+            time.sleep(poll)
+
+
+def merge_shards(root, folder=None, partial=False, shard_size=None):
+    """ Combine the crawl folders of the shards in root into folder,
+    by default root, as if download_pages had crawled all the URLs.
+
+    Status files are concatenated in shard order and pages are renumbered
+    in the same order. Page files are hard-linked into folder (or copied if
+    that's not possible), pages in shards are rewritten into new shards of
+    shard_size pages (default 100000).
+
+    Raise ValueError if some shards aren't done, unless partial,
+    in which case only the shards done are merged.
+
+    Return the number of URLs in each status file.
+    """
+    folder = folder or root
+    with open(os.path.join(get_links_folder(root), 'shards.json'), 'r') as f:
+        num_shards = json.load(f)['num_shards']
+    if os.path.exists(os.path.join(folder, 'index.urls')):
+        raise ValueError(f'{folder} already has an index.urls')
+
+    done = [shard for shard in range(num_shards)
+            if ShardLease(root, shard).is_done()]
+    if len(done) < num_shards and not partial:
+        raise ValueError(f'Only {len(done)} of {num_shards} shards are done')
+
+    os.makedirs(folder, exist_ok=True)
+    counts = {name: 0 for name in STATUS_FILES}
+    writer = None
+    idx = 0
+    for shard in done:
+        shard_folder = get_shard_folder(root, shard)
+        for name in STATUS_FILES:
+            path = os.path.join(shard_folder, f'{name}.urls')
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as src, \
+                    open(os.path.join(folder, f'{name}.urls'), 'ab') as out:
+                for line in src:
+                    out.write(line)
+                    counts[name] += 1
+
+        if list_shards(shard_folder):
+            if writer is None:
+                writer = ShardWriter(folder, shard_size or 100000)
+            for record in read_pages(shard_folder):
+                writer.write(idx + record['idx'],
+                             record['url'],
+                             record['text'],
+                             record['time'])
+        else:
+            with os.scandir(shard_folder) as entries:
+                for entry in entries:
+                    page_idx, _, name = entry.name.partition('_')
+                    if not entry.name.endswith('.txt') or \
+                            not page_idx.isdigit():
+                        continue
+                    path = os.path.join(folder,
+                                        f'{idx + int(page_idx)}_{name}')
+                    try:
+                        os.link(entry.path, path)
+                    except OSError:
+                        shutil.copyfile(entry.path, path)
+        idx = counts['index']
+
+    if writer is not None:
+        writer.close()
+    print(f'Merged {len(done)} shards: {idx} pages')
+    return counts
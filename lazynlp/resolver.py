@@ -0,0 +1,212 @@
+import collections
+import concurrent.futures
+import contextlib
+import ipaddress
+import socket
+import threading
+import time
+
+system_getaddrinfo = socket.getaddrinfo
+
+
+def resolve_host(host):
+    """ Return the IP addresses of host with the system resolver.
+    Raise socket.gaierror if it doesn't resolve.
+    """
+    infos = system_getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+def is_ip_address(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def get_address_family(address):
+    return socket.AF_INET6 if ':' in address else socket.AF_INET
+
+
+class DNSCache:
+    """ Cache of the IP addresses of hosts for the crawler, so each host
+    is resolved once every ttl seconds instead of once per URL.
+
+    Hosts that don't resolve are remembered for negative_ttl seconds, see
+    failed. Lookups are done in a pool of workers threads, and concurrent
+    lookups of the same host wait for the same result. prefetch starts the
+    lookup of a host without waiting for it, see prefetch_links.
+
+    resolver: function that takes a host and returns the list of its IP
+        addresses, or raises socket.gaierror if it doesn't resolve.
+        By default resolve_host, the system resolver, which doesn't give
+        the TTL of records, hence the fixed ttl. Tests can pass a fake one.
+
+    The threaded crawler uses the cache through installed(), which makes
+    socket.getaddrinfo go through the cache, so that urllib and requests
+    use it. The asyncio crawler gives aiohttp a resolver that uses the
+    cache instead, see CacheResolver. Calls from the resolver itself
+    bypass the cache.
+    """
+
+    # the installed caches, the last one answers socket.getaddrinfo,
+    # and the getaddrinfo to restore once none is installed
+    installed_caches = []
+    install_lock = threading.Lock()
+    previous_getaddrinfo = None
+    # set in the threads that look up a host, for any cache
+    local = threading.local()
+
+    def __init__(self, resolver=None, ttl=300, negative_ttl=60, workers=32,
+                 max_hosts=2**18):
+        self.resolver = resolver or resolve_host
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_hosts = max_hosts
+        self.hosts = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.lookups = 0
+        self.hits = 0
+
+    def lookup(self, host, entry):
+        """ Resolve host in a worker, and set when entry, [future, expiry],
+        expires.
+        """
+        self.local.resolving = True
+        try:
+            addresses = self.resolver(host)
+            if not addresses:
+                raise socket.gaierror(socket.EAI_NONAME,
+                                      f'No address for {host}')
+        except socket.gaierror:
+            entry[1] = time.monotonic() + self.negative_ttl
+            raise
+        except Exception:
+            # not an answer, so don't cache it
+            entry[1] = 0
+            raise
+        finally:
+            self.local.resolving = False
+        entry[1] = time.monotonic() + self.ttl
+        return addresses
+
+    def prefetch(self, host):
+        """ Start resolving host if it isn't cached.
+        Return a concurrent.futures.Future of its IP addresses.
+        """
+        if is_ip_address(host):
+            future = concurrent.futures.Future()
+            future.set_result([host])
+            return future
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry is not None and (not entry[0].done()
+                                      or time.monotonic() < entry[1]):
+                self.hosts.move_to_end(host)
+                self.hits += 1
+                return entry[0]
+            entry = [None, float('inf')]
+            self.hosts[host] = entry
+            if len(self.hosts) > self.max_hosts:
+                self.hosts.popitem(last=False)
+            self.lookups += 1
+            entry[0] = self.pool.submit(self.lookup, host, entry)
+            return entry[0]
+
+    def resolve(self, host):
+        """ Return the IP addresses of host.
+        Raise socket.gaierror if it doesn't resolve.
+        """
+        return self.prefetch(host).result()
+
+    def failed(self, host):
+        """ Return True if host is known not to resolve.
+        Never waits for a lookup.
+        """
+        with self.lock:
+            entry = self.hosts.get(host)
+        if entry is None or not entry[0].done():
+            return False
+        return isinstance(entry[0].exception(), socket.gaierror)
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """ Same as socket.getaddrinfo, for TCP connections to host names,
+        through the cache.
+        """
+        if isinstance(port, str) and port.isdigit():
+            port = int(port)
+        # a resolver that calls socket.getaddrinfo would wait for its
+        # own lookup, so it gets the system's answer
+        # AI_ADDRCONFIG, as aiohttp passes, only filters out address
+        # families the host can't connect with, so it's ignored
+        if getattr(self.local, 'resolving', False) or \
+                not isinstance(host, str) or is_ip_address(host) or \
+                flags & ~socket.AI_ADDRCONFIG or \
+                type not in (0, socket.SOCK_STREAM) or \
+                not (port is None or isinstance(port, int)):
+            return system_getaddrinfo(host, port, family, type, proto, flags)
+
+        infos = []
+        for address in self.resolve(host):
+            address_family = get_address_family(address)
+            if address_family == socket.AF_INET6:
+                sockaddr = (address, port or 0, 0, 0)
+            else:
+                sockaddr = (address, port or 0)
+            if family in (0, socket.AF_UNSPEC, address_family):
+                infos.append((address_family, socket.SOCK_STREAM,
+                              socket.IPPROTO_TCP, '', sockaddr))
+        if not infos:
+            raise socket.gaierror(socket.EAI_NONAME,
+                                  f'No address of family {family} for {host}')
+        return infos
+
+    @contextlib.contextmanager
+    def installed(self):
+        """ Resolve host names through the cache in this process
+        while in the with block.
+
+        Caches can be installed by several threads at once, and leave in
+        any order: the last installed cache that is still in its with
+        block answers, and socket.getaddrinfo is restored when the last
+        one leaves.
+        """
+        with DNSCache.install_lock:
+            if not DNSCache.installed_caches:
+                DNSCache.previous_getaddrinfo = socket.getaddrinfo
+                socket.getaddrinfo = installed_getaddrinfo
+            DNSCache.installed_caches.append(self)
+        try:
+            yield self
+        finally:
+            with DNSCache.install_lock:
+                caches = DNSCache.installed_caches
+                del caches[len(caches) - 1 - caches[::-1].index(self)]
+                if not caches:
+                    socket.getaddrinfo = DNSCache.previous_getaddrinfo
+                    DNSCache.previous_getaddrinfo = None
+
+    def report(self):
+        with self.lock:
+            failed = sum(1 for future, _ in self.hosts.values()
+                         if future.done() and
+                         isinstance(future.exception(), socket.gaierror))
+        print(f'DNS: {self.lookups} lookups, {self.hits} cache hits, '
+              f'{failed} hosts not resolved')
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+def installed_getaddrinfo(*args, **kwargs):
+    """ socket.getaddrinfo while DNSCaches are installed, through the last
+    installed one
+    """
+    with DNSCache.install_lock:
+        caches = DNSCache.installed_caches
+        cache = caches[-1] if caches else None
+    if cache is None:
+        return system_getaddrinfo(*args, **kwargs)
+    return cache.getaddrinfo(*args, **kwargs)
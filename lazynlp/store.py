@@ -0,0 +1,329 @@
+import collections
+import glob
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+
+def get_shard_file(folder, shard, prefix='pages'):
+    return os.path.join(folder, f'{prefix}_{shard:05d}.jsonl.gz')
+
+
+def get_index_file(shard_file):
+    return shard_file[:-len('.jsonl.gz')] + '.idx'
+
+
+def list_shards(folder, prefix='pages'):
+    """ Return the paths of all shards in folder, in order
+    """
+    return sorted(glob.glob(os.path.join(folder, f'{prefix}_*.jsonl.gz')))
+
+
+def get_index_line(idx, offset, length, txt, link):
+    return f'{idx}\t{offset}\t{length}\t{len(txt)}\t{link}\n'
+
+
+def scan_shard(shard_file, buffer_size=2**20):
+    """ Yield the offset, length and record of each page in the shard,
+    read from its gzip members. Stop at a page cut short.
+    """
+    with open(shard_file, 'rb') as f:
+        offset = 0
+        data = b''
+        while True:
+            if not data:
+                data = f.read(buffer_size)
+                if not data:
+                    return
+            decompressor = zlib.decompressobj(31)
+            chunks = []
+            length = 0
+            try:
+                while True:
+                    chunks.append(decompressor.decompress(data))
+                    length += len(data) - len(decompressor.unused_data)
+                    if decompressor.eof:
+                        data = decompressor.unused_data
+                        break
+                    data = f.read(buffer_size)
+                    if not data:
+                        return
+                record = json.loads(b''.join(chunks))
+            except (zlib.error, ValueError):
+                return
+            yield offset, length, record
+            offset += length
+
+
+def rebuild_index(shard_file):
+    """ Write the index of shard_file from its pages, and cut a page
+    written only in part from the end of the shard.
+    Return the number of pages.
+    """
+    count, end = 0, 0
+    with open(get_index_file(shard_file), 'w') as index:
+        for offset, length, record in scan_shard(shard_file):
+            index.write(get_index_line(record['idx'], offset, length,
+                                       record['text'], record['url']))
+            count, end = count + 1, offset + length
+    if os.path.getsize(shard_file) > end:
+        with open(shard_file, 'rb+') as f:
+            f.truncate(end)
+    return count
+
+
+def count_pages(shard_file):
+    """ Return the number of pages in shard_file.
+    If its index is missing or doesn't cover the whole shard, e.g. after a
+    crash between writing a page and its index line, rebuild it.
+    """
+    index_file = get_index_file(shard_file)
+    if os.path.exists(index_file):
+        count, end = 0, 0
+        with open(index_file, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                _, offset, length, _ = line.split('\t', 3)
+                count, end = count + 1, int(offset) + int(length)
+            else:
+                if end == os.path.getsize(shard_file):
+                    return count
+    print('Rebuild index of', shard_file)
+    return rebuild_index(shard_file)
+
+
+class ShardWriter:
+    """ Append pages to rotating shards instead of one file per page.
+
+    Shards are folder/[prefix]_[shard].jsonl.gz, each containing up to
+    shard_size pages. Each page is a JSON record:
+        {"idx": .., "url": .., "time": .., "text": ..}
+    compressed as its own gzip member, so a shard is a valid gzip file
+    that can be read with gzip.open or zcat, and a page can be read
+    by seeking to its offset.
+
+    Each shard has a sidecar index folder/[prefix]_[shard].idx with one line
+    per page:
+        [idx][tab][offset][tab][length][tab][number of chars][tab][url]
+    where offset and length are the byte range of the page in the shard.
+    If the index of the last shard is missing or incomplete when the writer
+    starts, it's rebuilt from the shard, see count_pages.
+    """
+
+    def __init__(self, folder, shard_size=100000, prefix='pages',
+                 compresslevel=6):
+        self.folder = folder
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.compresslevel = compresslevel
+        shards = list_shards(folder, prefix)
+        self.shard = len(shards) - 1 if shards else 0
+        self.count = count_pages(shards[-1]) if shards else 0
+        self.out = None
+        self.index = None
+
+    def open(self):
+        shard_file = get_shard_file(self.folder, self.shard, self.prefix)
+        self.out = open(shard_file, 'ab')
+        self.index = open(get_index_file(shard_file), 'a')
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.index.close()
+            self.out, self.index = None, None
+
+    def write(self, idx, link, txt, timestamp=None):
+        if self.count >= self.shard_size:
+            self.close()
+            self.shard += 1
+            self.count = 0
+        if self.out is None:
+            self.open()
+
+        if timestamp is None:
+            timestamp = time.time()
+        record = {'idx': idx, 'url': link, 'time': timestamp, 'text': txt}
+        data = gzip.compress((json.dumps(record) + '\n').encode(),
+                             compresslevel=self.compresslevel)
+        offset = self.out.tell()
+        self.out.write(data)
+        self.index.write(get_index_line(idx, offset, len(data), txt, link))
+        self.count += 1
+
+    def state(self):
+        """ Return what's needed to restore the shards to this point
+        """
+        if self.out is not None:
+            self.out.flush()
+            self.index.flush()
+        shard_file = get_shard_file(self.folder, self.shard, self.prefix)
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0
+                 for path in [shard_file, get_index_file(shard_file)]]
+        return {'shard': self.shard,
+                'count': self.count,
+                'size': sizes[0],
+                'index_size': sizes[1]}
+
+    def restore(self, state, idx, closed=False, interval=0):
+        """ Truncate the shards to what they were when state was saved,
+        removing the pages written after that.
+        """
+        self.close()
+        if not state:
+            return
+        for shard_file in list_shards(self.folder, self.prefix):
+            shard = int(shard_file[:-len('.jsonl.gz')].rsplit('_', 1)[1])
+            if shard > state['shard']:
+                os.remove(shard_file)
+                if os.path.exists(get_index_file(shard_file)):
+                    os.remove(get_index_file(shard_file))
+
+        self.shard, self.count = state['shard'], state['count']
+        shard_file = get_shard_file(self.folder, self.shard, self.prefix)
+        for path, size in [(shard_file, state['size']),
+                           (get_index_file(shard_file), state['index_size'])]:
+            if os.path.exists(path):
+                with open(path, 'rb+') as f:
+                    f.truncate(size)
+
+
+class ShardFile:
+    """ A shard shared by the Documents in it, so that it's opened once
+    instead of once per document.
+
+    The file is opened when a document is first read. At most max_open
+    shards are kept open, the least recently read ones are closed and
+    opened again when needed. It can be pickled to send documents to
+    other processes, which open the shard themselves.
+    """
+
+    max_open = 64
+    opened = collections.OrderedDict()
+    opened_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.path, 'rb')
+            self.f.seek(offset)
+            data = self.f.read(length)
+        self.touch()
+        return data
+
+    def touch(self):
+        """ Mark the shard as the most recently read one, and close the
+        least recently read ones if too many are open.
+        """
+        with ShardFile.opened_lock:
+            ShardFile.opened[id(self)] = self
+            ShardFile.opened.move_to_end(id(self))
+            while len(ShardFile.opened) > ShardFile.max_open:
+                _, shard = ShardFile.opened.popitem(last=False)
+                shard.close()
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+class Document:
+    """ A page stored in a shard. The text is only read when needed.
+
+    Functions that take files, such as build_ngram, estimate_overlap_bf,
+    file_stats and filter_files, also take documents. Like a page file,
+    the first line of a document is the URL.
+
+    shard: the ShardFile to read from, shared with the other documents
+        of the shard, as in get_documents. By default, the shard is
+        opened for each read.
+    """
+
+    def __init__(self, shard_file, idx, offset, length, size, url,
+                 shard=None):
+        self.shard_file = shard_file
+        self.idx = idx
+        self.offset = offset
+        self.length = length
+        self.size = size
+        self.url = url
+        self.shard = shard
+
+    def __str__(self):
+        return f'{self.shard_file}:{self.idx}'
+
+    def read(self):
+        """ Return the record of the document
+        """
+        if self.shard is not None:
+            data = self.shard.read(self.offset, self.length)
+        else:
+            with open(self.shard_file, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(self.length)
+        return json.loads(gzip.decompress(data))
+
+    def lines(self):
+        txt = self.read()['text']
+        yield self.url + '\n'
+        yield from io.StringIO(txt)
+
+
+def read_shard(shard_file):
+    """ Stream the records of a shard in order
+    """
+    with gzip.open(shard_file, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def read_pages(folder, prefix='pages'):
+    """ Stream the records of all the shards in folder
+    """
+    for shard_file in list_shards(folder, prefix):
+        yield from read_shard(shard_file)
+
+
+def read_shard_index(shard_file):
+    """ Yield a Document for each page in the shard.
+    The documents share one ShardFile.
+    """
+    shard = ShardFile(shard_file)
+    with open(get_index_file(shard_file), 'r') as f:
+        for line in f:
+            idx, offset, length, size, url = line.rstrip('\n').split('\t', 4)
+            yield Document(shard_file,
+                           int(idx),
+                           int(offset),
+                           int(length),
+                           int(size),
+                           url,
+                           shard)
+
+
+def get_documents(folder, prefix='pages'):
+    """ Return the list of Documents of all the shards in folder.
+    Only the indices are read, so it's cheap even for millions of pages.
+    """
+    documents = []
+    for shard_file in list_shards(folder, prefix):
+        documents.extend(read_shard_index(shard_file))
+    return documents
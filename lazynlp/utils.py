@@ -61,12 +61,30 @@ def get_english_alphabet():
     return set([chr(i) for i in range(ord('a'), ord('z') + 1)])
 
 
+def read_lines(file):
+    """ Yield the lines of file.
+    file is either a path or a document with a lines() method,
+    such as store.Document
+    """
+    if isinstance(file, str):
+        with open(file, 'r') as f:
+            yield from f
+    else:
+        yield from file.lines()
+
+
+def get_size(file):
+    if isinstance(file, str):
+        return os.path.getsize(file)
+    return file.size
+
+
 def sort_files_by_size(files):
     pairs = []
     for file in files:
-        size = os.path.getsize(file)
-        pairs.append((size, file))
-    return sorted(pairs, reverse=True)
+        size = get_size(file)
+        pairs.append((size, str(file), file))
+    return [(size, file) for size, _, file in sorted(pairs, reverse=True)]
 
 
 def get_filename(path):
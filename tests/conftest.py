@@ -0,0 +1,9 @@
+import pytest
+
+from .server import LocalServer
+
+
+@pytest.fixture
+def server():
+    with LocalServer(slow=3) as local_server:
+        yield local_server
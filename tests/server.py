@@ -0,0 +1,139 @@
+import asyncio
+import collections
+import socket
+import threading
+
+from aiohttp import web
+
+PARAGRAPH = ('It was the best of times, it was the worst of times, it was '
+             'the age of wisdom, it was the age of foolishness, it was the '
+             'epoch of belief, it was the epoch of incredulity, it was the '
+             'season of Light, it was the season of Darkness, it was the '
+             'spring of hope, it was the winter of despair, and this is {} '
+             'paragraph {}.')
+
+
+def get_page(path):
+    paragraphs = ''.join(f'<p>{PARAGRAPH.format(path, i)}</p>'
+                         for i in range(5))
+    return f'<html><body>{paragraphs}</body></html>'
+
+
+class LocalServer:
+    """ aiohttp server on 127.0.0.1, running in a thread, standing in for
+    the web in the crawler tests.
+
+    files maps paths to the bodies to serve. Other paths are:
+        /page/..: an HTML page with a few paragraphs of English
+        /empty/..: an HTML page without text
+        /slow/..: a page, sent after slow seconds
+        anything else: 404
+
+    hits counts the requests to each path. If set, hook is called with
+    the path of each request before answering it.
+    """
+
+    def __init__(self, files=None, slow=5):
+        self.files = files or {}
+        self.slow = slow
+        self.hits = collections.Counter()
+        self.hook = None
+        self.loop = None
+        self.runner = None
+        self.thread = None
+        self.port = None
+
+    async def handle(self, request):
+        path = request.path
+        self.hits[path] += 1
+        if self.hook is not None:
+            self.hook(path)
+        if path in self.files:
+            return web.Response(text=self.files[path])
+        kind = path.split('/')[1]
+        if kind == 'slow':
+            await asyncio.sleep(self.slow)
+        if kind in ('page', 'slow'):
+            return web.Response(text=get_page(path), content_type='text/html')
+        if kind == 'empty':
+            return web.Response(text='<html></html>',
+                                content_type='text/html')
+        return web.Response(status=404)
+
+    async def setup(self, sock):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.SockSite(self.runner, sock).start()
+
+    def start(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.setup(sock), self.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def url(self, path, host='127.0.0.1'):
+        return f'http://{host}:{self.port}{path}'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class SocketServer:
+    """ TCP server on 127.0.0.1 that reads each request and then calls
+    behavior with the connection, to stand in for broken web servers.
+    """
+
+    def __init__(self, behavior):
+        self.behavior = behavior
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,),
+                             daemon=True).start()
+
+    def handle(self, conn):
+        conn.settimeout(5)
+        data = b''
+        try:
+            while b'\r\n\r\n' not in data:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            self.behavior(conn)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def url(self, path='/x'):
+        return f'http://127.0.0.1:{self.port}{path}'
+
+    def close(self):
+        self.sock.close()
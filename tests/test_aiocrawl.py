@@ -0,0 +1,98 @@
+import glob
+import os
+import threading
+
+import lazynlp
+import lazynlp.aiocrawl
+
+
+def read_status(folder, name):
+    with open(os.path.join(folder, f'{name}.urls'), 'r') as f:
+        return f.read().split()
+
+
+def read_page_files(folder):
+    """ Return {idx: (url, text)} of the page files in folder
+    """
+    pages = {}
+    for path in glob.glob(os.path.join(folder, '*.txt')):
+        idx = int(os.path.basename(path).split('_')[0])
+        with open(path, 'r') as f:
+            url, _, txt = f.read().partition('\n')
+        pages[idx] = (url, txt)
+    return pages
+
+
+def write_links(path, links):
+    with open(path, 'a') as f:
+        f.write('\n'.join(links) + '\n')
+
+
+def crawl(link_file, folder, **kwargs):
+    lazynlp.download_pages(link_file, folder, concurrency=4, timeout=1,
+                           **kwargs)
+
+
+def test_crawl(server, tmp_path):
+    pages = [server.url(f'/page/{i}') for i in range(5)]
+    links = pages + [server.url('/missing/1'),
+                     server.url('/slow/1'),
+                     server.url('/empty/1'),
+                     server.url('/book.pdf'),
+                     '']
+    write_links(tmp_path / 'links.txt', links)
+    crawl(tmp_path / 'links.txt', tmp_path / 'out')
+
+    out = tmp_path / 'out'
+    assert sorted(read_status(out, 'index')) == sorted(pages)
+    assert read_status(out, 'bad') == [server.url('/missing/1')]
+    assert read_status(out, 'connection') == [server.url('/slow/1')]
+    assert read_status(out, 'empty') == [server.url('/empty/1')]
+    assert read_status(out, 'skip') == [server.url('/book.pdf')]
+    assert server.hits['/book.pdf'] == 0
+
+    page_files = read_page_files(out)
+    assert sorted(page_files) == list(range(5))
+    index = read_status(out, 'index')
+    for idx, (url, txt) in page_files.items():
+        assert url == index[idx]
+        assert 'best of times' in txt
+
+
+def test_resume(server, tmp_path):
+    link_file = tmp_path / 'links.txt'
+    first = [server.url(f'/page/{i}') for i in range(4)]
+    write_links(link_file, first)
+    crawl(link_file, tmp_path / 'out')
+
+    second = [server.url(f'/page/{i}') for i in range(4, 7)]
+    write_links(link_file, second)
+    crawl(link_file, tmp_path / 'out')
+
+    assert all(server.hits[f'/page/{i}'] == 1 for i in range(7))
+    index = read_status(tmp_path / 'out', 'index')
+    assert sorted(index) == sorted(first + second)
+    assert sorted(read_page_files(tmp_path / 'out')) == list(range(7))
+
+
+def test_worker_failure_stops_crawl(server, tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('cleaner crashed')
+
+    monkeypatch.setattr(lazynlp.aiocrawl, 'timed_clean_page', fail)
+    write_links(tmp_path / 'links.txt',
+                [server.url(f'/page/{i}') for i in range(50)])
+
+    errors = []
+
+    def run():
+        try:
+            crawl(tmp_path / 'links.txt', tmp_path / 'out')
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), 'the crawl hangs'
+    assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
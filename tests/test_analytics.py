@@ -0,0 +1,215 @@
+from collections import Counter
+import functools
+import math
+import random
+import statistics
+
+import numpy as np
+import pytest
+
+import lazynlp
+from lazynlp.analytics import count_order
+
+
+def get_pair(rng, similarity, size=1000):
+    """ Return two sets of size random 64-bit hashes with Jaccard
+    similarity close to similarity.
+    """
+    shared = round(2 * size * similarity / (1 + similarity))
+    values = rng.integers(0, 2**64, size=2 * size - shared, dtype=np.uint64)
+    return values[:size], values[size - shared:]
+
+
+@pytest.mark.parametrize('similarity,matched', [(0.2, False), (0.3, False),
+                                                (0.4, False), (0.8, True),
+                                                (0.9, True)])
+def test_minhash_lsh(similarity, matched):
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        lsh = lazynlp.MinHashLSH(threshold=0.5)
+        hashes1, hashes2 = get_pair(rng, similarity)
+        lsh.insert(lazynlp.get_minhash(hashes1))
+        assert lsh.query(lazynlp.get_minhash(hashes2)) == matched
+
+
+def test_filter_files_minhash(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    words = [f'w{i}' for i in range(5000)]
+    text = [rng.choice(words) for _ in range(400)]
+    near = list(text)
+    for i in range(0, 400, 100):
+        near[i] = 'changed'
+    files = []
+    for name, tokens in [('a', text), ('b', near),
+                         ('c', [rng.choice(words) for _ in range(380)])]:
+        path = tmp_path / f'{name}.txt'
+        path.write_text(' '.join(tokens) + '\n')
+        files.append(str(path))
+
+    monkeypatch.chdir(tmp_path)
+    lazynlp.filter_files(files, method='minhash', workers=2)
+    dupped = (tmp_path / 'dupped_files.list').read_text().split()
+    clean = (tmp_path / 'clean_files.list').read_text().split()
+    assert len(dupped) == 1 and dupped[0] in files[:2]
+    assert files[2] in clean and len(clean) == 2
+
+
+def write_text(path, seed=0, lines=300):
+    rng = random.Random(seed)
+    words = ['the', 'a', 'cat', 'dog', 'sat', 'on', 'mat', 'ran', 'far']
+    with open(path, 'w') as f:
+        for _ in range(lines):
+            f.write(' '.join(rng.choices(words, [9, 8, 7, 6, 5, 4, 3, 2, 1],
+                                         k=rng.randint(0, 12))) + '\n')
+
+
+def read_counts(path):
+    with open(path, 'r') as f:
+        return [(ngram, int(count)) for ngram, count in
+                (line.rstrip('\n').rsplit('\t', 1) for line in f)]
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for seed in range(3):
+        path = str(tmp_path / f'{seed}.txt')
+        write_text(path, seed)
+        paths.append(path)
+    return paths
+
+
+def get_expected(files, n):
+    count = lazynlp.build_ngram(files[0], n=n, interval=0)
+    for file in files[1:]:
+        count.update(lazynlp.build_ngram(file, n=n, interval=0))
+    return sorted(count.items(), key=count_order)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_spilled_runs_sum_counts(files, tmp_path, monkeypatch, workers):
+    written = []
+    write_count_run = lazynlp.analytics.write_count_run
+
+    def spy(items, tmp_dir):
+        written.append(tmp_dir)
+        return write_count_run(items, tmp_dir)
+
+    monkeypatch.setattr(lazynlp.analytics, 'write_count_run', spy)
+    monkeypatch.setattr(lazynlp.analytics, 'reduce_runs',
+                        functools.partial(lazynlp.analytics.reduce_runs,
+                                          max_runs=2))
+    outfile = str(tmp_path / 'out' / 'counts.txt')
+    max_memory = 5 * lazynlp.analytics.NGRAM_ENTRY_SIZE * workers
+    lazynlp.count_ngrams(files, outfile, n=2, max_memory=max_memory,
+                         workers=workers)
+    if workers == 1:
+        assert len(written) > 100
+    assert read_counts(outfile) == get_expected(files, 2)
+
+
+def test_top_k(files, tmp_path):
+    outfile = str(tmp_path / 'top.txt')
+    max_memory = 5 * lazynlp.analytics.NGRAM_ENTRY_SIZE
+    lazynlp.count_ngrams(files, outfile, n=1, max_memory=max_memory,
+                         workers=1, top_k=4)
+    expected = get_expected(files, 1)
+    assert read_counts(outfile) == expected[:4]
+    assert [ngram for ngram, _ in expected[:4]] == ['the', 'a', 'cat', 'dog']
+
+    lazynlp.count_ngrams(files, outfile, n=2, max_memory=max_memory,
+                         workers=1, by_count=False)
+    assert read_counts(outfile) == sorted(get_expected(files, 2))
+
+
+def test_text_stats_merge(tmp_path):
+    rng = random.Random(0)
+    lines = [' '.join('w' * rng.randint(1, 9)
+                      for _ in range(rng.randint(0, 20))) for _ in range(500)]
+    single = lazynlp.TextStats()
+    for line in lines:
+        single.add_line(line)
+    merged = lazynlp.TextStats()
+    for i in range(0, len(lines), 70):
+        part = lazynlp.TextStats()
+        for line in lines[i:i + 70]:
+            part.add_line(line)
+        merged.update(part)
+    merged.update(lazynlp.TextStats())
+
+    lengths = [len(line.split()) for line in lines if line.split()]
+    assert single.lines == merged.lines == len(lengths) < len(lines)
+    for stats in [single, merged]:
+        assert stats.mean == pytest.approx(statistics.mean(lengths))
+        assert stats.stdev() == pytest.approx(statistics.stdev(lengths))
+        assert stats.median() == statistics.median(lengths)
+        assert stats.min_length() == min(lengths)
+        assert stats.max_length() == max(lengths)
+    assert merged.histogram == single.histogram
+    assert merged.average_chars() == single.average_chars()
+
+    files = []
+    for i in range(0, len(lines), 125):
+        path = tmp_path / f'{i}.txt'
+        path.write_text('\n'.join(lines[i:i + 125]) + '\n')
+        files.append(str(path))
+    mean, average_chars = lazynlp.file_stats(files, workers=2)
+    assert mean == pytest.approx(single.mean)
+    assert average_chars == single.average_chars()
+
+
+def test_text_stats_empty_lines():
+    stats = lazynlp.TextStats()
+    for line in ['', '   ', '\n', 'a bb', '\t\n', 'ccc']:
+        stats.add_line(line)
+    assert stats.lines == 2
+    assert stats.histogram == {2: 1, 1: 1}
+    assert stats.mean == 1.5 and stats.median() == 1.5
+    assert stats.average_chars() == 2
+    assert stats.min_length() == 1
+
+
+def get_exact_entropies(sequences, max_n):
+    """ Exact entropies in bits of the k-grams of sequences, for k = 1..max_n,
+    with k-grams not crossing sequences
+    """
+    entropies = []
+    for k in range(1, max_n + 1):
+        count = Counter(tuple(seq[i:i + k]) for seq in sequences
+                        for i in range(len(seq) - k + 1))
+        total = sum(count.values())
+        entropies.append(-sum(c / total * math.log2(c / total)
+                              for c in count.values()))
+    return entropies
+
+
+@pytest.mark.parametrize('gran', ['word', 'char'])
+def test_entropy_matches_exact(tmp_path, gran):
+    rng = random.Random(0)
+    # few distinct k-grams, so that they don't share hashed counters
+    words = ['ab', 'ba', 'c']
+    lines = [' '.join(rng.choices(words, [3, 2, 1],
+                                  k=rng.randint(0, 8))) for _ in range(300)]
+    if gran == 'word':
+        sequences = [line.split() for line in lines if line]
+    else:
+        sequences = [line for line in lines if line]
+    exact = get_exact_entropies(sequences, 4)
+    conditional = [h - prev for h, prev in zip(exact, [0.0] + exact)]
+
+    counter = lazynlp.EntropyCounter(max_n=4, gran=gran)
+    counter.add_lines(sequences[:100])
+    other = lazynlp.EntropyCounter(max_n=4, gran=gran)
+    other.add_lines(sequences[100:])
+    counter.update(other)
+    assert counter.entropies() == pytest.approx(exact)
+    assert counter.conditional_entropies() == pytest.approx(conditional)
+
+    files = []
+    for i in range(0, len(lines), 100):
+        path = tmp_path / f'{i}.txt'
+        path.write_text('\n'.join(lines[i:i + 100]) + '\n')
+        files.append(str(path))
+    assert lazynlp.estimate_entropy(files, gran=gran, max_n=4, workers=2,
+                                    batch_size=7) == \
+        pytest.approx(conditional)
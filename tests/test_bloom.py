@@ -0,0 +1,69 @@
+import numpy as np
+
+import lazynlp
+
+
+def get_hashes(seed, size):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 2**64, size=size, dtype=np.uint64)
+
+
+def test_scalar_matches_batch(tmp_path):
+    hashes = get_hashes(0, 2000)
+    scalar = lazynlp.MmapBloomFilter.create(str(tmp_path / 'scalar.bf'),
+                                            capacity=1000, error_rate=0.01)
+    batch = lazynlp.MmapBloomFilter.create(str(tmp_path / 'batch.bf'),
+                                           capacity=1000, error_rate=0.01)
+    for h in hashes[:1000].tolist():
+        scalar.add(h)
+    batch.add_many(hashes[:1000])
+    assert np.array_equal(scalar.bits, batch.bits)
+    assert len(scalar) == len(batch) == 1000
+
+    found = batch.contains_many(hashes)
+    assert found.tolist() == [h in scalar for h in hashes.tolist()]
+    assert found[:1000].all()
+    # some of the other 1000 are false positives, at about error_rate
+    assert found[1000:].sum() < 50
+
+
+def test_reopen_keeps_keys(tmp_path):
+    path = str(tmp_path / 'ngrams.bf')
+    hashes = get_hashes(1, 20000)
+    bf = lazynlp.MmapBloomFilter.create(path, capacity=20000)
+    bf.add_many(hashes[:10000])
+    bf.add('a string')
+    bf.close()
+
+    bf = lazynlp.MmapBloomFilter.open_or_create(path)
+    assert len(bf) == 10001
+    assert bf.contains_many(hashes[:10000]).all()
+    assert 'a string' in bf
+    bf.add_many(hashes[10000:])
+    bf.close()
+
+    bf = lazynlp.MmapBloomFilter.open(path, readonly=True)
+    assert len(bf) == 20001
+    assert bf.contains_many(hashes).all()
+    assert all(h in bf for h in hashes[::100].tolist())
+    bf.close()
+
+
+def test_no_false_negatives(tmp_path):
+    keys = [f'n-gram {i}' for i in range(5000)]
+    hashes = get_hashes(2, 50000)
+    # a filter filled past its capacity still has no false negatives
+    bf = lazynlp.MmapBloomFilter.create(str(tmp_path / 'full.bf'),
+                                        capacity=1000, error_rate=0.01)
+    for key in keys:
+        bf.add(key)
+    for i in range(0, len(hashes), 4096):
+        bf.add_many(hashes[i:i + 4096])
+    assert all(key in bf for key in keys)
+    assert bf.contains_many(hashes).all()
+
+    other = lazynlp.MmapBloomFilter.create(str(tmp_path / 'other.bf'),
+                                           capacity=1000, error_rate=0.01)
+    other.update(bf)
+    assert all(key in other for key in keys)
+    assert other.contains_many(hashes).all()
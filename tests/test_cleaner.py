@@ -0,0 +1,52 @@
+import codecs
+
+import lxml.html
+import pytest
+
+import lazynlp
+
+TEXT = 'It was the best of times, it was the worst of times – Dickens'
+
+
+@pytest.mark.parametrize('charset', ['utf-16', 'UTF-16LE', 'utf-16be',
+                                     'utf-32'])
+def test_utf16_declaration_without_bom(charset):
+    page = (f'<html><head><meta charset="{charset}"></head>'
+            f'<body><p>{TEXT}</p></body></html>').encode('utf-8')
+    assert lazynlp.get_declared_encoding(page) == 'utf-8'
+    assert lazynlp.decode_page(page)[0] == page.decode('utf-8')
+
+    content_type = f'text/html; charset={charset}'
+    assert lazynlp.get_declared_encoding(page, content_type) == 'utf-8'
+    assert lazynlp.decode_page(page, content_type)[1] == 'utf-8'
+
+
+@pytest.mark.parametrize('bom,encoding', [(codecs.BOM_UTF16_LE, 'utf-16-le'),
+                                          (codecs.BOM_UTF16_BE, 'utf-16-be')])
+def test_utf16_bom(bom, encoding):
+    page = bom + f'<p>{TEXT}</p>'.encode(encoding)
+    assert lazynlp.get_declared_encoding(page, 'text/html; charset=utf-8') \
+        == 'utf-16'
+    assert lazynlp.decode_page(page)[0] == f'<p>{TEXT}</p>'
+
+
+def test_latin1_declaration():
+    page = f'<meta charset="iso-8859-1"><p>{TEXT}</p>'.encode('cp1252')
+    assert lazynlp.decode_page(page) == (page.decode('cp1252'), 'cp1252')
+
+
+def test_paragraph_with_comment():
+    page = ('<html><body><p>It was the best of times, <!-- note --> it was '
+            'the worst <?pi x?>of times, <a>it <!-- c -->was</a> the age of '
+            'wisdom<script>var a;</script>.</p></body></html>')
+    doc = lxml.html.document_fromstring(page)
+    assert list(lazynlp.get_paragraphs(doc)) == [
+        ('It was the best of times,  it was the worst of times, it was '
+         'the age of wisdom.', 6)]
+
+
+def test_unprintable_lone_surrogate():
+    txt = b'caf\xe9 \xc3\xa9t\xc3\xa9\x07'.decode('utf-8', 'surrogateescape')
+    assert lazynlp.find_unprintable(txt) == {'é': 2, '\udce9': 1, '\x07': 1}
+    assert lazynlp.replace_unprintable(txt) == 'caf ete'
+    assert lazynlp.replace_unprintable(txt, 'keep') == txt
@@ -0,0 +1,150 @@
+import socket
+import struct
+import time
+
+import pytest
+
+import lazynlp
+
+from .server import SocketServer
+
+
+def close(conn):
+    pass
+
+
+def reset(conn):
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+
+
+def stall(conn):
+    time.sleep(3)
+
+
+def stall_body(conn):
+    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nabc')
+    time.sleep(3)
+
+
+def short_body(conn):
+    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nabc')
+
+
+def garbage(conn):
+    conn.sendall(b'garbage\r\n\r\n')
+
+
+def not_found(conn):
+    conn.sendall(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+
+
+def ok(conn):
+    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+
+@pytest.mark.parametrize('behavior', [close, reset, stall, stall_body,
+                                      short_body, garbage, not_found, ok])
+def test_session_codes_match_urllib(behavior):
+    server = SocketServer(behavior)
+    ctx = lazynlp.get_ssl_context()
+    session = lazynlp.get_session(context=ctx)
+    try:
+        expected = lazynlp.fetch_page(server.url(), ctx, 1)[0]
+        assert lazynlp.fetch_page(server.url(), ctx, 1, session)[0] == expected
+    finally:
+        session.close()
+        server.close()
+
+
+def get_refused_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f'http://127.0.0.1:{port}/x'
+
+
+@pytest.mark.parametrize('link', ['refused', 'http://[::1/x', 'foo',
+                                  'ftp://example.com/x',
+                                  'http://a b.com/x', 'http://a..com/x'])
+def test_session_url_errors_match_urllib(link):
+    if link == 'refused':
+        link = get_refused_url()
+    ctx = lazynlp.get_ssl_context()
+    session = lazynlp.get_session(context=ctx)
+    try:
+        expected = lazynlp.fetch_page(link, ctx, 1)[0]
+        assert lazynlp.fetch_page(link, ctx, 1, session)[0] == expected
+    finally:
+        session.close()
+
+
+@pytest.mark.parametrize('mode', [{}, {'concurrency': 1}])
+def test_refused_host_trips_breaker(tmp_path, mode):
+    link = get_refused_url()
+    links = [f'{link}{i}' for i in range(4)]
+    link_file = tmp_path / 'links.urls'
+    link_file.write_text('\n'.join(links) + '\n')
+
+    def crawl(folder, **kwargs):
+        lazynlp.download_pages(str(link_file), str(folder), timeout=1,
+                               **mode, **kwargs)
+        return {name: (folder / f'{name}.urls').read_text().split()
+                for name in ['bad', 'connection']}
+
+    assert crawl(tmp_path / 'off') == {'bad': links, 'connection': []}
+    assert crawl(tmp_path / 'on', max_failures=2) == {
+        'bad': links[:2], 'connection': links[2:]}
+
+
+def test_resume_removes_pages_past_checkpoint(tmp_path):
+    """ Concurrent crawls can write more than interval pages after the last
+    checkpoint before they stop, all of them are crawled again.
+    """
+    link_file = tmp_path / 'links.urls'
+    link_file.write_text('')
+    folder = tmp_path / 'out'
+    log = lazynlp.CrawlLog(str(folder), str(link_file), interval=2)
+    log.open()
+    for i in range(2):
+        log.write_page(f'http://example.com/{i}', 'text')
+    log.save()
+    for i in range(2, 7):
+        log.write_page(f'http://example.com/{i}', 'text')
+    # stop without closing the log, as a crawl that crashes
+    for f in log.status_files.values():
+        f.close()
+
+    log = lazynlp.CrawlLog(str(folder), str(link_file), interval=2)
+    log.open().close()
+    log.close()
+    pages = sorted(path.name.split('_')[0] for path in folder.glob('*.txt'))
+    assert pages == ['0', '1']
+
+
+def test_resume_after_clean_run_then_crash(tmp_path):
+    link_file = tmp_path / 'links.urls'
+    link_file.write_text('')
+    folder = tmp_path / 'out'
+    log = lazynlp.CrawlLog(str(folder), str(link_file), interval=100)
+    log.open().close()
+    for i in range(2):
+        log.write_page(f'http://example.com/{i}', 'text')
+    log.close()
+
+    log = lazynlp.CrawlLog(str(folder), str(link_file), interval=100)
+    log.open().close()
+    for i in range(2, 5):
+        log.write_page(f'http://example.com/{i}', 'text')
+    # crash before the first checkpoint of the second run
+    for f in log.status_files.values():
+        f.close()
+
+    log = lazynlp.CrawlLog(str(folder), str(link_file), interval=100)
+    log.open().close()
+    log.close()
+    pages = sorted(path.name.split('_')[0] for path in folder.glob('*.txt'))
+    assert pages == ['0', '1']
+    assert (folder / 'index.urls').read_text().split() == [
+        'http://example.com/0', 'http://example.com/1']
@@ -0,0 +1,91 @@
+import gzip
+
+import pytest
+
+import lazynlp
+
+
+def write_files(tmp_path, files=4, lines=500, repeated=True):
+    """ Write files of distinct lines, then a blank line and
+    a line repeated in every file.
+    """
+    paths = []
+    for i in range(files):
+        path = tmp_path / f'{i}.txt'
+        text = ''.join(f'file {i} line {j}\n' for j in range(lines))
+        if repeated:
+            text += '\nrepeated\n'
+        path.write_text(text)
+        paths.append(str(path))
+    return paths
+
+
+def read_splits(outfold, compress=False):
+    splits = {}
+    for split in lazynlp.create.SPLITS:
+        if compress:
+            with gzip.open(outfold / f'{split}.txt.gz', 'rt') as f:
+                splits[split] = f.read().splitlines()
+        else:
+            splits[split] = (outfold / f'{split}.txt').read_text().splitlines()
+    return splits
+
+
+def test_same_seed_same_split(tmp_path):
+    files = write_files(tmp_path)
+    for name in ['a', 'b']:
+        lazynlp.partition(files, str(tmp_path / name), 0.2, 0.1, seed=1)
+    lazynlp.partition(files, str(tmp_path / 'c'), 0.2, 0.1, seed=2)
+    a = read_splits(tmp_path / 'a')
+    assert read_splits(tmp_path / 'b') == a
+    assert read_splits(tmp_path / 'c') != a
+    assert sorted(sum(a.values(), [])) == sorted(
+        line for file in files for line in open(file).read().splitlines()
+        if line)
+    # the same line always goes to the same split
+    assert sum(a[split].count('repeated') in [0, 4]
+               for split in a) == 3
+
+
+@pytest.mark.parametrize('valid_size,test_size,expected',
+                         [(50, 30, [1920, 50, 30]),
+                          (0.2, 30, [None, None, 30]),
+                          (50, 0.1, [None, 50, None]),
+                          (50, -1, [1950, 50, 0]),
+                          (1990, 20, [0, 1990, 10])])
+def test_integer_sizes(tmp_path, valid_size, test_size, expected):
+    files = write_files(tmp_path, repeated=False)
+    counts = lazynlp.partition(files, str(tmp_path / 'out'),
+                               test_size=test_size, valid_size=valid_size)
+    assert sum(counts) == 2000
+    for count, size in zip(counts, expected):
+        if size is not None:
+            assert count == size
+
+
+def test_fraction_sizes(tmp_path):
+    files = write_files(tmp_path, lines=5000)
+    train, valid, test = lazynlp.partition(files, str(tmp_path / 'out'),
+                                           test_size=0.1, valid_size=0.2)
+    total = train + valid + test
+    assert abs(valid / total - 0.2) < 0.01
+    assert abs(test / total - 0.1) < 0.01
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('valid_size,by_document', [(0.3, False),
+                                                    (100, False),
+                                                    (2, True)])
+def test_workers_match_serial(tmp_path, compress, valid_size, by_document):
+    files = write_files(tmp_path)
+    serial = lazynlp.partition(files, str(tmp_path / 'serial'), 0.1,
+                               valid_size, by_document=by_document,
+                               compress=compress)
+    parallel = lazynlp.partition(files, str(tmp_path / 'parallel'), 0.1,
+                                 valid_size, by_document=by_document,
+                                 compress=compress, workers=2)
+    assert parallel == serial
+    serial = read_splits(tmp_path / 'serial', compress)
+    parallel = read_splits(tmp_path / 'parallel', compress)
+    assert {split: sorted(lines) for split, lines in parallel.items()} == \
+        {split: sorted(lines) for split, lines in serial.items()}
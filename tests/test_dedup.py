@@ -0,0 +1,117 @@
+import os
+import random
+
+import pytest
+
+import lazynlp
+
+
+def read_outputs(outfold):
+    outputs = {}
+    for name in sorted(os.listdir(outfold)):
+        with open(os.path.join(outfold, name), 'rb') as f:
+            outputs[name] = f.read()
+    return outputs
+
+
+@pytest.mark.parametrize('chunk_size', [2**26, 4])
+def test_parallel_newlines_match_serial(tmp_path, chunk_size, monkeypatch):
+    contents = [b'a\r\nb\nc\rd\r\r\na\nb\r\n\xc3\xa9\r',
+                b'c\r\ne\n  a \r\nf\rf']
+    files = []
+    for i, content in enumerate(contents):
+        path = tmp_path / f'{i}.txt'
+        path.write_bytes(content)
+        files.append(str(path))
+
+    lazynlp.dedup_lines(files, str(tmp_path / 'serial'))
+    chunks = lazynlp.get_chunks
+    monkeypatch.setattr(lazynlp.dedup, 'get_chunks',
+                        lambda file, size: chunks(file, chunk_size))
+    lazynlp.dedup_lines(files, str(tmp_path / 'parallel'), workers=2)
+
+    serial = read_outputs(tmp_path / 'serial')
+    assert serial == {'0_0.txt': b'a\nb\nc\nd\n\n\xc3\xa9\n',
+                      '1_1.txt': b'e\nf\n'}
+    assert read_outputs(tmp_path / 'parallel') == serial
+
+
+def write_lines(tmp_path, seed=0, files=3, lines=2000):
+    """ Write files of random lines drawn from a small vocabulary, so that
+    many of them repeat, some only in their surrounding spaces.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        path = tmp_path / f'{i}.txt'
+        with open(path, 'w') as f:
+            for _ in range(lines):
+                line = f'line {rng.randrange(lines)}'
+                if rng.random() < 0.1:
+                    line = f'  {line} '
+                f.write(line + '\n')
+        paths.append(str(path))
+    return paths
+
+
+def dedup_with_set(files):
+    """ The old dedup_lines: keep the first occurrence of each stripped line
+    """
+    seen, outputs = set(), {}
+    for i, file in enumerate(files):
+        kept = []
+        with open(file, 'r') as f:
+            for line in f:
+                if line.strip() not in seen:
+                    seen.add(line.strip())
+                    kept.append(line)
+        outputs[f'{i}_{os.path.basename(file)}'] = ''.join(kept).encode()
+    return outputs
+
+
+@pytest.mark.parametrize('options', [{'backend': 'set'},
+                                     {'backend': 'table'},
+                                     {'backend': 'table', 'bits': 64},
+                                     {'backend': 'disk', 'max_memory': 2**12},
+                                     {'workers': 2}])
+def test_backends_match_set(tmp_path, options):
+    files = write_lines(tmp_path)
+    lazynlp.dedup_lines(files, str(tmp_path / 'out'), **options)
+    assert read_outputs(tmp_path / 'out') == dedup_with_set(files)
+
+    with open(files[1], 'r') as f:
+        seen_line = f.readline()
+    new_file = str(tmp_path / 'new.txt')
+    with open(new_file, 'w') as f:
+        f.write(f'{seen_line}new\n  new\nline 1999999\n')
+    outfile = str(tmp_path / 'new.out')
+    lazynlp.dedup_lines_from_new_file(files, new_file, outfile, **options)
+    with open(outfile, 'r') as f:
+        assert f.read() == 'new\nline 1999999\n'
+
+
+def test_table_over_budget_uses_disk(tmp_path, monkeypatch):
+    files = write_lines(tmp_path)
+    max_memory = lazynlp.FingerprintSet.get_memory(100)
+    # a table that grows past max_memory would raise midway
+    monkeypatch.setattr(lazynlp.cleaner, 'get_seen_set', None)
+    lazynlp.dedup_lines(files, str(tmp_path / 'out'), backend='table',
+                        max_memory=max_memory)
+    assert read_outputs(tmp_path / 'out') == dedup_with_set(files)
+
+
+@pytest.mark.parametrize('bits', [64, 128])
+def test_fingerprint_set_add_many(bits):
+    digests = [lazynlp.get_hash(str(i % 300)) for i in range(1000)]
+    digests[5] = digests[700] = bytes(16)
+    seen = lazynlp.FingerprintSet(bits=bits, capacity=4)
+    new = seen.add_many(digests[:600])
+    assert list(new) == [digests.index(digest) == i
+                         for i, digest in enumerate(digests[:600])]
+    assert not seen.add_many(digests[600:]).any()
+    assert len(seen) == 301
+    assert seen.capacity > 4
+    assert all(digest in seen for digest in digests)
+    assert lazynlp.get_hash('other') not in seen
+    assert seen.add(lazynlp.get_hash('other'))
+    assert not seen.add(lazynlp.get_hash('other'))
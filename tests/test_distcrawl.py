@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from lazynlp.distcrawl import *
+
+from .test_aiocrawl import read_page_files, read_status, write_links
+
+MODES = [{}, {'workers': 4}, {'concurrency': 4}]
+
+
+def steal_lease(root, shard, epoch, worker='other'):
+    """ Take the lease of shard as another worker that never renews it
+    """
+    lease = ShardLease(root, shard, worker)
+    with open(lease.get_file(epoch), 'w') as f:
+        f.write('{}')
+
+
+def run_in_thread(target, timeout=60):
+    """ Return the result or exception of target, failing if it hangs
+    """
+    result = {}
+
+    def run():
+        try:
+            result['value'] = target()
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'the crawl hangs'
+    return result
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_lease_stolen_stops_crawl(server, tmp_path, mode):
+    links = [server.url(f'/page/{i}') for i in range(40)]
+    write_links(tmp_path / 'links.txt', links)
+    root = str(tmp_path / 'root')
+    split_links(tmp_path / 'links.txt', root, num_shards=1)
+
+    lease = ShardLease(root, 0, 'me', lease_time=60)
+    assert lease.acquire()
+
+    def hook(path):
+        if path == '/page/10':
+            steal_lease(root, 0, lease.epoch + 1)
+
+    server.hook = hook
+    result = run_in_thread(lambda: crawl_shard(root, lease,
+                                               checkpoint_interval=2,
+                                               timeout=5,
+                                               **mode))
+    lease.release()
+    assert isinstance(result.get('error'), LeaseLost)
+    assert sum(server.hits.values()) < len(links)
+    assert not lease.is_done()
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_crawl_shards_resumes_stolen_shard(server, tmp_path, mode):
+    links = [server.url(f'/page/{i}') for i in range(40)]
+    write_links(tmp_path / 'links.txt', links)
+    root = str(tmp_path / 'root')
+    split_links(tmp_path / 'links.txt', root, num_shards=1)
+    stolen = []
+
+    def hook(path):
+        if path == '/page/10' and not stolen:
+            epoch = max(ShardLease(root, 0).epochs())
+            steal_lease(root, 0, epoch + 1)
+            stolen.append(epoch + 1)
+
+    server.hook = hook
+    result = run_in_thread(lambda: crawl_shards(tmp_path / 'links.txt',
+                                                root,
+                                                worker='me',
+                                                lease_time=1,
+                                                poll=0.1,
+                                                checkpoint_interval=2,
+                                                timeout=5,
+                                                **mode))
+    assert result.get('value') == [0]
+    assert stolen
+
+    counts = merge_shards(root, str(tmp_path / 'merged'))
+    assert counts['index'] == len(links)
+    assert sorted(read_status(tmp_path / 'merged', 'index')) == sorted(links)
+    pages = read_page_files(tmp_path / 'merged')
+    assert sorted(url for url, _ in pages.values()) == sorted(links)
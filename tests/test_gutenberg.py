@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import lazynlp
+
+from .server import LocalServer
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'gutenberg')
+
+# books 1 to 4 each use one of the link templates, 5 doesn't exist
+BOOK_PATHS = ['/cache/epub/1/pg1.txt', '/files/2/2.txt', '/files/3/3-0.txt',
+              '/files/4/4-8.txt']
+
+
+def read_fixtures():
+    """ Return {path: text} of the files of the mirror in FIXTURES
+    """
+    files = {}
+    for root, _, names in os.walk(FIXTURES):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'r') as f:
+                files['/' + os.path.relpath(path, FIXTURES)] = f.read()
+    return files
+
+
+@pytest.fixture
+def mirror():
+    with LocalServer(read_fixtures()) as server:
+        yield server
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        return f.read().split()
+
+
+def test_links_from_id(mirror):
+    session = lazynlp.get_session()
+    try:
+        for book_id, path in enumerate(BOOK_PATHS, 1):
+            assert lazynlp.get_gutenberg_link_from_id(
+                book_id, session, mirror.url('')) == mirror.url(path)
+        assert lazynlp.get_gutenberg_link_from_id(
+            5, session, mirror.url('')) is None
+    finally:
+        session.close()
+
+
+def test_workers_match_serial(mirror, tmp_path):
+    serial = str(tmp_path / 'serial.urls')
+    lazynlp.get_us_gutenberg_links(serial, max_id=5, base_url=mirror.url(''))
+    assert read_lines(serial) == [mirror.url(path) for path in BOOK_PATHS]
+
+    outfile = str(tmp_path / 'books.urls')
+    lazynlp.get_us_gutenberg_links(outfile, max_id=5, workers=4,
+                                   base_url=mirror.url(''))
+    assert read_lines(outfile) == read_lines(serial)
+
+    cache = lazynlp.read_gutenberg_cache(outfile + '.cache')
+    assert cache == {1: mirror.url(BOOK_PATHS[0]),
+                     2: mirror.url(BOOK_PATHS[1]),
+                     3: mirror.url(BOOK_PATHS[2]),
+                     4: mirror.url(BOOK_PATHS[3]),
+                     5: ''}
+
+
+def test_rerun_uses_cache(mirror, tmp_path):
+    outfile = str(tmp_path / 'books.urls')
+    lazynlp.get_us_gutenberg_links(outfile, max_id=3, workers=4,
+                                   base_url=mirror.url(''))
+    hits = sum(mirror.hits.values())
+
+    lazynlp.get_us_gutenberg_links(outfile, max_id=3, workers=4,
+                                   base_url=mirror.url(''))
+    assert sum(mirror.hits.values()) == hits
+
+    lazynlp.get_us_gutenberg_links(outfile, max_id=5, workers=4,
+                                   base_url=mirror.url(''))
+    assert read_lines(outfile) == [mirror.url(path) for path in BOOK_PATHS]
+    assert all(mirror.hits[path] == 1 for path in BOOK_PATHS[:3])
+
+
+def test_truncated_cache(mirror, tmp_path):
+    outfile = str(tmp_path / 'books.urls')
+    with open(outfile + '.cache', 'w') as f:
+        f.write(f'1\t{mirror.url(BOOK_PATHS[0])}\n'
+                f'2\t{mirror.url(BOOK_PATHS[1])}\n'
+                f'5\t\n'
+                f'3\t{mirror.url(BOOK_PATHS[2])[:-6]}')
+    assert lazynlp.read_gutenberg_cache(outfile + '.cache') == {
+        1: mirror.url(BOOK_PATHS[0]), 2: mirror.url(BOOK_PATHS[1]), 5: ''}
+
+    # a line cut to its book id
+    with open(outfile + '.cache', 'w') as f:
+        f.write(f'1\t{mirror.url(BOOK_PATHS[0])}\n'
+                f'2\t{mirror.url(BOOK_PATHS[1])}\n'
+                f'5\t\n'
+                f'4')
+    lazynlp.get_us_gutenberg_links(outfile, max_id=5, workers=4,
+                                   base_url=mirror.url(''))
+    assert read_lines(outfile) == [mirror.url(path) for path in BOOK_PATHS]
+    assert mirror.hits[BOOK_PATHS[0]] == 0
+    assert lazynlp.read_gutenberg_cache(outfile + '.cache') == {
+        book_id: mirror.url(path) for book_id, path in enumerate(BOOK_PATHS, 1)
+    } | {5: ''}
@@ -0,0 +1,177 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+import pytest
+
+import lazynlp
+
+from .test_aiocrawl import read_page_files, read_status, write_links
+
+
+class FakeResolver:
+    """ Resolver for DNSCache that resolves the hosts in addresses,
+    and counts the lookups of each host.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.lookups = collections.Counter()
+
+    def __call__(self, host):
+        self.lookups[host] += 1
+        if host not in self.addresses:
+            raise socket.gaierror(socket.EAI_NONAME, f'No address for {host}')
+        return self.addresses[host]
+
+
+def test_ttl():
+    resolver = FakeResolver({'site.test': ['127.0.0.1']})
+    dns = lazynlp.DNSCache(resolver, ttl=0.2)
+    try:
+        assert dns.resolve('site.test') == ['127.0.0.1']
+        assert dns.resolve('site.test') == ['127.0.0.1']
+        assert resolver.lookups['site.test'] == 1
+        time.sleep(0.3)
+        dns.resolve('site.test')
+        assert resolver.lookups['site.test'] == 2
+    finally:
+        dns.close()
+
+
+def test_negative_cache():
+    resolver = FakeResolver({})
+    dns = lazynlp.DNSCache(resolver, negative_ttl=60)
+    try:
+        assert not dns.failed('dead.test')
+        for _ in range(3):
+            with pytest.raises(socket.gaierror):
+                dns.resolve('dead.test')
+        assert dns.failed('dead.test')
+        assert resolver.lookups['dead.test'] == 1
+    finally:
+        dns.close()
+
+
+def test_getaddrinfo():
+    dns = lazynlp.DNSCache(FakeResolver({'site.test': ['127.0.0.1', '::1']}))
+    try:
+        with dns.installed():
+            infos = socket.getaddrinfo('site.test', 80, socket.AF_INET)
+        assert socket.getaddrinfo is lazynlp.system_getaddrinfo
+        assert [info[4] for info in infos] == [('127.0.0.1', 80)]
+    finally:
+        dns.close()
+
+
+def test_installs_exit_out_of_order():
+    first = lazynlp.DNSCache(FakeResolver({'site.test': ['127.0.0.1']}))
+    second = lazynlp.DNSCache(FakeResolver({'site.test': ['127.0.0.2']}))
+    try:
+        outer = first.installed()
+        outer.__enter__()
+        with second.installed():
+            assert socket.getaddrinfo('site.test', 80)[0][4] == \
+                ('127.0.0.2', 80)
+            outer.__exit__(None, None, None)
+            assert socket.getaddrinfo('site.test', 80)[0][4] == \
+                ('127.0.0.2', 80)
+        assert socket.getaddrinfo is lazynlp.system_getaddrinfo
+    finally:
+        first.close()
+        second.close()
+
+
+def test_cache_resolver():
+    resolver = FakeResolver({'site.test': ['127.0.0.1', '::1']})
+    dns = lazynlp.DNSCache(resolver)
+
+    async def resolve(host, family):
+        return await lazynlp.CacheResolver(dns).resolve(host, 80, family)
+
+    try:
+        results = asyncio.run(resolve('site.test', socket.AF_UNSPEC))
+        assert [(r['host'], r['family']) for r in results] == \
+            [('127.0.0.1', socket.AF_INET), ('::1', socket.AF_INET6)]
+        results = asyncio.run(resolve('site.test', socket.AF_INET6))
+        assert [(r['host'], r['port']) for r in results] == [('::1', 80)]
+        with pytest.raises(socket.gaierror):
+            asyncio.run(resolve('dead.test', socket.AF_INET))
+        assert resolver.lookups == {'site.test': 1, 'dead.test': 1}
+    finally:
+        dns.close()
+
+
+def test_resolver_calling_getaddrinfo():
+    """ A resolver that uses socket.getaddrinfo while the cache is installed
+    gets the system's answer instead of waiting for its own lookup.
+    """
+    def resolver(host):
+        infos = socket.getaddrinfo('localhost', None, 0, socket.SOCK_STREAM)
+        return [info[4][0] for info in infos]
+
+    dns = lazynlp.DNSCache(resolver, workers=1)
+    addresses = []
+    try:
+        with dns.installed():
+            thread = threading.Thread(
+                target=lambda: addresses.extend(dns.resolve('site.test')),
+                daemon=True)
+            thread.start()
+            thread.join(10)
+        assert not thread.is_alive(), 'the lookup waits for itself'
+        assert addresses
+    finally:
+        dns.close()
+
+
+@pytest.mark.parametrize('mode', [{}, {'concurrency': 4}])
+def test_crawl(server, tmp_path, mode):
+    resolver = FakeResolver({'site.test': ['127.0.0.1']})
+    pages = [server.url(f'/page/{i}', host='site.test') for i in range(4)]
+    dead = [server.url(f'/page/{i}', host='dead.test') for i in range(4, 6)]
+    write_links(tmp_path / 'links.txt', pages + dead)
+    patched = []
+    server.hook = lambda path: patched.append(
+        socket.getaddrinfo is not lazynlp.system_getaddrinfo)
+    lazynlp.download_pages(str(tmp_path / 'links.txt'),
+                           str(tmp_path / 'out'), timeout=1, dns_ttl=300,
+                           resolver=resolver, **mode)
+    # only the threaded crawler replaces socket.getaddrinfo
+    assert patched == [not mode] * 4
+
+    out = tmp_path / 'out'
+    assert sorted(read_status(out, 'index')) == sorted(pages)
+    assert read_status(out, 'bad') == dead
+    assert sorted(read_page_files(out)) == list(range(4))
+    assert resolver.lookups == {'site.test': 1, 'dead.test': 1}
+    assert all(server.hits[f'/page/{i}'] == 0 for i in range(4, 6))
+    assert socket.getaddrinfo is lazynlp.system_getaddrinfo
+
+
+def test_async_lookups_dont_block_crawl(server, tmp_path):
+    """ Without prefetching, a slow lookup holds up one fetcher,
+    not the others.
+    """
+    fetched = threading.Event()
+    waits = []
+
+    def resolver(host):
+        if host == 'slow.test':
+            waits.append(fetched.wait(10))
+            raise socket.gaierror(socket.EAI_NONAME, host)
+        return ['127.0.0.1']
+
+    server.hook = lambda path: fetched.set()
+    slow = server.url('/page/0', host='slow.test')
+    pages = [server.url(f'/page/{i}', host='site.test') for i in range(1, 4)]
+    write_links(tmp_path / 'links.txt', [slow] + pages)
+    lazynlp.download_pages(str(tmp_path / 'links.txt'),
+                           str(tmp_path / 'out'), timeout=1, concurrency=4,
+                           dns_ttl=300, prefetch=0, resolver=resolver)
+
+    assert waits == [True]
+    assert read_status(tmp_path / 'out', 'bad') == [slow]
+    assert sorted(read_status(tmp_path / 'out', 'index')) == sorted(pages)
@@ -0,0 +1,78 @@
+import gzip
+import os
+import pickle
+
+import lazynlp
+from lazynlp.store import ShardFile, get_index_file
+
+
+def write_pages(folder, start, end, shard_size=4):
+    writer = lazynlp.ShardWriter(str(folder), shard_size)
+    for idx in range(start, end):
+        writer.write(idx, f'http://example.com/{idx}', f'page {idx}\nline 2',
+                     timestamp=0)
+    writer.close()
+
+
+def read_index(shard_file):
+    with open(get_index_file(shard_file), 'r') as f:
+        return f.read()
+
+
+def test_missing_index(tmp_path):
+    write_pages(tmp_path, 0, 6)
+    shard_file = lazynlp.list_shards(str(tmp_path))[-1]
+    index = read_index(shard_file)
+    os.remove(get_index_file(shard_file))
+
+    write_pages(tmp_path, 6, 9)
+    assert read_index(shard_file).startswith(index)
+    documents = lazynlp.get_documents(str(tmp_path))
+    assert [doc.idx for doc in documents] == list(range(9))
+    assert len(lazynlp.list_shards(str(tmp_path))) == 3
+    assert documents[5].read()['text'] == 'page 5\nline 2'
+
+
+def test_page_cut_short(tmp_path):
+    write_pages(tmp_path, 0, 2)
+    shard_file = lazynlp.list_shards(str(tmp_path))[-1]
+    index = read_index(shard_file)
+    size = os.path.getsize(shard_file)
+    # a crash in the middle of writing a page and before its index line
+    with open(shard_file, 'ab') as f:
+        f.write(gzip.compress(b'{"idx": 2, "url": "x", "text": "y"}\n')[:10])
+
+    writer = lazynlp.ShardWriter(str(tmp_path), 4)
+    writer.close()
+    assert writer.count == 2
+    assert os.path.getsize(shard_file) == size
+    assert read_index(shard_file) == index
+
+    write_pages(tmp_path, 2, 3)
+    assert [page['idx'] for page in lazynlp.read_pages(str(tmp_path))] == \
+        [0, 1, 2]
+
+
+def test_documents_share_shard(tmp_path):
+    write_pages(tmp_path, 0, 8)
+    documents = lazynlp.get_documents(str(tmp_path))
+    shards = {id(doc.shard) for doc in documents}
+    assert len(shards) == 2
+
+    texts = [doc.read()['text'] for doc in documents]
+    assert texts == [f'page {idx}\nline 2' for idx in range(8)]
+    assert documents[0].shard.f is not None
+
+    copies = pickle.loads(pickle.dumps(documents))
+    assert copies[0].shard.f is None
+    assert [doc.read()['text'] for doc in copies] == texts
+
+
+def test_max_open_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(ShardFile, 'max_open', 2)
+    write_pages(tmp_path, 0, 8, shard_size=2)
+    documents = lazynlp.get_documents(str(tmp_path))
+    for doc in documents:
+        doc.read()
+    opened = [doc.shard for doc in documents[::2] if doc.shard.f is not None]
+    assert opened == [documents[4].shard, documents[6].shard]